@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the admission control stage that sits between the network socket and
+    the IkeSaController, prioritising messages for established IKE_SAs and rate-limiting new negotiations
+"""
+import time
+from collections import Counter, OrderedDict, deque
+
+from helpers import SafeIntEnum
+from message import IkeSaError, Message
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class TokenBucket:
+    """ Classic token bucket: allows bursts of up to burst events and rate events per second in average
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, tokens=1):
+        """ Takes the indicated number of tokens from the bucket, if available
+        """
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    @property
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class AdmissionScheduler:
+    """ Classifies inbound datagrams from their IKE header only, queues them by priority and drops
+        the excess, keeping a counter per drop reason
+    """
+    class Priority(SafeIntEnum):
+        ESTABLISHED = 0
+        NEW = 1
+
+    # Maximum number of queued messages per priority
+    MAX_QUEUE_LENGTH = {Priority.ESTABLISHED: 1000, Priority.NEW: 100}
+
+    # Maximum number of per-peer buckets kept. The least recently used one is evicted to make room
+    MAX_PEER_BUCKETS = 10000
+
+    def __init__(self, is_known_spi, peer_rate=2, peer_burst=5, global_rate=50, global_burst=100):
+        self.is_known_spi = is_known_spi
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        # per-peer buckets, least recently used first
+        self.peer_buckets = OrderedDict()
+        self.queues = {x: deque() for x in AdmissionScheduler.Priority}
+        self.accepted = Counter()
+        self.drops = Counter()
+
+    def __len__(self):
+        return sum(len(x) for x in self.queues.values())
+
+    def _drop(self, reason):
+        self.drops[reason] += 1
+        return False
+
+    def _get_peer_bucket(self, peer_ip):
+        bucket = self.peer_buckets.get(peer_ip)
+        if bucket is not None:
+            self.peer_buckets.move_to_end(peer_ip)
+            return bucket
+        if len(self.peer_buckets) >= self.MAX_PEER_BUCKETS:
+            self.peer_buckets.popitem(last=False)
+        bucket = self.peer_buckets[peer_ip] = TokenBucket(self.peer_rate, self.peer_burst)
+        return bucket
+
+    def classify(self, data):
+        """ Returns the priority of the message, or None if it does not belong to any IKE_SA and is not
+            starting a new one
+        """
+        header = Message.parse(data, header_only=True)
+        if (header.exchange_type in (Message.Exchange.IKE_SA_INIT, Message.Exchange.IKE_SESSION_RESUME)
+                and header.is_request):
+            return AdmissionScheduler.Priority.NEW
+        my_spi = header.spi_r if header.is_initiator else header.spi_i
+        if self.is_known_spi(my_spi):
+            return AdmissionScheduler.Priority.ESTABLISHED
+        return None
+
+    def submit(self, data, addr):
+        """ Classifies and queues an inbound datagram. Returns whether it has been accepted
+        """
+        try:
+            priority = self.classify(data)
+        except IkeSaError:
+            return self._drop('malformed')
+        if priority is None:
+            return self._drop('unknown_spi')
+        queue = self.queues[priority]
+        if len(queue) >= self.MAX_QUEUE_LENGTH[priority]:
+            return self._drop('queue_full')
+        if priority == AdmissionScheduler.Priority.NEW:
+            # the global bucket goes first, so a flood of (spoofed) sources cannot create peer buckets beyond its rate
+            if not self.global_bucket.consume():
+                return self._drop('global_rate')
+            if not self._get_peer_bucket(addr[0]).consume():
+                return self._drop('peer_rate')
+        queue.append((data, addr))
+        self.accepted[priority.name] += 1
+        return True
+
+    def get(self):
+        """ Returns the next (data, addr) tuple to be processed, highest priority first, or None
+        """
+        for priority in AdmissionScheduler.Priority:
+            if self.queues[priority]:
+                return self.queues[priority].popleft()
+        return None
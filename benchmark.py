@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines micro-benchmarks for the hot paths of the daemon, comparing them with the
+    straightforward implementations they replaced. Run it as a script.
+"""
+import argparse
+import logging
+import os
+import timeit
+from ipaddress import ip_address, ip_network
+from unittest.mock import patch
+
+from configuration import Configuration, ProtectIndex
+from message import PayloadSA, PayloadTSi, PayloadTSr, Proposal, ProposalTable, TrafficSelector, Transform
+from protocol_ import IkeSa
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+def _linear_ipsec_configuration(protect, payload_tsi, payload_tsr):
+    """ Former IkeSa._get_ipsec_configuration(), which compares every received TS pair with every
+        "protect" configuration
+    """
+    for tsi in reversed(payload_tsi.traffic_selectors):
+        for tsr in reversed(payload_tsr.traffic_selectors):
+            for ipsec_conf in protect:
+                conf_tsi = TrafficSelector.from_network(ipsec_conf.my_subnet, ipsec_conf.my_port, ipsec_conf.ip_proto)
+                conf_tsr = TrafficSelector.from_network(ipsec_conf.peer_subnet, ipsec_conf.peer_port,
+                                                        ipsec_conf.ip_proto)
+                if tsi.is_subset(conf_tsi) and tsr.is_subset(conf_tsr):
+                    return ipsec_conf, tsi, tsr
+                elif conf_tsi.is_subset(tsi) and conf_tsr.is_subset(tsr):
+                    return ipsec_conf, conf_tsi, conf_tsr
+    return None
+
+
+def _indexed_ipsec_configuration(protect_index, payload_tsi, payload_tsr):
+    for tsi in reversed(payload_tsi.traffic_selectors):
+        for tsr in reversed(payload_tsr.traffic_selectors):
+            match = protect_index.lookup(tsi, tsr)
+            if match is not None:
+                return match
+    return None
+
+
+def bench_ts_matching(protect_entries, number):
+    """ Matches a CHILD_SA request for the last of protect_entries /24 subnets of a peer
+    """
+    configuration = Configuration('192.168.0.1', {
+        '192.168.0.2': {
+            'protect': [{'my_subnet': '10.{}.{}.0/24'.format(i // 256, i % 256), 'peer_subnet': '172.16.0.0/16',
+                         'mode': 'tunnel', 'index': i} for i in range(protect_entries)]
+        }
+    })
+    protect = configuration.get_ike_configuration('192.168.0.2').protect
+    last = protect_entries - 1
+    # peers include the packet that triggered the negotiation as the first TS (RFC 7296 section 2.9)
+    payload_tsi = PayloadTSi([
+        TrafficSelector.from_network(ip_network('10.{}.{}.7/32'.format(last // 256, last % 256)), 0,
+                                     TrafficSelector.IpProtocol.ANY),
+        TrafficSelector.from_network(ip_network('10.{}.{}.0/24'.format(last // 256, last % 256)), 0,
+                                     TrafficSelector.IpProtocol.ANY)])
+    payload_tsr = PayloadTSr([
+        TrafficSelector.from_network(ip_network('172.16.0.1/32'), 0, TrafficSelector.IpProtocol.ANY),
+        TrafficSelector.from_network(ip_network('172.16.0.0/16'), 0, TrafficSelector.IpProtocol.ANY)])
+    assert (_linear_ipsec_configuration(protect, payload_tsi, payload_tsr)
+            == _indexed_ipsec_configuration(protect.ts_index, payload_tsi, payload_tsr))
+    # seconds per call
+    return {
+        'linear': timeit.timeit(lambda: _linear_ipsec_configuration(protect, payload_tsi, payload_tsr),
+                                number=number) / number,
+        'index build': timeit.timeit(lambda: ProtectIndex(protect), number=1),
+        'indexed': timeit.timeit(lambda: _indexed_ipsec_configuration(protect.ts_index, payload_tsi, payload_tsr),
+                                 number=number) / number,
+    }
+
+
+def _nested_intersection(my_proposal, other):
+    """ Former Proposal.intersection(), which compares every pair of transforms
+    """
+    if my_proposal.protocol_id == other.protocol_id:
+        selected = {}
+        for my_transform in my_proposal.transforms:
+            for peer_transform in other.transforms:
+                if my_transform == peer_transform and my_transform.type not in selected:
+                    selected[my_transform.type] = my_transform
+        if set(selected) == set(x.type for x in my_proposal.transforms):
+            return Proposal(other.num, my_proposal.protocol_id, other.spi, list(selected.values()))
+    return None
+
+
+def _nested_select(ike_conf, payload_sa):
+    # the proposal used to be rebuilt from the configuration on every negotiation
+    my_proposal = Proposal(1, Proposal.Protocol.IKE, b'', ike_conf.encr + ike_conf.integ + ike_conf.prf + ike_conf.dh)
+    for peer_proposal in payload_sa.proposals:
+        intersection = _nested_intersection(my_proposal, peer_proposal)
+        if intersection is not None:
+            return intersection
+    return None
+
+
+def _table_select(ike_conf, payload_sa):
+    table = ProposalTable.get(Proposal.Protocol.IKE, tuple(ike_conf.encr + ike_conf.integ + ike_conf.prf
+                                                           + ike_conf.dh))
+    for peer_proposal in payload_sa.proposals:
+        intersection = table.negotiate(peer_proposal)
+        if intersection is not None:
+            return intersection
+    return None
+
+
+def bench_proposal_negotiation(peer_proposals, number):
+    """ Negotiates an IKE_SA with a peer offering peer_proposals proposals, of which only the last one is
+        acceptable
+    """
+    configuration = Configuration('192.168.0.1', {
+        '192.168.0.2': {'encr': ['aes256', 'aes128'], 'integ': ['sha512', 'sha256', 'sha1'],
+                        'prf': ['sha512', 'sha256', 'sha1'], 'dh': ['18', '17', '16', '15', '14']}
+    })
+    ike_conf = configuration.get_ike_configuration('192.168.0.2')
+    unacceptable = [Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_3DES),
+                    Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_MD5_96),
+                    Transform(Transform.Type.PRF, Transform.PrfId.PRF_HMAC_MD5),
+                    Transform(Transform.Type.DH, Transform.DhId.DH_2)]
+    proposals = [Proposal(i + 1, Proposal.Protocol.IKE, b'', unacceptable + ike_conf.dh[:2])
+                 for i in range(peer_proposals - 1)]
+    proposals.append(Proposal(peer_proposals, Proposal.Protocol.IKE, b'',
+                              unacceptable + ike_conf.encr[1:] + ike_conf.integ[1:] + ike_conf.prf[1:]
+                              + ike_conf.dh[-1:]))
+    payload_sa = PayloadSA.parse(PayloadSA(proposals).to_bytes())
+    assert _nested_select(ike_conf, payload_sa) == _table_select(ike_conf, payload_sa)
+    # seconds per call
+    return {
+        'nested': timeit.timeit(lambda: _nested_select(ike_conf, payload_sa), number=number) / number,
+        'table': timeit.timeit(lambda: _table_select(ike_conf, payload_sa), number=number) / number,
+    }
+
+
+def _handshake(conf1, conf2):
+    """ Runs IKE_SA_INIT and IKE_AUTH between two IkeSa objects
+    """
+    ip1, ip2 = ip_address('192.168.0.1'), ip_address('192.168.0.2')
+    ike_sa1 = IkeSa(is_initiator=True, peer_spi=b'\0' * 8, configuration=conf1, my_addr=ip1, peer_addr=ip2)
+    ike_sa2 = IkeSa(is_initiator=False, peer_spi=ike_sa1.my_spi, configuration=conf2, my_addr=ip2, peer_addr=ip1)
+    tsi = TrafficSelector.from_network(ip_network('192.168.0.1/32'), 0, TrafficSelector.IpProtocol.ANY)
+    tsr = TrafficSelector.from_network(ip_network('192.168.0.2/32'), 0, TrafficSelector.IpProtocol.ANY)
+    ike_auth_req = ike_sa1.process_message(ike_sa2.process_message(ike_sa1.process_acquire(tsi, tsr, 1)))
+    ike_sa1.process_message(ike_sa2.process_message(ike_auth_req))
+    assert ike_sa1.state == ike_sa2.state == IkeSa.State.ESTABLISHED
+
+
+def bench_handshake(level, number):
+    """ Measures the handshakes per second with the indicated logging level, writing the log to /dev/null.
+        Before lazy logging, the DEBUG work (JSON dumps, hex-encoded keys) was done for every level
+    """
+    conf1 = Configuration('192.168.0.1', {'192.168.0.2': {'psk': 'bench', 'protect': [{'index': 1}]}})
+    conf2 = Configuration('192.168.0.2', {'192.168.0.1': {'psk': 'bench', 'protect': [{'index': 1}]}})
+    conf1, conf2 = conf1.get_ike_configuration('192.168.0.2'), conf2.get_ike_configuration('192.168.0.1')
+    logger = logging.getLogger()
+    old_level, old_handlers = logger.level, logger.handlers
+    with open(os.devnull, 'w') as devnull, patch('xfrm.Xfrm'):
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter('[%(asctime)s.%(msecs)03d] [%(levelname)-7s] %(message)s'))
+        logger.handlers = [handler]
+        logger.setLevel(level)
+        logging.indent = 2
+        try:
+            elapsed = timeit.timeit(lambda: _handshake(conf1, conf2), number=number)
+        finally:
+            logger.handlers = old_handlers
+            logger.setLevel(old_level)
+    return {'handshakes/s': number / elapsed}
+
+
+BENCHMARKS = {
+    'handshake': lambda args: ((logging.getLevelName(x), bench_handshake(x, args.number))
+                               for x in (logging.INFO, logging.DEBUG)),
+    'proposal_negotiation': lambda args: ((n, bench_proposal_negotiation(n, args.number)) for n in (1, 10, 50)),
+    'ts_matching': lambda args: ((n, bench_ts_matching(n, args.number)) for n in (10, 100, 1000)),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the pyikev2 micro-benchmarks.')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+                        help='Benchmarks to run ({}). All of them by default.'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--number', type=int, default=100, help='Number of iterations of each measurement.')
+    args = parser.parse_args()
+    for name in set(args.benchmarks) - set(BENCHMARKS):
+        parser.error('unknown benchmark {}'.format(name))
+    for name in args.benchmarks:
+        for size, results in BENCHMARKS[name](args):
+            print('{} ({}): {}'.format(name, size, ', '.join(
+                '{} {:.1f}'.format(k, v) if k.endswith('/s') else '{} {:.3f} ms'.format(k, v * 1000)
+                for k, v in results.items())))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the capture of the IKE exchanges to pcapng files, to be inspected with Wireshark.
+    Sent and received datagrams are written as IP/UDP packets. Optionally, the decrypted messages are
+    written as well (as if they had been sent unencrypted), and the IKE_SA keys are appended to a Wireshark
+    ikev2_decryption_table file, so the original packets can be decrypted too.
+"""
+import os
+import time
+from ipaddress import ip_address
+from struct import pack
+
+from message import Transform
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+# pcapng block types and options
+BLOCK_SHB = 0x0A0D0D0A
+BLOCK_IDB = 0x00000001
+BLOCK_EPB = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPT_ENDOFOPT = 0
+OPT_COMMENT = 1
+SHB_USERAPPL = 4
+IF_NAME = 2
+# raw IPv4/IPv6 packets
+LINKTYPE_RAW = 101
+
+IP_PROTO_UDP = 17
+
+# suffix of the Wireshark decryption table written next to each capture file
+KEYS_SUFFIX = '.ikev2_decryption_table'
+
+# names of the algorithms in the Wireshark ikev2_decryption_table file
+_WIRESHARK_ENCR = {
+    (Transform.EncrId.ENCR_AES_CBC, 128): 'AES-CBC-128 [RFC3602]',
+    (Transform.EncrId.ENCR_AES_CBC, 192): 'AES-CBC-192 [RFC3602]',
+    (Transform.EncrId.ENCR_AES_CBC, 256): 'AES-CBC-256 [RFC3602]',
+}
+
+_WIRESHARK_INTEG = {
+    Transform.IntegId.AUTH_HMAC_SHA1_96: 'HMAC_SHA1_96 [RFC2404]',
+    Transform.IntegId.AUTH_HMAC_SHA2_256_128: 'HMAC_SHA2_256_128 [RFC4868]',
+    Transform.IntegId.AUTH_HMAC_SHA2_512_256: 'HMAC_SHA2_512_256 [RFC4868]',
+}
+
+
+def _block(block_type, body):
+    length = 12 + len(body)
+    return pack('<LL', block_type, length) + body + pack('<L', length)
+
+
+def _options(*options):
+    data = bytearray()
+    for code, value in options:
+        data += pack('<HH', code, len(value)) + value + b'\0' * (-len(value) % 4)
+    return bytes(data + pack('<HH', OPT_ENDOFOPT, 0))
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum((data[i] << 8) + data[i + 1] for i in range(0, len(data), 2))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def ip_udp_packet(data, src, dst):
+    """ Encapsulates an IKE datagram in IP and UDP headers. src and dst are (address, port) tuples
+    """
+    src_addr, dst_addr = ip_address(src[0]), ip_address(dst[0])
+    udp_length = 8 + len(data)
+    if src_addr.version == 4:
+        pseudo_header = pack('>4s4sBBH', src_addr.packed, dst_addr.packed, 0, IP_PROTO_UDP, udp_length)
+    else:
+        pseudo_header = pack('>16s16sL3xB', src_addr.packed, dst_addr.packed, udp_length, IP_PROTO_UDP)
+    udp_checksum = _checksum(pseudo_header + pack('>HHHH', src[1], dst[1], udp_length, 0) + data) or 0xFFFF
+    udp = pack('>HHHH', src[1], dst[1], udp_length, udp_checksum) + data
+    if src_addr.version == 4:
+        ip_header = pack('>BBHHHBBH4s4s', 0x45, 0, 20 + udp_length, 0, 0, 64, IP_PROTO_UDP, 0,
+                         src_addr.packed, dst_addr.packed)
+        ip_header = ip_header[:10] + pack('>H', _checksum(ip_header)) + ip_header[12:]
+    else:
+        ip_header = pack('>LHBB16s16s', 6 << 28, udp_length, IP_PROTO_UDP, 64, src_addr.packed, dst_addr.packed)
+    return ip_header + udp
+
+
+class Capture:
+    """ Writes the IKE datagrams to a pcapng file through a write buffer, which is flushed every
+        FLUSH_INTERVAL seconds. Once the file reaches MAX_SIZE bytes it is rotated, keeping up to
+        MAX_FILES old files (path.1 being the most recent one). The decryption table is rotated along with
+        it, and the new one starts with the keys of the IKE_SAs that are still alive
+    """
+    MAX_SIZE = 100 * 1024 * 1024
+    MAX_FILES = 5
+    BUFFER_SIZE = 1024 * 1024
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, path, decrypted=False):
+        self.path = path
+        self.decrypted = decrypted
+        self.keys_path = path + KEYS_SUFFIX
+        # decryption table lines of the IKE_SAs still alive, indexed by (SPIi, SPIr)
+        self.keys = {}
+        self.packets = 0
+        self.file = None
+        self.flush_at = 0
+        self._open()
+
+    def _open(self):
+        # every file (and every capture appended to an existing file) starts a new pcapng section
+        self.file = open(self.path, 'ab', buffering=self.BUFFER_SIZE)
+        self.file.write(_block(BLOCK_SHB, pack('<LHHq', BYTE_ORDER_MAGIC, 1, 0, -1)
+                               + _options((SHB_USERAPPL, b'pyikev2'))))
+        self.file.write(_block(BLOCK_IDB, pack('<HHL', LINKTYPE_RAW, 0, 0) + _options((IF_NAME, b'ike'))))
+        self.flush_at = time.time() + self.FLUSH_INTERVAL
+
+    def _rotate(self):
+        self.file.close()
+        for suffix in ('', KEYS_SUFFIX):
+            for index in range(self.MAX_FILES - 1, 0, -1):
+                if os.path.exists('{}.{}{}'.format(self.path, index, suffix)):
+                    os.replace('{}.{}{}'.format(self.path, index, suffix),
+                               '{}.{}{}'.format(self.path, index + 1, suffix))
+            if not os.path.exists(self.path + suffix):
+                continue
+            if self.MAX_FILES > 0:
+                os.replace(self.path + suffix, '{}.1{}'.format(self.path, suffix))
+            else:
+                os.remove(self.path + suffix)
+        self._open()
+        if self.keys:
+            self._append_keys(self.keys.values())
+
+    def _append_keys(self, lines):
+        # the keys are never readable by other users
+        fd = os.open(self.keys_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'a') as file:
+            file.writelines(lines)
+
+    def write_packet(self, packet, timestamp=None, comment=None):
+        timestamp = int((time.time() if timestamp is None else timestamp) * 1000000)
+        body = (pack('<LLLLL', 0, timestamp >> 32, timestamp & 0xFFFFFFFF, len(packet), len(packet))
+                + packet + b'\0' * (-len(packet) % 4))
+        if comment is not None:
+            body += _options((OPT_COMMENT, comment.encode()))
+        self.file.write(_block(BLOCK_EPB, body))
+        self.packets += 1
+        if self.file.tell() >= self.MAX_SIZE:
+            self._rotate()
+        elif time.time() >= self.flush_at:
+            self.flush()
+
+    def write_datagram(self, data, src, dst):
+        """ Writes a sent or received IKE datagram. src and dst are (address, port) tuples
+        """
+        self.write_packet(ip_udp_packet(bytes(data), src, dst))
+
+    def write_decrypted(self, data, src, dst):
+        """ Writes the cleartext version of an encrypted IKE message
+        """
+        self.write_packet(ip_udp_packet(bytes(data), src, dst), comment='Decrypted')
+
+    def write_keys(self, spi_i, spi_r, proposal, keyring):
+        """ Appends the IKE_SA keys to the Wireshark ikev2_decryption_table file
+        """
+        encr = proposal.get_transform(Transform.Type.ENCR)
+        integ = proposal.get_transform(Transform.Type.INTEG)
+        fields = [spi_i.hex(), spi_r.hex(), keyring.sk_ei.hex(), keyring.sk_er.hex(),
+                  _WIRESHARK_ENCR.get((encr.id, encr.keylen or 128), Transform.EncrId.safe_name(encr.id)),
+                  keyring.sk_ai.hex(), keyring.sk_ar.hex(),
+                  _WIRESHARK_INTEG.get(integ.id, Transform.IntegId.safe_name(integ.id))]
+        line = ','.join('"{}"'.format(x) for x in fields) + '\n'
+        self.keys[(spi_i, spi_r)] = line
+        self._append_keys([line])
+
+    def forget_keys(self, spi_i, spi_r):
+        """ Stops carrying the keys of an IKE_SA over to the rotated decryption tables (e.g. once deleted)
+        """
+        self.keys.pop((spi_i, spi_r), None)
+
+    def flush(self):
+        self.file.flush()
+        self.flush_at = time.time() + self.FLUSH_INTERVAL
+
+    def close(self):
+        self.file.close()
+
+
+# capture in progress, shared by the IkeSaController and all the IKE_SAs
+_capture = None
+
+
+def start(path, decrypted=False):
+    """ Starts capturing to the indicated file. Returns the Capture object
+    """
+    global _capture
+    stop()
+    _capture = Capture(path, decrypted)
+    return _capture
+
+
+def stop():
+    global _capture
+    if _capture is not None:
+        _capture.close()
+        _capture = None
+
+
+def active():
+    """ Returns the capture in progress, if any
+    """
+    return _capture
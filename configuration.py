@@ -6,8 +6,8 @@
 import random
 import socket
 from collections import namedtuple
-from copy import deepcopy
 from ipaddress import ip_address, ip_network
+from math import inf
 
 import xfrm
 from message import PayloadID, Proposal, TrafficSelector, Transform
@@ -51,6 +51,11 @@ _dh_name_to_transform = {
     '18': Transform(Transform.Type.DH, Transform.DhId.DH_18),
 }
 
+_esn_name_to_transform = {
+    'esn': Transform(Transform.Type.ESN, Transform.EsnId.ESN),
+    'noesn': Transform(Transform.Type.ESN, Transform.EsnId.NO_ESN),
+}
+
 _ip_proto_name_to_enum = {
     'tcp': TrafficSelector.IpProtocol.TCP,
     'any': TrafficSelector.IpProtocol.ANY,
@@ -69,38 +74,205 @@ _ipsec_proto_name_to_enum = {
 }
 
 IkeConfiguration = namedtuple('IkeConfiguration',
-                              ['psk', 'lifetime', 'dpd', 'id', 'peer_id', 'encr', 'integ', 'prf', 'dh', 'protect'],
-                              defaults=(None,)*10)
+                              ['psk', 'lifetime', 'dpd', 'id', 'peer_id', 'encr', 'integ', 'prf', 'dh', 'protect',
+                               'window_size', 'resumption', 'redirect', 'auto_start'],
+                              defaults=(None,)*14)
 IpsecConfiguration = namedtuple('IpsecConfiguration',
                                 ['my_subnet', 'index', 'peer_subnet', 'my_port', 'lifetime', 'peer_port', 'ip_proto',
-                                 'mode', 'ipsec_proto', 'encr', 'integ'],
-                                defaults=(None,)*11)
+                                 'mode', 'ipsec_proto', 'encr', 'integ', 'if_id', 'mark', 'esn', 'replay_window',
+                                 'per_cpu_sas', 'lifetime_bytes', 'lifetime_packets', 'idle_timeout'],
+                                defaults=(None,)*19)
+
+# maximum replay window supported by the kernel (XFRMA_REPLAY_ESN_MAX)
+MAX_REPLAY_WINDOW = 4096
+
+
+class PrefixTrie(object):
+    """ Binary trie for longest-prefix matching of IP addresses against networks. Lookups take
+        O(prefix length), regardless of the number of networks
+    """
+
+    def __init__(self):
+        # nodes are [child for bit 0, child for bit 1, value] lists, with a root per IP version
+        self._roots = {4: [None, None, None], 6: [None, None, None]}
+
+    def insert(self, network, value):
+        node = self._roots[network.version]
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (address >> (network.max_prefixlen - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    def lookup(self, addr):
+        """ Returns the value of the longest network containing addr, or None
+        """
+        node = self._roots[addr.version]
+        address = int(addr)
+        result = node[2]
+        for i in range(addr.max_prefixlen):
+            node = node[(address >> (addr.max_prefixlen - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                result = node[2]
+        return result
+
+
+_ProtectEntry = namedtuple('_ProtectEntry', ['position', 'ipsec_conf', 'conf_tsi', 'conf_tsr'])
+
+
+class ProtectIndex(object):
+    """ Index of the "protect" configurations of a peer by their local subnet, which finds the configuration
+        matching a pair of proposed traffic selectors without comparing them with every configuration.
+        Local subnets are stored in a binary trie: those containing the proposed range lie on the path to its
+        smallest covering prefix, and those it may contain lie in the subtree below it. As with a linear
+        search, the first matching configuration in "protect" order wins.
+    """
+
+    def __init__(self, protect):
+        # nodes are [child for bit 0, child for bit 1, entries, lowest position in the subtree] lists
+        self._roots = {4: [None, None, [], inf], 6: [None, None, [], inf]}
+        for position, ipsec_conf in enumerate(protect):
+            conf_tsi = TrafficSelector.from_network(ipsec_conf.my_subnet, ipsec_conf.my_port, ipsec_conf.ip_proto)
+            conf_tsr = TrafficSelector.from_network(ipsec_conf.peer_subnet, ipsec_conf.peer_port, ipsec_conf.ip_proto)
+            entry = _ProtectEntry(position, ipsec_conf, conf_tsi, conf_tsr)
+            network = ipsec_conf.my_subnet
+            address = int(network.network_address)
+            node = self._roots[network.version]
+            node[3] = min(node[3], position)
+            for i in range(network.prefixlen):
+                bit = (address >> (network.max_prefixlen - 1 - i)) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, [], position]
+                node = node[bit]
+            node[2].append(entry)
+
+    @staticmethod
+    def _match(entry, tsi, tsr):
+        # look for a larger policy
+        if tsi.is_subset(entry.conf_tsi) and tsr.is_subset(entry.conf_tsr):
+            return entry.position, entry, True
+        # look for a smaller policy
+        if entry.conf_tsi.is_subset(tsi) and entry.conf_tsr.is_subset(tsr):
+            return entry.position, entry, False
+        return None
+
+    def _first_match(self, entries, tsi, tsr, best):
+        # entries are sorted by position, so the first match of the node is the best one
+        for entry in entries:
+            if best is not None and entry.position >= best[0]:
+                break
+            match = self._match(entry, tsi, tsr)
+            if match is not None:
+                return match
+        return best
+
+    def lookup(self, tsi, tsr):
+        """ Returns the first configuration that is larger or smaller than the proposed pair of
+            TrafficSelector, along with the chosen selectors, or None
+        """
+        width = tsi.max_prefixlen
+        start, prefixlen = tsi.get_prefix()
+        best = None
+        node = self._roots[tsi.version]
+        for i in range(prefixlen):
+            best = self._first_match(node[2], tsi, tsr, best)
+            node = node[(start >> (width - 1 - i)) & 1]
+            if node is None:
+                break
+        else:
+            # node is the smallest prefix covering tsi
+            pending = [node]
+            while pending:
+                node = pending.pop()
+                if node is None or (best is not None and node[3] >= best[0]):
+                    continue
+                best = self._first_match(node[2], tsi, tsr, best)
+                pending += node[:2]
+        if best is None:
+            return None
+        _, entry, larger = best
+        if larger:
+            return entry.ipsec_conf, tsi, tsr
+        return entry.ipsec_conf, entry.conf_tsi, entry.conf_tsr
+
+
+def _invalidating(method):
+    def wrapper(self, *args, **kwargs):
+        self._ts_index = None
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ProtectList(list):
+    """ List of the "protect" configurations of a peer. Its ProtectIndex is built on first use, and built
+        again after the list is modified
+    """
+    _ts_index = None
+
+    @property
+    def ts_index(self):
+        if self._ts_index is None:
+            self._ts_index = ProtectIndex(self)
+        return self._ts_index
+
+    __setitem__ = _invalidating(list.__setitem__)
+    __delitem__ = _invalidating(list.__delitem__)
+    __iadd__ = _invalidating(list.__iadd__)
+    append = _invalidating(list.append)
+    extend = _invalidating(list.extend)
+    insert = _invalidating(list.insert)
+    pop = _invalidating(list.pop)
+    remove = _invalidating(list.remove)
+    clear = _invalidating(list.clear)
+    sort = _invalidating(list.sort)
+    reverse = _invalidating(list.reverse)
 
 
 class Configuration(object):
     """ Represents the daemon configuration.
+        Peers are indicated by IP address, host name or network (e.g. 10.0.0.0/24, for road-warriors). The
+        exact peers are looked up in a dict, and the networks in a PrefixTrie (longest prefix wins).
     """
 
     def __init__(self, my_addr, conf_dict):
         """ Creates a new Configuration object from a textual dict (e.g. coming from JSON or YAML)
         """
         self._configuration = {}
+        self._networks = PrefixTrie()
         for key, value in conf_dict.items():
             try:
                 self.my_addr = self._load_ip_address(my_addr)
+                if '/' in str(key):
+                    network = ip_network(key)
+                    self._networks.insert(network, self._load_ike_conf(network, value))
+                    continue
                 ip = ip_address(socket.gethostbyname(key))
             except (ValueError, socket.gaierror) as ex:
                 raise ConfigurationError(str(ex))
             self._configuration[ip] = self._load_ike_conf(ip, value)
 
     def items(self):
+        """ Returns the (address, IkeConfiguration) tuples of the exact peers (i.e. not the networks)
+        """
         return self._configuration.items()
 
+    def has_peer(self, addr):
+        """ Returns whether addr is configured as an exact peer (i.e. not only matched by a network)
+        """
+        return ip_address(addr) in self._configuration
+
     def _load_ike_conf(self, peer_ip, conf_dict):
         default_id = 'https://github.com/alejandro-perez/pyikev2'
-        ipsec_confs = []
+        ipsec_confs = ProtectList()
         for ipsec_conf in conf_dict.get('protect', [{}]):
             ipsec_confs.append(self._load_ipsec_conf(peer_ip, ipsec_conf))
+        window_size = int(conf_dict.get('window_size', 1))
+        if window_size < 1:
+            raise ConfigurationError('window_size should be greater than 0')
 
         return IkeConfiguration(
             psk=conf_dict.get('psk', 'whatever').encode(),
@@ -112,7 +284,11 @@ class Configuration(object):
             integ=self._load_crypto_algs('integ', conf_dict.get('integ', ['sha256']), _integ_name_to_transform),
             prf=self._load_crypto_algs('prf', conf_dict.get('prf', ['sha256']), _prf_name_to_transform),
             dh=self._load_crypto_algs('dh', conf_dict.get('dh', ['14']), _dh_name_to_transform),
-            protect=ipsec_confs
+            protect=ipsec_confs,
+            window_size=window_size,
+            resumption=bool(conf_dict.get('resumption', False)),
+            redirect=[self._load_ip_address(x) for x in conf_dict.get('redirect', [])],
+            auto_start=bool(conf_dict.get('auto_start', False)),
         )
 
     @staticmethod
@@ -130,27 +306,53 @@ class Configuration(object):
             raise ConfigurationError(str(ex))
 
     def _load_ipsec_conf(self, peer_ip, conf_dict):
+        if_id = int(conf_dict.get('if_id', 0))
+        mark = int(conf_dict.get('mark', 0))
+        # route-based tunnels protect whatever the routing table sends to the XFRM interface (or marks)
+        route_based = bool(if_id or mark)
+        replay_window = int(conf_dict.get('replay_window', 32))
+        if not 0 <= replay_window <= MAX_REPLAY_WINDOW:
+            raise ConfigurationError('replay_window should be between 0 and {}'.format(MAX_REPLAY_WINDOW))
+        # NO_ESN is always accepted as the last option, so peers configured without ESN can still negotiate
+        esn = self._load_crypto_algs('esn', conf_dict.get('esn', []), _esn_name_to_transform)
+        if _esn_name_to_transform['noesn'] not in esn:
+            esn.append(_esn_name_to_transform['noesn'])
+        # the kernel rejects inbound ESN SAs without a replay window
+        if replay_window == 0 and _esn_name_to_transform['esn'] in esn:
+            raise ConfigurationError('esn requires a replay_window greater than 0')
+        # the peers of a network share its peer_subnet and index, which are only used to match their traffic
+        # selectors. Their policies are created per peer (see Xfrm.create_policies)
         return IpsecConfiguration(
-            my_subnet=self._load_ip_network(conf_dict.get('my_subnet', self.my_addr)),
+            my_subnet=self._load_ip_network(conf_dict.get('my_subnet', '0.0.0.0/0' if route_based else self.my_addr)),
             index=int(conf_dict.get('index', random.randint(0, 2**20))),
-            peer_subnet=self._load_ip_network(conf_dict.get('peer_subnet', peer_ip)),
+            peer_subnet=self._load_ip_network(conf_dict.get('peer_subnet', '0.0.0.0/0' if route_based else peer_ip)),
             my_port=int(conf_dict.get('my_port', 0)),
             lifetime=int(conf_dict.get('lifetime', 5 * 60)),
             peer_port=int(conf_dict.get('peer_port', 0)),
             ip_proto=self._load_from_dict(conf_dict.get('ip_proto', 'any'), _ip_proto_name_to_enum),
-            mode=self._load_from_dict(conf_dict.get('mode', 'transport'), _mode_name_to_enum),
+            mode=self._load_from_dict(conf_dict.get('mode', 'tunnel' if route_based else 'transport'),
+                                      _mode_name_to_enum),
             ipsec_proto=self._load_from_dict(conf_dict.get('ipsec_proto', 'esp'), _ipsec_proto_name_to_enum),
             encr=self._load_crypto_algs('encr', conf_dict.get('encr', ['aes256']), _encr_name_to_transform),
             integ=self._load_crypto_algs('integ', conf_dict.get('integ', ['sha256']), _integ_name_to_transform),
+            if_id=if_id,
+            mark=mark,
+            esn=esn,
+            replay_window=replay_window,
+            per_cpu_sas=bool(conf_dict.get('per_cpu_sas', False)),
+            lifetime_bytes=int(conf_dict.get('lifetime_bytes', 0)),
+            lifetime_packets=int(conf_dict.get('lifetime_packets', 0)),
+            idle_timeout=int(conf_dict.get('idle_timeout', 0)),
         )
 
     def get_ike_configuration(self, addr):
         addr = ip_address(addr)
-        try:
-            found = next(key for key in self._configuration if addr == key)
-        except StopIteration:
+        ike_conf = self._configuration.get(addr)
+        if ike_conf is None:
+            ike_conf = self._networks.lookup(addr)
+        if ike_conf is None:
             raise ConfigurationNotFound
-        return self._configuration[found]
+        return ike_conf
 
     @staticmethod
     def _load_from_dict(key, cnf_dict):
@@ -164,6 +366,6 @@ class Configuration(object):
         if type(names) is not list:
             raise ConfigurationError('{} should be a list.'.format(key))
         for x in names:
-            transform = self._load_from_dict(str(x), deepcopy(name_to_transform))
+            transform = self._load_from_dict(str(x), name_to_transform)
             transforms.append(transform)
         return transforms
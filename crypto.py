@@ -6,8 +6,9 @@
 
 import hashlib
 import os
+import time
 from collections import namedtuple
-from hmac import HMAC
+from hmac import HMAC, compare_digest
 
 import cryptography.hazmat.backends.openssl.backend
 from cryptography.hazmat.primitives.asymmetric import dh
@@ -300,3 +301,42 @@ class Crypto:
         self.sk_a = sk_a
         self.prf = prf
         self.sk_p = sk_p
+
+
+class CookieGenerator:
+    """ Generates and verifies stateless COOKIEs (RFC 7296 section 2.6) as
+        <VersionIDofSecret> | Hash(Ni | IPi | SPIi | <secret>).
+        The secret is rotated every SECRET_LIFETIME seconds, and cookies generated with the previous one
+        are still accepted so initiators in the middle of an exchange are not rejected.
+    """
+    SECRET_LIFETIME = 300
+
+    def __init__(self):
+        self.version = 0
+        self.secrets = {self.version: os.urandom(32)}
+        self.rotate_at = time.time() + self.SECRET_LIFETIME
+
+    def _rotate_secret(self):
+        if self.rotate_at < time.time():
+            previous_version = self.version
+            self.version = (self.version + 1) % 256
+            self.secrets = {previous_version: self.secrets[previous_version], self.version: os.urandom(32)}
+            self.rotate_at = time.time() + self.SECRET_LIFETIME
+
+    @staticmethod
+    def _compute(version, secret, nonce, addr, spi_i):
+        return bytes([version]) + hashlib.sha256(nonce + addr + spi_i + secret).digest()
+
+    def generate(self, nonce, addr, spi_i):
+        """ Generates a COOKIE for the nonce, initiator address (bytes) and initiator SPI
+        """
+        self._rotate_secret()
+        return self._compute(self.version, self.secrets[self.version], nonce, addr, spi_i)
+
+    def verify(self, cookie, nonce, addr, spi_i):
+        """ Verifies a COOKIE sent by an initiator
+        """
+        self._rotate_secret()
+        if not cookie or cookie[0] not in self.secrets:
+            return False
+        return compare_digest(cookie, self._compute(cookie[0], self.secrets[cookie[0]], nonce, addr, spi_i))
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the active/standby state replication. The active member streams the lifecycle
+    events of its IKE_SAs to the standby one, which keeps a replica to take over them when the active
+    member stops sending (RFC 6027 style cluster, with RFC 6311 message ID synchronisation)
+"""
+import errno
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import stat
+import time
+from select import select
+from struct import error as struct_error, pack, unpack_from
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import snapshot
+from helpers import SafeIntEnum
+from snapshot import SnapshotError
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class HaEvent(SafeIntEnum):
+    # IKE_SA created, rekeyed or with a different set of CHILD_SAs (data is a serialised IkeSaSnapshot)
+    UPSERT = 1
+    # IKE_SA deleted (data is the SPI)
+    DELETE = 2
+    # message IDs advanced (data is SPI | next request message ID | next expected request message ID)
+    MSG_ID = 3
+    # outbound IPsec SA sequence number (data is SPI | number of packets sent)
+    OSEQ = 4
+
+
+# size of the nonces exchanged when connecting, and of the proof of the standby member
+NONCE_SIZE = 16
+PROOF_SIZE = 32
+
+
+def _family(addr):
+    if isinstance(addr, str):
+        return socket.AF_UNIX
+    return socket.AF_INET6 if ':' in addr[0] else socket.AF_INET
+
+
+def _standby_proof(key, active_nonce, standby_nonce):
+    return hmac.new(key, b'pyikev2 HA standby' + active_nonce + standby_nonce, hashlib.sha256).digest()
+
+
+def _session_cipher(key, active_nonce, standby_nonce):
+    """ Returns the AES-GCM cipher protecting the batches of a connection. Its key is derived from the
+        nonces, so the batch sequence numbers (used as GCM nonces) are never reused with the same key
+    """
+    return AESGCM(hmac.new(key, b'pyikev2 HA batch' + active_nonce + standby_nonce, hashlib.sha256).digest())
+
+
+def _batch_nonce(sequence_number):
+    return pack('>4xQ', sequence_number)
+
+
+def _frame(cipher, sequence_number, events):
+    """ Builds a batch of events: Length | AES-GCM((Type | Length | Data)*)
+    """
+    data = bytearray()
+    for event_type, event_data in events:
+        data += pack('>BL', event_type, len(event_data)) + event_data
+    data = cipher.encrypt(_batch_nonce(sequence_number), bytes(data), None)
+    return pack('>L', len(data)) + data
+
+
+class HaSender:
+    """ Streams batches of events to the standby member without ever blocking: the connection is established
+        over the following calls, and the data not fitting in the socket buffer is kept for the next ones.
+        On connection, the standby member proves it knows the pre-shared key, and the batches are encrypted
+        and authenticated with a key derived from it.
+        The whole state is sent again every time the connection is (re)established, and empty batches are sent
+        as heartbeats when there is nothing else
+    """
+    BATCH_SIZE = 256
+    HEARTBEAT_INTERVAL = 1
+    RECONNECT_INTERVAL = 5
+    # Seconds to connect and authenticate the standby member, and bytes pending to be sent before giving up
+    CONNECT_TIMEOUT = 5
+    MAX_PENDING = 16 * 1024 * 1024
+
+    def __init__(self, addr, key, get_full_state):
+        self.addr = addr
+        self.key = key
+        self.get_full_state = get_full_state
+        self.sock = None
+        self.nonce = None
+        self.handshake = bytearray()
+        self.connect_deadline = 0
+        self.cipher = None
+        self.sequence_number = 0
+        self.pending = bytearray()
+        self.events = []
+        self.heartbeat_at = 0
+        self.reconnect_at = 0
+
+    @property
+    def connected(self):
+        return self.cipher is not None
+
+    def _connect(self):
+        self.sock = socket.socket(_family(self.addr), socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        error = self.sock.connect_ex(self.addr)
+        if error not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            raise OSError(error, os.strerror(error))
+        self.nonce = os.urandom(NONCE_SIZE)
+        self.pending = bytearray(self.nonce)
+        self.handshake.clear()
+        self.connect_deadline = time.time() + self.CONNECT_TIMEOUT
+
+    def _authenticate(self):
+        if self.connect_deadline < time.time():
+            raise TimeoutError('Timed out')
+        self._send_pending()
+        try:
+            data = self.sock.recv(NONCE_SIZE + PROOF_SIZE - len(self.handshake))
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionResetError('Connection closed')
+        self.handshake += data
+        if len(self.handshake) < NONCE_SIZE + PROOF_SIZE:
+            return
+        standby_nonce, proof = bytes(self.handshake[:NONCE_SIZE]), bytes(self.handshake[NONCE_SIZE:])
+        if not hmac.compare_digest(proof, _standby_proof(self.key, self.nonce, standby_nonce)):
+            raise ConnectionRefusedError('The standby member does not know the key')
+        self.cipher = _session_cipher(self.key, self.nonce, standby_nonce)
+        self.sequence_number = 0
+        logging.info('Connected to HA standby at {}'.format(self.addr))
+        # the events queued so far are applied on top of the full state (which UPSERTs are idempotent with)
+        self.events = list(self.get_full_state()) + self.events
+
+    def _send_pending(self):
+        if self.pending:
+            try:
+                del self.pending[:self.sock.send(self.pending)]
+            except BlockingIOError:
+                pass
+
+    def send(self, event_type, data):
+        """ Queues an event, flushing the batch if it is full
+        """
+        self.events.append((event_type, data))
+        if len(self.events) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Sends the queued events (or a heartbeat if due), as far as the socket buffer allows
+        """
+        try:
+            if self.sock is None and self.reconnect_at <= time.time():
+                self._connect()
+            if self.sock is not None and not self.connected:
+                self._authenticate()
+        except OSError as ex:
+            logging.debug('Could not connect to HA standby at {}: {}'.format(self.addr, ex))
+            self._reset()
+        if not self.connected:
+            # the standby will get the whole state once connected
+            self.events.clear()
+            return
+        if self.events or self.heartbeat_at <= time.time():
+            for index in range(0, max(len(self.events), 1), self.BATCH_SIZE):
+                self.pending += _frame(self.cipher, self.sequence_number, self.events[index:index + self.BATCH_SIZE])
+                self.sequence_number += 1
+            self.heartbeat_at = time.time() + self.HEARTBEAT_INTERVAL
+        self.events.clear()
+        try:
+            self._send_pending()
+            if len(self.pending) > self.MAX_PENDING:
+                raise BufferError('Too much data pending to be sent')
+        except (OSError, BufferError) as ex:
+            logging.warning('Lost connection with HA standby at {}: {}'.format(self.addr, ex))
+            self._reset()
+
+    def _reset(self):
+        self.close()
+        self.reconnect_at = time.time() + self.RECONNECT_INTERVAL
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.cipher = None
+        self.pending.clear()
+
+
+class HaReceiver:
+    """ Receives the events from the active member and keeps the replica of its IKE_SAs. A new connection
+        only replaces the current one once its first batch is authenticated, so those not knowing the
+        pre-shared key can neither feed events nor prevent the take over
+    """
+    # Seconds without receiving anything from the active member before considering it dead
+    TIMEOUT = 3
+    MAX_CONNECTIONS = 4
+    MAX_BATCH_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, addr, key):
+        self.key = key
+        self.path = None
+        if isinstance(addr, str):
+            # only stale sockets (e.g. from a previous run) are replaced, never other files
+            try:
+                if not stat.S_ISSOCK(os.stat(addr).st_mode):
+                    raise FileExistsError('{} exists and is not a socket'.format(addr))
+                os.remove(addr)
+            except FileNotFoundError:
+                pass
+            self.path = addr
+        self.listen_sock = socket.socket(_family(addr), socket.SOCK_STREAM)
+        if self.path is None:
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_sock.bind(addr)
+        if self.path is not None:
+            os.chmod(self.path, 0o600)
+        self.listen_sock.listen(self.MAX_CONNECTIONS)
+        # connections, mapped to [received data, cipher (once the nonces are exchanged), next sequence number]
+        self.connections = {}
+        # authenticated connection with the active member
+        self.sock = None
+        self.last_seen = time.time()
+        # replicated IKE_SAs, indexed by SPI
+        self.ike_sas = {}
+        # number of packets sent by the outbound IPsec SAs, indexed by SPI
+        self.oseqs = {}
+
+    def get_sockets(self):
+        return [self.listen_sock] + list(self.connections)
+
+    def is_active_lost(self):
+        return self.last_seen + self.TIMEOUT < time.time()
+
+    def receive(self, timeout=0):
+        """ Reads and applies all the available events, waiting up to timeout seconds for the first ones
+        """
+        while True:
+            readable = select(self.get_sockets(), [], [], timeout)[0]
+            if not readable:
+                return
+            timeout = 0
+            if self.listen_sock in readable:
+                self._accept()
+            for sock in [x for x in readable if x in self.connections]:
+                try:
+                    data = sock.recv(65536)
+                    if not data:
+                        raise ConnectionResetError('Connection closed')
+                    self.connections[sock][0] += data
+                    self._process_buffer(sock)
+                except (OSError, InvalidTag, ValueError) as ex:
+                    reason = str(ex) or 'Invalid batch'
+                    if sock is self.sock:
+                        logging.warning('HA active member disconnected: {}'.format(reason))
+                    else:
+                        logging.debug('HA connection closed before being authenticated: {}'.format(reason))
+                    self._disconnect(sock)
+
+    def _accept(self):
+        sock, addr = self.listen_sock.accept()
+        # the oldest unauthenticated connection makes room for the new one
+        if len(self.connections) >= self.MAX_CONNECTIONS:
+            self._disconnect(next(x for x in self.connections if x is not self.sock))
+        self.connections[sock] = [bytearray(), None, 0]
+        logging.debug('HA connection from {}'.format(addr))
+
+    def _disconnect(self, sock):
+        sock.close()
+        del self.connections[sock]
+        if sock is self.sock:
+            self.sock = None
+
+    def _process_buffer(self, sock):
+        connection = self.connections[sock]
+        buffer = connection[0]
+        if connection[1] is None:
+            if len(buffer) < NONCE_SIZE:
+                return
+            active_nonce = bytes(buffer[:NONCE_SIZE])
+            del buffer[:NONCE_SIZE]
+            nonce = os.urandom(NONCE_SIZE)
+            sock.sendall(nonce + _standby_proof(self.key, active_nonce, nonce))
+            connection[1] = _session_cipher(self.key, active_nonce, nonce)
+        while len(buffer) >= 4:
+            length = unpack_from('>L', buffer)[0]
+            if length > self.MAX_BATCH_SIZE:
+                raise ValueError('Batch too large')
+            if len(buffer) < 4 + length:
+                return
+            batch = connection[1].decrypt(_batch_nonce(connection[2]), bytes(buffer[4:4 + length]), None)
+            connection[2] += 1
+            del buffer[:4 + length]
+            if sock is not self.sock:
+                if self.sock is not None:
+                    self._disconnect(self.sock)
+                self.sock = sock
+                logging.info('HA active member connected')
+            self.last_seen = time.time()
+            offset = 0
+            while offset < len(batch):
+                event_type, event_length = unpack_from('>BL', batch, offset)
+                offset += 5
+                self.apply(event_type, batch[offset:offset + event_length])
+                offset += event_length
+
+    def apply(self, event_type, data):
+        """ Applies an event to the replica
+        """
+        try:
+            if event_type == HaEvent.UPSERT:
+                ike_sa = snapshot.ike_sa_from_bytes(data)
+                self.ike_sas[ike_sa.my_spi] = ike_sa
+            elif event_type == HaEvent.DELETE:
+                self.ike_sas.pop(data, None)
+            elif event_type == HaEvent.MSG_ID:
+                spi, my_msg_id, peer_msg_id = unpack_from('>8sLL', data)
+                if spi in self.ike_sas:
+                    self.ike_sas[spi] = self.ike_sas[spi]._replace(my_msg_id=my_msg_id, peer_msg_id=peer_msg_id)
+            elif event_type == HaEvent.OSEQ:
+                spi, packets = unpack_from('>4sQ', data)
+                self.oseqs[spi] = packets
+            else:
+                logging.warning('Unknown HA event type {}'.format(event_type))
+        except (SnapshotError, struct_error) as ex:
+            logging.error('Invalid HA event {}: {}'.format(HaEvent.safe_name(event_type), ex))
+            return
+        logging.debug('Applied HA event {} ({} bytes)'.format(HaEvent.safe_name(event_type), len(data)))
+
+    def close(self):
+        for sock in self.get_sockets():
+            sock.close()
+        self.connections.clear()
+        self.sock = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def msg_id_event(ike_sa):
+    return HaEvent.MSG_ID, pack('>8sLL', ike_sa.my_spi, ike_sa.my_msg_id, ike_sa.peer_msg_id)
+
+
+def oseq_event(spi, packets):
+    return HaEvent.OSEQ, pack('>4sQ', spi, packets)
+
+
+def upsert_event(ike_sa_snapshot):
+    return HaEvent.UPSERT, snapshot.ike_sa_to_bytes(ike_sa_snapshot)
+
+
+def delete_event(spi):
+    return HaEvent.DELETE, spi
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the logging pipeline. Records are put in a bounded queue by the event loop and
+    written by a separate thread, so a slow terminal, journald or disk never stalls the IKE processing
+"""
+import copy
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class BoundedQueueHandler(QueueHandler):
+    """ Puts the records in a bounded queue without ever blocking. Records that do not fit are dropped and
+        counted, and a warning with the number of dropped records is queued as soon as there is room again
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        # records dropped since the last warning, and since the start
+        self.dropped = 0
+        self.dropped_total = 0
+
+    def prepare(self, record):
+        # unlike QueueHandler.prepare(), leave the formatting (e.g. the timestamp) to the listener thread.
+        # Only the arguments are merged, as they might change before the record is written
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                warning = logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING,
+                                                 'levelname': 'WARNING', 'created': record.created,
+                                                 'msecs': record.msecs,
+                                                 'msg': 'Dropped {} log records. The log queue was full'
+                                                        ''.format(self.dropped)})
+                self.queue.put_nowait(warning)
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.dropped_total += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """ Lets through at most BURST records with the same level and message template (e.g. 'Received
+        message for unknown SPI=%s') every INTERVAL seconds. Only records of MIN_LEVEL or above are limited,
+        as those are the ones a misbehaving peer can trigger repeatedly. The first record let through after
+        a suppression indicates how many were suppressed
+    """
+    INTERVAL = 10
+    BURST = 5
+    MIN_LEVEL = logging.WARNING
+    # number of templates tracked before forgetting the expired ones
+    MAX_TEMPLATES = 1024
+
+    def __init__(self):
+        super().__init__()
+        # [window start time, number of records in the window], indexed by (level, template)
+        self.windows = {}
+        self.suppressed_total = 0
+
+    def filter(self, record):
+        if record.levelno < self.MIN_LEVEL:
+            return True
+        key = (record.levelno, str(record.msg))
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= self.INTERVAL:
+            if window is not None and window[1] > self.BURST:
+                record.msg = '{} ({} similar messages suppressed)'.format(record.msg, window[1] - self.BURST)
+            elif window is None and len(self.windows) >= self.MAX_TEMPLATES:
+                self.windows = {k: v for k, v in self.windows.items() if record.created - v[0] < self.INTERVAL}
+            self.windows[key] = [record.created, 1]
+            return True
+        window[1] += 1
+        if window[1] > self.BURST:
+            self.suppressed_total += 1
+            return False
+        return True
+
+
+def setup(level, fmt, datefmt=None, queue_size=10000, rate_limit=False):
+    """ Configures the root logger to write to stderr through a BoundedQueueHandler. Returns the started
+        QueueListener, which has to be stopped on exit to flush the pending records
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(fmt, datefmt))
+    queue_handler = BoundedQueueHandler(queue_size)
+    if rate_limit:
+        queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    listener = QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    return listener
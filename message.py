@@ -7,7 +7,9 @@ import logging
 import os
 
 from collections import OrderedDict
-from ipaddress import ip_address, ip_network
+from copy import copy
+from functools import lru_cache
+from ipaddress import IPv4Network, IPv6Network, ip_address, ip_network
 from random import SystemRandom
 from struct import error as struct_error, pack, pack_into, unpack_from
 
@@ -54,6 +56,10 @@ class TsUnacceptable(IkeSaError):
     pass
 
 
+class TsMaxQueue(IkeSaError):
+    pass
+
+
 class ChildSaNotFound(IkeSaError):
     def __init__(self, msg, spi, protocol):
         super().__init__(msg)
@@ -183,10 +189,20 @@ class Transform:
         Type.ESN: EsnId
     }
 
+    # transforms are immutable, so the ones of the configuration can be shared by every negotiation
+    __slots__ = ('type', 'id', 'keylen', '_hash')
+
     def __init__(self, type, id, keylen=None):
-        self.type = type
-        self.id = id
-        self.keylen = keylen
+        object.__setattr__(self, 'type', type)
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'keylen', keylen)
+        object.__setattr__(self, '_hash', hash((type, id, keylen)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Transform objects are immutable')
+
+    def __reduce__(self):
+        return Transform, (self.type, self.id, self.keylen)
 
     @classmethod
     def parse(cls, data):
@@ -222,10 +238,13 @@ class Transform:
         return result
 
     def __hash__(self):
-        return hash((self.type, self.id, self.keylen),)
+        return self._hash
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        if not isinstance(other, Transform):
+            return NotImplemented
+        return (self is other or (self._hash == other._hash
+                                  and (self.type, self.id, self.keylen) == (other.type, other.id, other.keylen)))
 
 
 class Proposal:
@@ -307,16 +326,7 @@ class Proposal:
             It contains one Transform per type (e.g. ENCR, AUTH, DH...)
             The Proposal num and SPI values are taken from "other"
         """
-        if self.protocol_id == other.protocol_id:
-            selected = {}
-            for my_transform in self.transforms:
-                for peer_transform in other.transforms:
-                    if my_transform == peer_transform and my_transform.type not in selected:
-                        selected[my_transform.type] = my_transform
-            # If we have a transform of each type => success
-            if set(selected) == set(x.type for x in self.transforms):
-                return Proposal(other.num, self.protocol_id, other.spi, list(selected.values()))
-        return None
+        return ProposalTable.get(self.protocol_id, tuple(self.transforms)).negotiate(other)
 
     def __eq__(self, other):
         return ((self.num, self.protocol_id, self.spi, set(self.transforms))
@@ -327,6 +337,63 @@ class Proposal:
         return (intersection is not None) and (intersection == self)
 
 
+class ProposalTable:
+    """ Our own proposal, precompiled for negotiation: the frozen set of acceptable transforms of each
+        type, and the preference of each transform. Negotiating a peer proposal takes one lookup per
+        peer transform plus one check per type, instead of comparing every pair of transforms.
+        Tables are cached by their transforms, so each configuration compiles its proposal only once.
+    """
+    __slots__ = ('protocol_id', 'transforms', 'by_type', '_preference')
+
+    def __init__(self, protocol_id, transforms):
+        self.protocol_id = protocol_id
+        self.transforms = transforms
+        by_type = {}
+        for transform in transforms:
+            by_type.setdefault(transform.type, []).append(transform)
+        self.by_type = {type: frozenset(type_transforms) for type, type_transforms in by_type.items()}
+        # the first occurrence is the one that counts
+        self._preference = {}
+        for preference, transform in enumerate(transforms):
+            self._preference.setdefault(transform, preference)
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def get(cls, protocol_id, transforms):
+        """ Returns the (shared) table for the indicated protocol and tuple of transforms
+        """
+        return cls(protocol_id, transforms)
+
+    def to_proposal(self, spi=b''):
+        return Proposal(1, self.protocol_id, spi, list(self.transforms))
+
+    def negotiate(self, other):
+        """ Returns the intersection of this table and the other Proposal, as Proposal.intersection() does,
+            or None if there is none
+        """
+        if self.protocol_id != other.protocol_id:
+            return None
+        # preference of the best transform of each type offered by the peer
+        selected = {}
+        for transform in other.transforms:
+            preference = self._preference.get(transform)
+            if preference is None:
+                continue
+            current = selected.get(transform.type)
+            if current is None or preference < current:
+                selected[transform.type] = preference
+        # proposals without ESN transforms (e.g. from older implementations) mean no ESN
+        if (Transform.Type.ESN in self.by_type and Transform.Type.ESN not in selected
+                and not any(x.type == Transform.Type.ESN for x in other.transforms)):
+            preference = self._preference.get(Transform(Transform.Type.ESN, Transform.EsnId.NO_ESN))
+            if preference is not None:
+                selected[Transform.Type.ESN] = preference
+        # we need a transform of each type
+        if len(selected) != len(self.by_type):
+            return None
+        return Proposal(other.num, self.protocol_id, other.spi, [self.transforms[x] for x in sorted(selected.values())])
+
+
 class PayloadSA(Payload):
     type = Payload.Type.SA
 
@@ -343,7 +410,7 @@ class PayloadSA(Payload):
         if len(data):
             offset = 0
             while offset < len(data):
-                more, _, length = unpack_from('>BBH', data)
+                more, _, length = unpack_from('>BBH', data, offset)
                 start = offset + 4
                 end = offset + length
                 proposal = Proposal.parse(data[start:end])
@@ -437,6 +504,7 @@ class PayloadNOTIFY(Payload):
         INVALID_SELECTORS = 39
         TEMPORARY_FAILURE = 43
         CHILD_SA_NOT_FOUND = 44
+        TS_MAX_QUEUE = 48
         INITIAL_CONTACT = 16384
         SET_WINDOW_SIZE = 16385
         ADDITIONAL_TS_POSSIBLE = 16386
@@ -449,6 +517,22 @@ class PayloadNOTIFY(Payload):
         REKEY_SA = 16393
         ESP_TFC_PADDING_NOT_SUPPORTED = 16394
         NON_FIRST_FRAGMENTS_ALSO = 16395
+        REDIRECT_SUPPORTED = 16406
+        REDIRECT = 16407
+        REDIRECTED_FROM = 16408
+        TICKET_LT_OPAQUE = 16409
+        TICKET_REQUEST = 16410
+        TICKET_ACK = 16411
+        TICKET_NACK = 16412
+        TICKET_OPAQUE = 16413
+        IKEV2_MESSAGE_ID_SYNC_SUPPORTED = 16420
+        IKEV2_MESSAGE_ID_SYNC = 16422
+        SA_RESOURCE_INFO = 16444
+
+    class GwIdentType(SafeIntEnum):
+        IPV4 = 1
+        IPV6 = 2
+        FQDN = 3
 
     def __init__(self, protocol_id, notification_type, spi, notification_data, critical=False):
         super(PayloadNOTIFY, self).__init__(critical)
@@ -467,7 +551,8 @@ class PayloadNOTIFY(Payload):
             TsUnacceptable: PayloadNOTIFY.Type.TS_UNACCEPTABLE,
             InvalidKePayload: PayloadNOTIFY.Type.INVALID_KE_PAYLOAD,
             ChildSaNotFound: PayloadNOTIFY.Type.CHILD_SA_NOT_FOUND,
-            TemporaryFailure: PayloadNOTIFY.Type.TEMPORARY_FAILURE
+            TemporaryFailure: PayloadNOTIFY.Type.TEMPORARY_FAILURE,
+            TsMaxQueue: PayloadNOTIFY.Type.TS_MAX_QUEUE,
         }
         notification_type = exception_2_notify.get(type(ex), PayloadNOTIFY.Type.INVALID_SYNTAX)
         notification_data = pack('>H', ex.group) if type(ex) is InvalidKePayload else b''
@@ -475,6 +560,30 @@ class PayloadNOTIFY(Payload):
         notification_spi = ex.spi if type(ex) is ChildSaNotFound else b''
         return PayloadNOTIFY(notification_protocol, notification_type, notification_spi, notification_data)
 
+    @staticmethod
+    def gw_identity_to_bytes(addr):
+        """ Encodes a gateway address as used by the REDIRECT and REDIRECTED_FROM notifications (RFC 5685)
+        """
+        gw_ident_type = PayloadNOTIFY.GwIdentType.IPV4 if addr.version == 4 else PayloadNOTIFY.GwIdentType.IPV6
+        return pack('>BB', gw_ident_type, len(addr.packed)) + addr.packed
+
+    @staticmethod
+    def parse_gw_identity(data):
+        """ Parses a gateway identity, returning the (address, remaining data) tuple
+        """
+        try:
+            gw_ident_type, gw_ident_len = unpack_from('>BB', data)
+        except struct_error:
+            raise InvalidSyntax('Error parsing gateway identity.')
+        if gw_ident_type not in (PayloadNOTIFY.GwIdentType.IPV4, PayloadNOTIFY.GwIdentType.IPV6):
+            raise InvalidSyntax('Gateway identity type {} not supported.'
+                                ''.format(PayloadNOTIFY.GwIdentType.safe_name(gw_ident_type)))
+        try:
+            addr = ip_address(bytes(data[2:2 + gw_ident_len]))
+        except ValueError:
+            raise InvalidSyntax('Invalid gateway identity address.')
+        return addr, data[2 + gw_ident_len:]
+
     @classmethod
     def parse(cls, data, critical=False):
         try:
@@ -612,24 +721,56 @@ class TrafficSelector(object):
         ICMPv6 = 58
         MH = 135
 
+    # ts_type, ip_proto and ports are ints, as the addresses, so matching does not create any ipaddress object
+    __slots__ = ('ts_type', 'ip_proto', 'start_port', 'end_port', 'start', 'end')
+
     def __init__(self, ts_type, ip_proto, start_port, end_port, start_addr, end_addr):
+        """ Creates a new TrafficSelector. Addresses can be ipaddress objects or ints
+        """
         self.ts_type = ts_type
         self.ip_proto = ip_proto
         self.start_port = start_port
         self.end_port = end_port
-        self.start_addr = start_addr
-        self.end_addr = end_addr
+        self.start = int(start_addr)
+        self.end = int(end_addr)
 
     @classmethod
     def from_network(cls, subnet, port, ip_proto):
-        return TrafficSelector(TrafficSelector.Type.TS_IPV4_ADDR_RANGE, ip_proto, port,
-                               65535 if port == 0 else port, subnet[0], subnet[-1])
+        ts_type = (TrafficSelector.Type.TS_IPV4_ADDR_RANGE if subnet.version == 4
+                   else TrafficSelector.Type.TS_IPV6_ADDR_RANGE)
+        start = int(subnet.network_address)
+        return TrafficSelector(ts_type, ip_proto, port, 65535 if port == 0 else port, start,
+                               start | int(subnet.hostmask))
+
+    @classmethod
+    def from_address(cls, addr, port, ip_proto):
+        return cls.from_network(ip_network(addr), port, ip_proto)
+
+    @property
+    def version(self):
+        return 4 if self.ts_type == TrafficSelector.Type.TS_IPV4_ADDR_RANGE else 6
+
+    @property
+    def max_prefixlen(self):
+        return 32 if self.ts_type == TrafficSelector.Type.TS_IPV4_ADDR_RANGE else 128
+
+    @property
+    def start_addr(self):
+        return ip_address(self.start.to_bytes(self.max_prefixlen // 8, 'big'))
+
+    @property
+    def end_addr(self):
+        return ip_address(self.end.to_bytes(self.max_prefixlen // 8, 'big'))
+
+    def get_prefix(self):
+        """ Returns the (address, prefix length) tuple of the smallest network containing the selector
+        """
+        host_bits = (self.start ^ self.end).bit_length()
+        return self.start >> host_bits << host_bits, self.max_prefixlen - host_bits
 
     def get_network(self):
-        network = ip_network(self.start_addr)
-        while self.end_addr not in network:
-            network = network.supernet()
-        return network
+        network_class = IPv4Network if self.ts_type == TrafficSelector.Type.TS_IPV4_ADDR_RANGE else IPv6Network
+        return network_class(self.get_prefix())
 
     def get_port(self):
         if self.start_port == 0 and self.end_port == 65535:
@@ -645,13 +786,14 @@ class TrafficSelector(object):
             start_addr, end_addr = unpack_from('>{0}s{0}s'.format(addr_len), data, 8)
         except struct_error:
             raise InvalidSyntax('Error parsing Traffic selector.')
-        return TrafficSelector(ts_type, ip_proto, start_port, end_port, ip_address(start_addr), ip_address(end_addr))
+        return TrafficSelector(ts_type, ip_proto, start_port, end_port, int.from_bytes(start_addr, 'big'),
+                               int.from_bytes(end_addr, 'big'))
 
     def to_bytes(self):
         addr_len = (4 if self.ts_type == TrafficSelector.Type.TS_IPV4_ADDR_RANGE else 16)
         return pack('>BBHHH{0}s{0}s'.format(addr_len), self.ts_type, self.ip_proto,
-                    8 + addr_len * 2, self.start_port, self.end_port, self.start_addr.packed,
-                    self.end_addr.packed)
+                    8 + addr_len * 2, self.start_port, self.end_port, self.start.to_bytes(addr_len, 'big'),
+                    self.end.to_bytes(addr_len, 'big'))
 
     def to_dict(self):
         return OrderedDict([
@@ -661,25 +803,14 @@ class TrafficSelector(object):
             ('addr-range', '{} - {}'.format(self.start_addr, self.end_addr))])
 
     def is_subset(self, other):
-        if self.ts_type != other.ts_type:
-            return False
-
-        if other.ip_proto != TrafficSelector.IpProtocol.ANY and self.ip_proto != other.ip_proto:
-            return False
-
-        if self.start_port < other.start_port or self.end_port > other.end_port:
-            return False
-
-        if self.start_addr < other.start_addr or self.end_addr > other.end_addr:
-            return False
-
-        return True
+        return (self.ts_type == other.ts_type
+                and (other.ip_proto == TrafficSelector.IpProtocol.ANY or self.ip_proto == other.ip_proto)
+                and other.start_port <= self.start_port and self.end_port <= other.end_port
+                and other.start <= self.start and self.end <= other.end)
 
     def __eq__(self, other):
-        return ((self.ts_type, self.ip_proto, self.start_port, self.end_port, self.start_addr,
-                 self.end_addr)
-                == (other.ts_type, other.ip_proto, other.start_port, other.end_port,
-                    other.start_addr, other.end_addr))
+        return ((self.ts_type, self.ip_proto, self.start_port, self.end_port, self.start, self.end)
+                == (other.ts_type, other.ip_proto, other.start_port, other.end_port, other.start, other.end))
 
 
 class PayloadTS(Payload):
@@ -807,6 +938,7 @@ class Message:
         IKE_AUTH = 35
         CREATE_CHILD_SA = 36
         INFORMATIONAL = 37
+        IKE_SESSION_RESUME = 38
 
     type_2_payload = {
         Payload.Type.SA: PayloadSA,
@@ -978,6 +1110,16 @@ class Message:
 
         return data
 
+    def to_cleartext_bytes(self):
+        """ Returns the message as if it was sent unencrypted, with the encrypted payloads in place of the
+            Payload SK. Only meant for debugging (e.g. packet captures)
+        """
+        cleartext = copy(self)
+        cleartext.payloads = self.payloads + self.encrypted_payloads
+        cleartext.encrypted_payloads = []
+        cleartext.crypto = None
+        return cleartext.to_bytes()
+
     def to_dict(self):
         return OrderedDict([
             ('spi_i', hexstring(self.spi_i)),
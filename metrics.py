@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the metrics registry (counters, gauges and fixed-bucket histograms) and the server
+    that exports it in the Prometheus text format
+"""
+import logging
+import os
+import socket
+import stat
+import time
+from bisect import bisect_left
+from ipaddress import ip_address
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+# latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(x).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for x in values)
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """ Base class for the metrics. Values are kept per tuple of label values, given in the order of
+        label_names
+    """
+    type = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.clear()
+
+    def _zero(self):
+        return 0
+
+    def clear(self):
+        self.values.clear()
+        # metrics without labels are exported from the start
+        if not self.label_names:
+            self.values[()] = self._zero()
+
+    def samples(self):
+        """ Yields the (name, label names, label values, value) samples of the metric
+        """
+        for labels, value in list(self.values.items()):
+            yield self.name, self.label_names, labels, value
+
+    def to_text(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        lines.extend('{}{} {}'.format(name, _format_labels(label_names, labels), _format_value(value))
+                     for name, label_names, labels, value in self.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+
+class Histogram(Metric):
+    """ Counts the observed values in fixed buckets (plus +Inf), keeping their sum and count
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, label_names)
+
+    def _zero(self):
+        # [non-cumulative count per bucket, sum]
+        return [[0] * (len(self.buckets) + 1), 0]
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = self._zero()
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def get_count(self, *labels):
+        series = self.values.get(labels)
+        return sum(series[0]) if series is not None else 0
+
+    def samples(self):
+        label_names = self.label_names + ('le',)
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', label_names, labels + (_format_value(bound),), cumulative
+            yield self.name + '_sum', self.label_names, labels, total
+            yield self.name + '_count', self.label_names, labels, cumulative
+
+
+class Registry:
+    """ Keeps the metrics, indexed by name
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric {} is already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()):
+        return self.register(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def to_text(self):
+        """ Returns the metrics in the Prometheus text exposition format
+        """
+        return ''.join(x.to_text() for x in self.metrics.values())
+
+
+# registry used by all the modules
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """ Serves the metrics over HTTP, on a TCP address (host, port) or a Unix socket path. It never blocks:
+        the main loop waits for the sockets returned by get_sockets() and calls process() with the readable
+        ones. Responses that do not fit in the socket buffer are sent over the following calls.
+        on_scrape (if any) is called before rendering the metrics, e.g. to update gauges.
+    """
+    # Seconds a client has to send its request and read the response before being disconnected
+    TIMEOUT = 5
+    MAX_CLIENTS = 16
+    MAX_REQUEST_SIZE = 8192
+
+    def __init__(self, addr, registry=REGISTRY, on_scrape=None):
+        self.registry = registry
+        self.on_scrape = on_scrape
+        self.path = None
+        if isinstance(addr, str):
+            # only stale sockets (e.g. from a previous run) are replaced, never other files
+            try:
+                if not stat.S_ISSOCK(os.stat(addr).st_mode):
+                    raise FileExistsError('{} exists and is not a socket'.format(addr))
+                os.remove(addr)
+            except FileNotFoundError:
+                pass
+            self.listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.path = addr
+        else:
+            family = socket.AF_INET6 if ip_address(addr[0]).version == 6 else socket.AF_INET
+            self.listen_sock = socket.socket(family, socket.SOCK_STREAM)
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_sock.bind(addr)
+        self.listen_sock.listen(self.MAX_CLIENTS)
+        self.listen_sock.setblocking(False)
+        # clients, mapped to [received request, pending response, deadline]
+        self.clients = {}
+
+    def get_sockets(self):
+        return [self.listen_sock] + [x for x, client in self.clients.items() if client[1] is None]
+
+    def process(self, readable):
+        """ Accepts the new clients, reads the requests, and sends the (pending) responses
+        """
+        now = time.time()
+        if self.listen_sock in readable:
+            try:
+                sock, addr = self.listen_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                pass
+            else:
+                if len(self.clients) >= self.MAX_CLIENTS:
+                    sock.close()
+                else:
+                    sock.setblocking(False)
+                    self.clients[sock] = [bytearray(), None, now + self.TIMEOUT]
+        for sock, client in list(self.clients.items()):
+            try:
+                if sock in readable and client[1] is None:
+                    data = sock.recv(4096)
+                    if not data:
+                        self._disconnect(sock)
+                        continue
+                    client[0] += data
+                    if b'\r\n\r\n' in client[0] or len(client[0]) > self.MAX_REQUEST_SIZE:
+                        client[1] = self._response(bytes(client[0]))
+                if client[1]:
+                    client[1] = client[1][sock.send(client[1]):]
+                    if not client[1]:
+                        self._disconnect(sock)
+                        continue
+                if client[2] < now:
+                    self._disconnect(sock)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as ex:
+                logging.debug('Metrics client error: {}'.format(ex))
+                self._disconnect(sock)
+
+    def _response(self, request):
+        request_line = request.split(b'\r\n', 1)[0].split()
+        if len(request_line) < 2 or request_line[0] != b'GET':
+            status, body = '405 Method Not Allowed', ''
+        elif request_line[1].split(b'?')[0] not in (b'/', b'/metrics'):
+            status, body = '404 Not Found', ''
+        else:
+            if self.on_scrape is not None:
+                self.on_scrape()
+            status, body = '200 OK', self.registry.to_text()
+        body = body.encode()
+        return ('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\n'
+                'Connection: close\r\n\r\n'.format(status, len(body))).encode() + body
+
+    def _disconnect(self, sock):
+        sock.close()
+        del self.clients[sock]
+
+    def close(self):
+        for sock in list(self.clients):
+            self._disconnect(sock)
+        self.listen_sock.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -3,6 +3,7 @@
 
 """ This module defines a simplistic Netlink framework
 """
+import errno
 import os
 import socket
 import time
@@ -12,6 +13,8 @@ from struct import unpack_from
 # Flags
 import logging
 
+from metrics import REGISTRY
+
 NLM_F_REQUEST = 0x0001
 NLM_F_MULTI = 0x0002
 NLM_F_ACK = 0x0004
@@ -25,6 +28,12 @@ NLMSG_ERROR = 0x02
 NLMSG_DONE = 0x03
 
 
+NETLINK_REQUESTS = REGISTRY.histogram('pyikev2_netlink_request_seconds', 'Netlink request round-trip time.',
+                                      ('type',))
+NETLINK_ERRORS = REGISTRY.counter('pyikev2_netlink_errors_total', 'Netlink error responses, by error.',
+                                  ('type', 'error'))
+
+
 class NetlinkError(Exception):
     pass
 
@@ -67,6 +76,7 @@ class NetlinkProtocol(object):
     attribute_types = {}
     payload_types = {}
     netlink_family = None
+    RECV_BUFFER_SIZE = 32768
 
     def __init__(self):
         self.payload_types[NLMSG_ERROR] = NetlinkErrorMsg
@@ -125,19 +135,28 @@ class NetlinkProtocol(object):
                 data += bytes(attr)
         header = NetlinkHeader(length=sizeof(NetlinkHeader) + len(data), type=payload_type,
                                seq=int(time.time()), pid=os.getpid(), flags=flags)
+        start = time.perf_counter()
         sock = self._get_socket(0)
         sock.send(bytes(header) + data)
-        data = sock.recv(4096)
-        sock.close()
         responses = []
-        while len(data) > 0:
-            header, payload, attributes = self.parse_message(data)
-            if header.type == NLMSG_ERROR and payload.error != 0:
-                print('Received error header!: {}'.format(os.strerror(-payload.error)))
-                # raise NetlinkError(
-                #     'Received error header!: {}'.format(os.strerror(-payload.error)))
-            if header.type == NLMSG_DONE:
-                break
-            data = data[header.length:]
-            responses.append((header, payload, attributes),)
+        # multipart responses (e.g. dumps) may span several datagrams, and are terminated by NLMSG_DONE
+        multipart = True
+        while multipart:
+            multipart = False
+            data = sock.recv(self.RECV_BUFFER_SIZE)
+            while len(data) > 0:
+                header, payload, attributes = self.parse_message(data)
+                if header.type == NLMSG_ERROR and payload.error != 0:
+                    NETLINK_ERRORS.inc(payload_type, errno.errorcode.get(-payload.error, -payload.error))
+                    print('Received error header!: {}'.format(os.strerror(-payload.error)))
+                    # raise NetlinkError(
+                    #     'Received error header!: {}'.format(os.strerror(-payload.error)))
+                if header.type == NLMSG_DONE:
+                    multipart = False
+                    break
+                multipart = bool(header.flags & NLM_F_MULTI)
+                data = data[header.length:]
+                responses.append((header, payload, attributes),)
+        sock.close()
+        NETLINK_REQUESTS.observe(time.perf_counter() - start, payload_type)
         return responses
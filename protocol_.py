@@ -3,6 +3,7 @@
 
 """ This module defines the classes for the protocol handling.
 """
+import hashlib
 import json
 import logging
 import os
@@ -10,27 +11,67 @@ import random
 import socket
 import time
 import traceback
-from collections import namedtuple
-from ipaddress import ip_address, ip_network
+from collections import Counter, namedtuple
+from ipaddress import ip_address
 from itertools import chain
 from select import select
-from struct import unpack
+from struct import error as struct_error, pack, unpack
 
+import capture
+import ha
+import snapshot
 import xfrm
-from crypto import Cipher, Crypto, DiffieHellman, Integrity, Prf
+from admission import AdmissionScheduler, TokenBucket
+from configuration import ConfigurationNotFound, ProtectIndex, ProtectList
+from crypto import Cipher, CookieGenerator, Crypto, DiffieHellman, Integrity, Prf
 from helpers import SafeIntEnum, hexstring
-from message import (AuthenticationFailed, ChildSaNotFound, IkeSaError, InvalidKePayload,
-                     NoProposalChosen, TemporaryFailure, TsUnacceptable)
+from message import (AuthenticationFailed, ChildSaNotFound, IkeSaError, InvalidKePayload, InvalidSyntax,
+                     NoProposalChosen, TemporaryFailure, TsMaxQueue, TsUnacceptable)
 from message import (Message, Payload, PayloadAUTH, PayloadDELETE, PayloadIDi, PayloadIDr, PayloadKE, PayloadNONCE,
-                     PayloadNOTIFY, PayloadSA, PayloadTSi, PayloadTSr, PayloadVENDOR, Proposal, TrafficSelector,
-                     Transform)
+                     PayloadNOTIFY, PayloadSA, PayloadTSi, PayloadTSr, PayloadVENDOR, Proposal, ProposalTable,
+                     TrafficSelector, Transform)
+from metrics import REGISTRY, MetricsServer
+from rekey import RekeyGovernor
+from resumption import TicketManager
+from snapshot import ChildSaSnapshot, IkeSaSnapshot, SnapshotError
 
 __author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
 
 # TODO: Implement tests for this with valid and invalid exchange sequences
 
+HalfOpenSa = namedtuple('HalfOpenSa', ['ike_sa', 'request_hash', 'expires_at'])
+
+WindowRequest = namedtuple('WindowRequest', ['request', 'child_sa', 'rekeyed_child_sa', 'retransmit_at',
+                                             'retransmissions'])
+
+CachedResponse = namedtuple('CachedResponse', ['request_hash', 'response_data'])
+
+MESSAGES_RECEIVED = REGISTRY.counter('pyikev2_messages_received_total', 'IKE messages received, by exchange.',
+                                     ('exchange', 'type'))
+UNKNOWN_SPI_MESSAGES = REGISTRY.counter('pyikev2_unknown_spi_messages_total', 'IKE messages received for unknown SPIs.')
+DISPATCH_SECONDS = REGISTRY.histogram('pyikev2_dispatch_seconds', 'Time to dispatch a received IKE message.')
+REQUEST_SECONDS = REGISTRY.histogram('pyikev2_request_processing_seconds', 'Time to process a received request.',
+                                     ('exchange', 'result'))
+RESPONSE_SECONDS = REGISTRY.histogram('pyikev2_response_processing_seconds', 'Time to process a received response.',
+                                      ('exchange', 'result'))
+HANDSHAKE_SECONDS = REGISTRY.histogram('pyikev2_handshake_seconds', 'Time from the creation of an IKE_SA to its '
+                                       'establishment.', ('role',),
+                                       buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+RETRANSMISSIONS = REGISTRY.counter('pyikev2_retransmissions_total', 'Requests retransmitted.')
+RETRANSMISSION_TIMEOUTS = REGISTRY.counter('pyikev2_retransmission_timeouts_total', 'IKE_SAs closed after '
+                                           'retransmitting a request without getting a response.')
+DPD_REQUESTS = REGISTRY.counter('pyikev2_dpd_requests_total', 'DEAD-PEER-DETECTION requests sent.')
+REKEYS = REGISTRY.counter('pyikev2_rekeys_total', 'Rekeys started, by SA type.', ('sa',))
+REKEYS_DEFERRED = REGISTRY.counter('pyikev2_rekeys_deferred_total', 'CHILD_SA rekeys deferred by the rekey governor.')
+IKE_SAS = REGISTRY.gauge('pyikev2_ike_sas', 'IKE_SAs, by state.', ('state',))
+HALF_OPEN_IKE_SAS = REGISTRY.gauge('pyikev2_half_open_ike_sas', 'Half-open IKE_SAs.')
+CHILD_SAS = REGISTRY.gauge('pyikev2_child_sas', 'CHILD_SAs.')
+
 Keyring = namedtuple('Keyring', ['sk_d', 'sk_ai', 'sk_ar', 'sk_ei', 'sk_er', 'sk_pi', 'sk_pr'])
-ChildSa = namedtuple('ChildSa', ['inbound_spi', 'outbound_spi', 'proposal', 'tsi', 'tsr', 'mode', 'ipsec_conf'])
+# exchange_initiator tells whether we initiated the exchange that created the CHILD_SA, and hence own its "i" keys
+ChildSa = namedtuple('ChildSa', ['inbound_spi', 'outbound_spi', 'proposal', 'tsi', 'tsr', 'mode', 'ipsec_conf', 'cpu',
+                                 'keyring', 'exchange_initiator'],
+                     defaults=(None, None, None))
 ChildSa.__str__ = lambda x: '({}, {})'.format(hexstring(x.inbound_spi), hexstring(x.outbound_spi))
 
 
@@ -38,6 +79,16 @@ class IkeSaStateError(Exception):
     pass
 
 
+class IkeSaLoggerAdapter(logging.LoggerAdapter):
+    """ Prefixes the log records of an IKE_SA with its SPI. The logger checks the level before calling
+        process(), so records that are not emitted cost neither the prefix nor the formatting of their
+        arguments (e.g. log_debug('Generated %s', value)).
+    """
+
+    def process(self, msg, kwargs):
+        return 'IKE_SA: {}. {}'.format(self.extra['ike_sa'], msg), kwargs
+
+
 class IkeSa(object):
     """ This class controls the state machine of a IKE SA
         It is triggered with received Messages and/or IPsec events
@@ -59,6 +110,7 @@ class IkeSa(object):
         DEL_IKE_SA_REQ_SENT = 15
         DEL_AFTER_REKEY_IKE_SA_REQ_SENT = 16
         DPD_REQ_SENT = 17
+        MSG_ID_SYNC_REQ_SENT = 18
 
         # Closing states
         REKEYED = 20
@@ -67,7 +119,15 @@ class IkeSa(object):
     MAX_RETRANSMISSIONS = 4
     RETRANSMISSION_DELAY = 2
 
-    def __init__(self, is_initiator, peer_spi, configuration, my_addr, peer_addr):
+    # Increment applied to the message IDs when taking over an IKE_SA from another cluster member (RFC 6311),
+    # so they are beyond any message ID used by the previous active member and not replicated
+    MSG_ID_JUMP = 100
+
+    # Maximum number of REDIRECT notifications (RFC 5685) followed when creating an IKE_SA, to avoid loops
+    MAX_REDIRECTS = 5
+
+    def __init__(self, is_initiator, peer_spi, configuration, my_addr, peer_addr, ticket_manager=None,
+                 rekey_governor=None):
         self.state = IkeSa.State.INITIAL
         self.my_spi = os.urandom(8)
         self.peer_spi = peer_spi
@@ -85,6 +145,15 @@ class IkeSa(object):
         self.ike_sa_init_req_data = None
         self.ike_sa_init_res_data = None
         self.request = None
+        self.last_sent_response_data = None
+        # responses to the last requests received, indexed by message ID, to answer retransmissions
+        self.response_cache = {}
+        # message IDs of requests processed out of order, beyond peer_msg_id
+        self.processed_msg_ids = set()
+        # pipelined CREATE_CHILD_SA requests sent while self.request is in flight, indexed by message ID
+        self.window = {}
+        self.last_window_msg_id = 0
+        self.peer_window_size = 1
         self.creating_child_sa = None
         self.rekeying_child_sa = None
         self.deleting_child_sa = None
@@ -94,27 +163,47 @@ class IkeSa(object):
         self.retransmit_at = 0
         self.retransmissions = 0
         self.start_dpd_at = time.time() + configuration.dpd
-        self.rekey_ike_sa_at = time.time() + configuration.lifetime + random.uniform(0, 5)
-        self.delete_ike_sa_at = self.rekey_ike_sa_at + 30
+        self.inbound_bytes = {}
+        self.rekey_ike_sa_at = time.time() + RekeyGovernor.jittered(configuration.lifetime)
+        self.delete_ike_sa_at = time.time() + configuration.lifetime + 30
         self.pending_events = []
+        # session resumption (RFC 5723) tickets, and whether this IKE_SA has been created by resuming another one
+        self.ticket_manager = ticket_manager
+        self.resumption_ticket = None
+        self.resumed = False
+        # IDi the ticket used for resuming was issued to, which the initiator must present in IKE_AUTH
+        self.resumed_peer_id = None
+        # spreads the rekeys and limits how many of them are in flight, shared by all the IKE_SAs
+        self.rekey_governor = rekey_governor
+        # whether the peer supports IKEV2_MESSAGE_ID_SYNC (RFC 6311), and the nonce of the one in flight
+        self.msg_id_sync = False
+        self.msg_id_sync_nonce = None
+        # gateway that redirected us to the current peer (RFC 5685), and number of redirections followed
+        self.redirected_from = None
+        self.redirects = 0
+        # set (shared by the IKE_SAs of the controller) where the IKE_SA adds itself when its message IDs or
+        # CHILD_SAs may have changed, so only those are replicated (HA)
+        self.changed_ike_sas = None
+        self.created_at = time.time()
+        self.logger = IkeSaLoggerAdapter(logging.getLogger(), {'ike_sa': self})
 
     def __str__(self):
         return hexstring(self.my_spi)
 
-    def log_msg(self, level, message):
-        logging.log(level, 'IKE_SA: {}. {}'.format(self, message))
+    def log_msg(self, level, message, *args):
+        self.logger.log(level, message, *args)
 
-    def log_error(self, message):
-        self.log_msg(logging.ERROR, message)
+    def log_error(self, message, *args):
+        self.log_msg(logging.ERROR, message, *args)
 
-    def log_info(self, message):
-        self.log_msg(logging.INFO, message)
+    def log_info(self, message, *args):
+        self.log_msg(logging.INFO, message, *args)
 
-    def log_warning(self, message):
-        self.log_msg(logging.WARNING, message)
+    def log_warning(self, message, *args):
+        self.log_msg(logging.WARNING, message, *args)
 
-    def log_debug(self, message):
-        self.log_msg(logging.DEBUG, message)
+    def log_debug(self, message, *args):
+        self.log_msg(logging.DEBUG, message, *args)
 
     def generate_ike_sa_key_material(self, ike_proposal, nonce_i, nonce_r, spi_i, spi_r, shared_secret, old_sk_d=None):
         """ Generates IKE_SA key material based on the proposal and DH
@@ -128,22 +217,103 @@ class IkeSa(object):
         else:
             skeyseed = prf.prf(old_sk_d, shared_secret + nonce_i + nonce_r)
 
-        self.log_debug('Generated SKEYSEED: {}'.format(hexstring(skeyseed)))
+        # key material is only hex-encoded when it is going to be logged
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log_debug('Generated SKEYSEED: %s', hexstring(skeyseed))
 
         keymat = prf.prfplus(skeyseed, nonce_i + nonce_r + spi_i + spi_r,
                              prf.key_size * 3 + integ.key_size * 2 + cipher.key_size * 2)
         sk_d, sk_ai, sk_ar, sk_ei, sk_er, sk_pi, sk_pr = unpack(
             '>{0}s{1}s{1}s{2}s{2}s{0}s{0}s'.format(prf.key_size, integ.key_size, cipher.key_size), keymat)
         ike_sa_keyring = Keyring(sk_d, sk_ai, sk_ar, sk_ei, sk_er, sk_pi, sk_pr)
+        self._generate_ike_sa_crypto(ike_proposal, ike_sa_keyring)
+        self._capture_keys(spi_i, spi_r, ike_proposal, ike_sa_keyring)
+
+        if debug:
+            for keyname in ['sk_d', 'sk_ai', 'sk_ar', 'sk_ei', 'sk_er', 'sk_pi', 'sk_pr']:
+                self.log_debug('Generated %s: %s', keyname, hexstring(getattr(ike_sa_keyring, keyname)))
+        return ike_sa_keyring
+
+    def _capture_keys(self, spi_i, spi_r, ike_proposal, ike_sa_keyring):
+        active_capture = capture.active()
+        if active_capture is not None and active_capture.decrypted:
+            active_capture.write_keys(spi_i, spi_r, ike_proposal, ike_sa_keyring)
+
+    def capture_keys(self):
+        """ Writes the keys of this IKE_SA to the capture in progress (e.g. when it starts after the IKE_SA
+            has been established)
+        """
+        if self.ike_sa_keyring is not None:
+            self._capture_keys(*self._spis(), self.chosen_proposal, self.ike_sa_keyring)
+
+    def forget_capture_keys(self):
+        active_capture = capture.active()
+        if active_capture is not None:
+            active_capture.forget_keys(*self._spis())
+
+    def _spis(self):
+        """ Returns the (SPIi, SPIr) tuple of this IKE_SA
+        """
+        return (self.my_spi, self.peer_spi) if self.is_initiator else (self.peer_spi, self.my_spi)
+
+    def _generate_ike_sa_crypto(self, ike_proposal, ike_sa_keyring):
+        """ Sets self.my_crypto and self.peer_crypto from the proposal and the IKE_SA keys
+        """
+        prf = Prf(ike_proposal.get_transform(Transform.Type.PRF))
+        integ = Integrity(ike_proposal.get_transform(Transform.Type.INTEG))
+        cipher = Cipher(ike_proposal.get_transform(Transform.Type.ENCR))
         crypto_i = Crypto(cipher, ike_sa_keyring.sk_ei, integ, ike_sa_keyring.sk_ai, prf, ike_sa_keyring.sk_pi)
         crypto_r = Crypto(cipher, ike_sa_keyring.sk_er, integ, ike_sa_keyring.sk_ar, prf, ike_sa_keyring.sk_pr)
         self.my_crypto = crypto_i if self.is_initiator else crypto_r
         self.peer_crypto = crypto_r if self.is_initiator else crypto_i
 
-        for keyname in ['sk_d', 'sk_ai', 'sk_ar', 'sk_ei', 'sk_er', 'sk_pi', 'sk_pr']:
-            hexkey = hexstring(getattr(ike_sa_keyring, keyname))
-            self.log_debug('Generated {}: {}'.format(keyname, hexkey))
-        return ike_sa_keyring
+    def to_snapshot(self):
+        """ Returns the IkeSaSnapshot of an established IKE_SA, or None if it is in the middle of an exchange
+        """
+        if self.state != IkeSa.State.ESTABLISHED or self.window:
+            return None
+        child_sas = [ChildSaSnapshot(x.inbound_spi, x.outbound_spi, x.proposal, x.tsi, x.tsr, x.mode,
+                                     x.ipsec_conf.index, x.cpu,
+                                     (x.keyring.sk_ai, x.keyring.sk_ar, x.keyring.sk_ei, x.keyring.sk_er)
+                                     if x.keyring else None, x.exchange_initiator) for x in self.child_sas]
+        return IkeSaSnapshot(self.is_initiator, self.resumed, self.my_spi, self.peer_spi, self.my_msg_id,
+                             self.peer_msg_id, self.peer_window_size, self.rekey_ike_sa_at, self.delete_ike_sa_at,
+                             self.my_addr, self.peer_addr, self.chosen_proposal, tuple(self.ike_sa_keyring),
+                             child_sas, self.msg_id_sync)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, configuration, ticket_manager=None, rekey_governor=None):
+        """ Creates an established IKE_SA from an IkeSaSnapshot. The IPsec SAs of its CHILD_SAs are expected
+            to be already installed in the kernel
+        """
+        ike_sa = IkeSa(snapshot.is_initiator, snapshot.peer_spi, configuration, snapshot.my_addr, snapshot.peer_addr,
+                       ticket_manager, rekey_governor)
+        ike_sa.state = IkeSa.State.ESTABLISHED
+        ike_sa.my_spi = snapshot.my_spi
+        ike_sa.my_msg_id = snapshot.my_msg_id
+        ike_sa.peer_msg_id = snapshot.peer_msg_id
+        ike_sa.peer_window_size = snapshot.peer_window_size
+        ike_sa.rekey_ike_sa_at = snapshot.rekey_ike_sa_at
+        ike_sa.delete_ike_sa_at = snapshot.delete_ike_sa_at
+        ike_sa.resumed = snapshot.resumed
+        ike_sa.msg_id_sync = snapshot.msg_id_sync
+        ike_sa.chosen_proposal = snapshot.proposal
+        ike_sa.ike_sa_keyring = Keyring(*snapshot.keyring)
+        ike_sa._generate_ike_sa_crypto(ike_sa.chosen_proposal, ike_sa.ike_sa_keyring)
+        for child_sa in snapshot.child_sas:
+            try:
+                ipsec_conf = next(x for x in configuration.protect if x.index == child_sa.index)
+            except StopIteration:
+                ike_sa.log_warning('No "protect" configuration with index {} for restored CHILD_SA {}. Omitting.'
+                                   ''.format(child_sa.index, hexstring(child_sa.inbound_spi)))
+                continue
+            keyring = Keyring(None, *child_sa.keyring, None, None) if child_sa.keyring else None
+            ike_sa.child_sas.append(ChildSa(inbound_spi=child_sa.inbound_spi, outbound_spi=child_sa.outbound_spi,
+                                            proposal=child_sa.proposal, tsi=child_sa.tsi, tsr=child_sa.tsr,
+                                            mode=child_sa.mode, ipsec_conf=ipsec_conf, cpu=child_sa.cpu,
+                                            keyring=keyring, exchange_initiator=child_sa.exchange_initiator))
+        return ike_sa
 
     def delete_child_sas(self):
         for child_sa in self.child_sas:
@@ -164,39 +334,44 @@ class IkeSa(object):
         sk_ei, sk_ai, sk_er, sk_ar = unpack('>{0}s{1}s{0}s{1}s'.format(encr_key_size, integ_key_size), keymat)
         child_sa_keyring = Keyring(None, sk_ai, sk_ar, sk_ei, sk_er, None, None)
 
-        self.log_debug('Generated sk_ai: {}'.format(hexstring(sk_ai)))
-        self.log_debug('Generated sk_ar: {}'.format(hexstring(sk_ar)))
-        self.log_debug('Generated sk_ei: {}'.format(hexstring(sk_ei)))
-        self.log_debug('Generated sk_er: {}'.format(hexstring(sk_er)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log_debug('Generated sk_ai: %s', hexstring(sk_ai))
+            self.log_debug('Generated sk_ar: %s', hexstring(sk_ar))
+            self.log_debug('Generated sk_ei: %s', hexstring(sk_ei))
+            self.log_debug('Generated sk_er: %s', hexstring(sk_er))
 
         return child_sa_keyring
 
-    def _select_best_sa_proposal(self, my_proposal, peer_payload_sa):
+    def _select_best_sa_proposal(self, my_table, peer_payload_sa):
         """ Selects a received Payload SA with our own suite
         """
         for peer_proposal in peer_payload_sa.proposals:
-            intersection = my_proposal.intersection(peer_proposal)
+            intersection = my_table.negotiate(peer_proposal)
             if intersection is not None:
                 return intersection
         raise NoProposalChosen('Could not find a suitable matching Proposal')
 
-    def _ike_conf_2_proposal(self):
-        return Proposal(1, Proposal.Protocol.IKE, b'', (self.configuration.encr + self.configuration.integ
-                                                        + self.configuration.prf + self.configuration.dh))
+    def _ike_conf_2_table(self):
+        return ProposalTable.get(Proposal.Protocol.IKE, tuple(self.configuration.encr + self.configuration.integ
+                                                              + self.configuration.prf + self.configuration.dh))
 
-    def _ipsec_conf_2_proposal(self, ipsec_conf):
+    def _ipsec_conf_2_table(self, ipsec_conf):
         if ipsec_conf.ipsec_proto == Proposal.Protocol.ESP:
-            return Proposal(1, ipsec_conf.ipsec_proto, b'', ipsec_conf.encr + ipsec_conf.integ)
+            return ProposalTable.get(ipsec_conf.ipsec_proto, tuple(ipsec_conf.encr + ipsec_conf.integ + ipsec_conf.esn))
         else:
-            return Proposal(1, ipsec_conf.ipsec_proto, b'', ipsec_conf.integ)
+            return ProposalTable.get(ipsec_conf.ipsec_proto, tuple(ipsec_conf.integ + ipsec_conf.esn))
+
+    def _ike_conf_2_proposal(self):
+        return self._ike_conf_2_table().to_proposal()
+
+    def _ipsec_conf_2_proposal(self, ipsec_conf):
+        return self._ipsec_conf_2_table(ipsec_conf).to_proposal()
 
     def _select_best_ike_sa_proposal(self, peer_payload_sa):
-        my_proposal = self._ike_conf_2_proposal()
-        return self._select_best_sa_proposal(my_proposal, peer_payload_sa)
+        return self._select_best_sa_proposal(self._ike_conf_2_table(), peer_payload_sa)
 
     def _select_best_child_sa_proposal(self, peer_payload_sa, ipsec_conf):
-        my_proposal = self._ipsec_conf_2_proposal(ipsec_conf)
-        return self._select_best_sa_proposal(my_proposal, peer_payload_sa)
+        return self._select_best_sa_proposal(self._ipsec_conf_2_table(ipsec_conf), peer_payload_sa)
 
     def _ipsec_conf_2_ts(self, ipsec_conf):
         """ Generates traffic selectors based on an ipsec configuration
@@ -211,37 +386,40 @@ class IkeSa(object):
             first configuration that is larger or smaller than the proposed
             pair, along with the chosen selectors
         """
+        protect = self.configuration.protect
+        protect_index = protect.ts_index if isinstance(protect, ProtectList) else ProtectIndex(protect)
         for tsi in reversed(payload_tsi.traffic_selectors):
             for tsr in reversed(payload_tsr.traffic_selectors):
-                for ipsec_conf in self.configuration.protect:
-                    conf_tsi, conf_tsr = self._ipsec_conf_2_ts(ipsec_conf)
-                    # look for a larger policy
-                    if tsi.is_subset(conf_tsi) and tsr.is_subset(conf_tsr):
-                        return ipsec_conf, tsi, tsr
-                    # look for a smaller policy
-                    elif conf_tsi.is_subset(tsi) and conf_tsr.is_subset(tsr):
-                        return ipsec_conf, conf_tsi, conf_tsr
+                match = protect_index.lookup(tsi, tsr)
+                if match is not None:
+                    return match
         raise TsUnacceptable('TS could not be matched with any IPsec configuration')
 
     # TODO: Logging should be done per exchange, instead of having a generic
     # call, to make it more specific (e.g. CHILD_SA_REKEY, IKE_SA_REKEY, IKE_SA_DELETE, etc.)
     def log_message(self, message, data, send=True):
+        active_capture = capture.active()
+        if active_capture is not None and active_capture.decrypted and message.encrypted_payloads:
+            my_addr, peer_addr = (str(self.my_addr), 500), (str(self.peer_addr), 500)
+            active_capture.write_decrypted(message.to_cleartext_bytes(), *((my_addr, peer_addr) if send
+                                                                           else (peer_addr, my_addr)))
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
         payloads_names = (Payload.Type.safe_name(x.type) for x in message.payloads + message.encrypted_payloads if
                           x.type != Payload.Type.NOTIFY)
         payloads_notify_names = ('N({})'.format(PayloadNOTIFY.Type.safe_name(x.notification_type)) for x in
                                  message.payloads + message.encrypted_payloads if x.type == Payload.Type.NOTIFY)
-        self.log_info('{} {} {} ({} bytes) {} {} [{}]'
-                      ''.format('Sent' if send else 'Received',
-                                Message.Exchange.safe_name(message.exchange_type),
-                                'response' if message.is_response else 'request',
-                                len(data),
-                                'to' if send else 'from',
-                                self.peer_addr,
-                                ', '.join(chain(payloads_names, payloads_notify_names))))
-        self.log_debug(json.dumps(message.to_dict(), indent=logging.indent))
+        self.log_info('%s %s %s (%d bytes) %s %s [%s]', 'Sent' if send else 'Received',
+                      Message.Exchange.safe_name(message.exchange_type),
+                      'response' if message.is_response else 'request', len(data), 'to' if send else 'from',
+                      self.peer_addr, ', '.join(chain(payloads_names, payloads_notify_names)))
+        # the JSON dump of the message is the most expensive log line by far
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log_debug(json.dumps(message.to_dict(), indent=logging.indent))
 
     def _generate_ike_error_response(self, request, exception):
         notify_error = PayloadNOTIFY.from_exception(exception)
+        unencrypted = request.exchange_type in (Message.Exchange.IKE_SA_INIT, Message.Exchange.IKE_SESSION_RESUME)
         return Message(spi_i=request.spi_i,
                        spi_r=request.spi_r,
                        major=2,
@@ -250,25 +428,32 @@ class IkeSa(object):
                        is_response=True,
                        can_use_higher_version=False,
                        is_initiator=self.is_initiator,
-                       message_id=self.peer_msg_id,
-                       payloads=([notify_error] if request.exchange_type == Message.Exchange.IKE_SA_INIT else []),
-                       encrypted_payloads=([notify_error] if request.exchange_type != Message.Exchange.IKE_SA_INIT
-                                           else []),
-                       crypto=(self.my_crypto if request.exchange_type != Message.Exchange.IKE_SA_INIT else None))
+                       message_id=request.message_id,
+                       payloads=([notify_error] if unencrypted else []),
+                       encrypted_payloads=([notify_error] if not unencrypted else []),
+                       crypto=(self.my_crypto if not unencrypted else None))
 
-    def _process_request(self, message):
+    def _process_request(self, message, request_hash=None):
         _handler_dict = {
             Message.Exchange.IKE_SA_INIT: self.process_ike_sa_init_request,
             Message.Exchange.IKE_AUTH: self.process_ike_auth_request,
             Message.Exchange.INFORMATIONAL: self.process_informational_request,
-            Message.Exchange.CREATE_CHILD_SA: self.process_create_child_sa_request
+            Message.Exchange.CREATE_CHILD_SA: self.process_create_child_sa_request,
+            Message.Exchange.IKE_SESSION_RESUME: self.process_ike_session_resume_request,
         }
 
-        # check message_id and handle retransmissions
-        if message.message_id == self.peer_msg_id - 1:
+        # IKEV2_MESSAGE_ID_SYNC requests use message ID 0 and are never cached (RFC 6311)
+        if (message.message_id == 0 and message.exchange_type == Message.Exchange.INFORMATIONAL
+                and message.get_notifies(PayloadNOTIFY.Type.IKEV2_MESSAGE_ID_SYNC, True)):
+            return self.process_msg_id_sync_request(message)
+
+        # check message_id and handle retransmissions. Requests within our window might arrive out of order
+        cached_response = self.response_cache.get(message.message_id)
+        if cached_response is not None:
             self.log_warning('Retransmission detected. Sending last sent message')
-            return self.last_sent_response_data
-        elif message.message_id != self.peer_msg_id:
+            return cached_response.response_data
+        elif (not self.peer_msg_id <= message.message_id < self.peer_msg_id + self.configuration.window_size
+              or message.message_id in self.processed_msg_ids):
             self.log_error('Message with invalid ID. Expecting: {}. Received: {}. Omitting.'
                            ''.format(self.peer_msg_id, message.message_id))
             return None
@@ -278,27 +463,39 @@ class IkeSa(object):
         except KeyError:
             self.log_error("I don't know how to handle this message. Please, implement a handler for this exchange!")
             return None
+        start, previous_state, result = time.perf_counter(), self.state, 'ok'
         try:
             response = handler(message)
         except IkeSaError as ex:
             self.log_error(str(ex))
             response = self._generate_ike_error_response(message, ex)
             self.state = IkeSa.State.DELETED
+            result = 'error'
         except Exception as ex:
             traceback.print_exc()
             self.log_error(str(ex))
             response = self._generate_ike_error_response(message, ex)
             self.state = IkeSa.State.DELETED
+            result = 'error'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, Message.Exchange.safe_name(message.exchange_type), result)
+        self._observe_handshake(previous_state)
 
         # if the message is successfully processed, increment expected message
         # ID and store response (for future retransmissions responses)
-        self.peer_msg_id = self.peer_msg_id + 1
+        self.processed_msg_ids.add(message.message_id)
+        while self.peer_msg_id in self.processed_msg_ids:
+            self.processed_msg_ids.remove(self.peer_msg_id)
+            self.peer_msg_id = self.peer_msg_id + 1
         response_data = response.to_bytes()
         self.log_message(response, response_data, send=True)
         self.last_sent_response_data = response_data
+        self.response_cache[message.message_id] = CachedResponse(request_hash, response_data)
+        for msg_id in [x for x in self.response_cache if x < self.peer_msg_id - self.configuration.window_size]:
+            del self.response_cache[msg_id]
         return response_data
 
     def _send_request(self, request):
+        self._mark_changed()
         self.retransmissions = 1
         self.retransmit_at = time.time() + IkeSa.RETRANSMISSION_DELAY
         request_data = request.to_bytes()
@@ -311,48 +508,173 @@ class IkeSa(object):
             Message.Exchange.IKE_AUTH: self.process_ike_auth_response,
             Message.Exchange.CREATE_CHILD_SA: self.process_create_child_sa_response,
             Message.Exchange.INFORMATIONAL: self.process_informational_response,
+            Message.Exchange.IKE_SESSION_RESUME: self.process_ike_session_resume_response,
         }
 
+        # responses to IKEV2_MESSAGE_ID_SYNC requests use message ID 0 (RFC 6311)
+        if self.state == IkeSa.State.MSG_ID_SYNC_REQ_SENT and message.message_id == 0:
+            self.process_msg_id_sync_response(message)
+            return self._process_pending_events() if self.state == IkeSa.State.ESTABLISHED else None
+
+        # the rekey exchange (if any) is no longer in flight
+        if self.rekey_governor is not None and (message.message_id in self.window
+                                                or message.message_id == self.my_msg_id):
+            self.rekey_governor.release(self.my_spi, message.message_id)
+
+        # responses to pipelined requests are processed on their own
+        if message.message_id in self.window:
+            return self._process_window_response(message)
+
         # if message ID is not the expected one, log and omit
         if message.message_id != self.my_msg_id:
             self.log_error('Message with invalid ID. Expecting: {}. Received: {}. Omitting.'
                            ''.format(self.my_msg_id, message.message_id))
             return None
 
-        # increment our message ID for future requests
-        self.my_msg_id = self.my_msg_id + 1
+        # increment our message ID for future requests, skipping those used by pipelined requests
+        self.my_msg_id = max(self.my_msg_id, self.last_window_msg_id) + 1
         try:
             handler = _handler_dict[message.exchange_type]
         except KeyError:
             self.log_error("I don't know how to handle this message. Please, implement a handler!")
             return None
 
+        start, previous_state, result = time.perf_counter(), self.state, 'ok'
         try:
             request = handler(message)
+            self._observe_handshake(previous_state)
             # If there is a another request to be sent, serialise it and return it
             if request:
                 return self._send_request(request)
 
             # if state is ESTABLISHED, check for pending events
             if self.state == IkeSa.State.ESTABLISHED:
-                for x in list(self.pending_events):
-                    self.pending_events.remove(x)
-                    self.log_debug('Processing pending event')
-                    handler, *args = x
-                    request = handler(*args)
-                    if request:
-                        return request
+                return self._process_pending_events()
         except (IkeSaError, IkeSaStateError) as ex:
             self.log_error(str(ex))
             self.state = IkeSa.State.DELETED
+            result = 'error'
         except Exception as ex:
             traceback.print_exc()
             self.log_error(str(ex))
             self.state = IkeSa.State.DELETED
+            result = 'error'
+        finally:
+            RESPONSE_SECONDS.observe(time.perf_counter() - start, Message.Exchange.safe_name(message.exchange_type),
+                                     result)
+
+        return None
+
+    def _observe_handshake(self, previous_state):
+        if previous_state < IkeSa.State.ESTABLISHED and self.state == IkeSa.State.ESTABLISHED:
+            HANDSHAKE_SECONDS.observe(time.time() - self.created_at,
+                                      'initiator' if self.is_initiator else 'responder')
+
+    def _process_pending_events(self):
+        for x in list(self.pending_events):
+            self.pending_events.remove(x)
+            self.log_debug('Processing pending event')
+            handler, *args = x
+            request = handler(*args)
+            if request:
+                return request
+        return None
+
+    def _can_send_request(self):
+        """ Returns whether a new request can be sent, as no other one is in flight (besides pipelined
+            CREATE_CHILD_SA requests) and its message ID fits in the peer's window
+        """
+        return (self.state == IkeSa.State.ESTABLISHED
+                and (not self.window or self.my_msg_id < min(self.window) + self.peer_window_size))
+
+    def _next_window_msg_id(self):
+        """ Returns the message ID to be used by a new pipelined CREATE_CHILD_SA request, or None if it
+            cannot be sent now (the peer's window is full or the IKE_SA is not in a pipelining state)
+        """
+        if self.peer_window_size <= 1 or self.state not in (IkeSa.State.NEW_CHILD_REQ_SENT,
+                                                            IkeSa.State.REK_CHILD_REQ_SENT,
+                                                            IkeSa.State.DEL_CHILD_REQ_SENT,
+                                                            IkeSa.State.DPD_REQ_SENT):
+            return None
+        in_flight = [self.my_msg_id] + list(self.window)
+        msg_id = max(self.my_msg_id, self.last_window_msg_id) + 1
+        return msg_id if msg_id < min(in_flight) + self.peer_window_size else None
 
+    def _is_child_sa_busy(self, child_sa):
+        """ Returns whether there is an exchange in flight rekeying or deleting the CHILD_SA
+        """
+        return ((self.state == IkeSa.State.REK_CHILD_REQ_SENT and child_sa == self.rekeying_child_sa)
+                or (self.state == IkeSa.State.DEL_CHILD_REQ_SENT and child_sa == self.deleting_child_sa)
+                or any(x.rekeyed_child_sa == child_sa for x in self.window.values()))
+
+    def _send_window_request(self, child_sa, rekeyed_child_sa=None):
+        """ Sends a pipelined CREATE_CHILD_SA request while the current request is still in flight
+        """
+        msg_id = self.last_window_msg_id = self._next_window_msg_id()
+        request = self._generate_create_child_sa_message(child_sa, rekeyed_child_sa, msg_id)
+        self.window[msg_id] = WindowRequest(request, child_sa, rekeyed_child_sa,
+                                            time.time() + IkeSa.RETRANSMISSION_DELAY, 1)
+        request_data = request.to_bytes()
+        self.log_message(request, request_data, send=True)
+        return request_data
+
+    def _process_window_response(self, response):
+        """ Processes the response to a pipelined CREATE_CHILD_SA request
+        """
+        window_request = self.window.pop(response.message_id)
+        try:
+            self.abort_on_error_notifies(response, True, ignore=[PayloadNOTIFY.Type.TS_UNACCEPTABLE,
+                                                                 PayloadNOTIFY.Type.NO_PROPOSAL_CHOSEN,
+                                                                 PayloadNOTIFY.Type.CHILD_SA_NOT_FOUND,
+                                                                 PayloadNOTIFY.Type.TEMPORARY_FAILURE,
+                                                                 PayloadNOTIFY.Type.INVALID_KE_PAYLOAD,
+                                                                 PayloadNOTIFY.Type.TS_MAX_QUEUE])
+        except IkeSaError as ex:
+            self.log_error(str(ex))
+            self.state = IkeSa.State.DELETED
+            return None
+        try:
+            self._process_create_child_sa_negotiation_res(response, window_request.request,
+                                                          window_request.child_sa)
+            rekeyed_child_sa = window_request.rekeyed_child_sa
+            # the rekeyed CHILD_SA is deleted once the new one is in place
+            if rekeyed_child_sa is not None and rekeyed_child_sa in self.child_sas:
+                self.pending_events.append((self._request_child_sa_deletion, rekeyed_child_sa.inbound_spi))
+        except IkeSaError as ex:
+            self.log_warning(str(ex))
+        if self._can_send_request():
+            return self._process_pending_events()
         return None
 
+    def _request_child_sa_deletion(self, spi):
+        """ Creates an INFORMATIONAL message deleting the CHILD_SA, queuing it if that is not possible yet
+        """
+        if not self._can_send_request():
+            self.pending_events.append((self._request_child_sa_deletion, spi))
+            return None
+        child_sa = self.get_child_sa(spi)
+        if child_sa is None:
+            return None
+        return self._send_request(self.generate_delete_child_sa_request(child_sa))
+
+    def _mark_changed(self):
+        if self.changed_ike_sas is not None:
+            self.changed_ike_sas.add(self)
+
     def process_message(self, data):
+        self._mark_changed()
+        # retransmissions of the last request are detected from the header and a hash of the whole
+        # datagram, and answered before spending any time in decryption and parsing
+        header = Message.parse(data, header_only=True)
+        request_hash = None
+        if header.is_request:
+            request_hash = hashlib.sha256(data).digest()
+            cached_response = self.response_cache.get(header.message_id)
+            if cached_response is not None and cached_response.request_hash == request_hash:
+                self.log_warning('Retransmission detected. Sending last sent message')
+                self.start_dpd_at = time.time() + self.configuration.dpd
+                return cached_response.response_data
+
         # parse the whole message (including encrypted data)
         message = Message.parse(data, header_only=False, crypto=self.peer_crypto)
         self.log_message(message, data, send=False)
@@ -365,51 +687,96 @@ class IkeSa(object):
         # receiving any kind of message from the peer resets the DPD timer
         self.start_dpd_at = time.time() + self.configuration.dpd
         if message.is_request:
-            return self._process_request(message)
+            return self._process_request(message, request_hash)
         else:
             return self._process_response(message)
 
-    def process_acquire(self, tsi, tsr, index):
-        if self.state not in (IkeSa.State.INITIAL, IkeSa.State.ESTABLISHED):
+    def process_acquire(self, tsi, tsr, index, cpu=None):
+        if (self.state != IkeSa.State.INITIAL and not self._can_send_request()
+                and self._next_window_msg_id() is None):
             self.log_debug('Cannot process acquire while waiting for a response. Queuing')
-            self.pending_events.append((self.process_acquire, tsi, tsr, index))
+            self.pending_events.append((self.process_acquire, tsi, tsr, index, cpu))
             return None
-        try:
-            ipsec_conf = next(x for x in self.configuration.protect if x.index == index)
-        except StopIteration:
+        if index is None:
+            # the policies of peers configured by network have indexes chosen by the kernel, so use the selectors
+            protect = self.configuration.protect
+            protect_index = protect.ts_index if isinstance(protect, ProtectList) else ProtectIndex(protect)
+            match = protect_index.lookup(tsi, tsr)
+            ipsec_conf = match[0] if match is not None else None
+        else:
+            ipsec_conf = next((x for x in self.configuration.protect if x.index == index), None)
+        if ipsec_conf is None:
             self.log_warning('Could not find a matching "protect" configuration for received ACQUIRE.')
             return None
 
-        self.log_info("Received acquire from policy with index={}".format(index))
+        self.log_info("Received acquire from policy with index={}".format(ipsec_conf.index))
+        if not ipsec_conf.per_cpu_sas:
+            cpu = None
+        elif cpu is not None:
+            per_cpu_child_sas = [x for x in self.child_sas if x.ipsec_conf.index == ipsec_conf.index]
+            # the first CHILD_SA is installed without CPU, to be used as a fallback by the kernel
+            if not per_cpu_child_sas:
+                cpu = None
+            elif any(x.cpu == cpu for x in per_cpu_child_sas):
+                self.log_debug('There is already a CHILD_SA for CPU %s. Omitting ACQUIRE', cpu)
+                return None
+
         # Create the ChildSa object with the values we know so far
         child_sa = ChildSa(inbound_spi=os.urandom(4), outbound_spi=None, proposal=None, tsi=tsi, tsr=tsr,
-                           mode=ipsec_conf.mode, ipsec_conf=ipsec_conf)
+                           mode=ipsec_conf.mode, ipsec_conf=ipsec_conf, cpu=cpu)
         if self.state == IkeSa.State.INITIAL:
-            request = self.generate_ike_sa_init_request(child_sa)
-        else:
+            # resume a previous IKE_SA with the peer if we have a ticket for it, skipping the DH exchange
+            ticket = None
+            if self.ticket_manager is not None and self.configuration.resumption:
+                ticket = self.ticket_manager.pop(self.peer_addr)
+            if ticket is not None:
+                request = self.generate_ike_session_resume_request(child_sa, ticket)
+            else:
+                request = self.generate_ike_sa_init_request(child_sa)
+        elif self._can_send_request():
             request = self.generate_create_child_sa_request(child_sa)
+        # pipeline the request if there is another one in flight
+        else:
+            return self._send_window_request(child_sa)
 
         return self._send_request(request)
 
     def process_expire(self, spi, hard=False):
         """ Creates a rekey CREATE_CHILD_SA message for creating a new CHILD or an INFORMATIONAL for deleting it
         """
-        if self.state != IkeSa.State.ESTABLISHED:
-            self.log_debug('Cannot process expire while waiting for a response. Queuing')
-            self.pending_events.append((self.process_expire, spi, hard))
-            return None
-
         child_sa = self.get_child_sa(spi)
         if child_sa is None:
             self.log_debug("Received expire for unknown CHILD_SA with spi {}".format(hexstring(spi)))
             return None
 
+        # only soft expires can be pipelined (as CREATE_CHILD_SA rekeys) while waiting for a response
+        if not self._can_send_request() and (hard or self._next_window_msg_id() is None
+                                             or self._is_child_sa_busy(child_sa)
+                                             or self._is_child_sa_idle(child_sa)):
+            self.log_debug('Cannot process expire while waiting for a response. Queuing')
+            self.pending_events.append((self.process_expire, spi, hard))
+            return None
+
         self.log_info("Received expire for CHILD_SA {}. Hard={}".format(child_sa, hard))
-        # if this is a soft expire, rekey the CHILD SA
-        if not hard:
+        # if this is a soft expire of an idle CHILD_SA, let it go instead of rekeying it
+        if not hard and self._is_child_sa_idle(child_sa):
+            self.log_info('CHILD_SA {} has been idle for more than {} seconds. Deleting it instead of rekeying'
+                          ''.format(child_sa, child_sa.ipsec_conf.idle_timeout))
+            request = self.generate_delete_child_sa_request(child_sa)
+        # if this is a soft expire, rekey the CHILD SA (if there is budget for it)
+        elif not hard:
+            if not self._acquire_rekey(self.my_msg_id if self._can_send_request() else self._next_window_msg_id()):
+                self.log_debug('Too many rekeys in flight. Deferring the rekey of CHILD_SA %s', child_sa)
+                self.rekey_governor.defer(spi)
+                REKEYS_DEFERRED.inc()
+                return None
+            REKEYS.inc('child')
             # Create the ChildSa object with the values we know so far
             new_child_sa = ChildSa(inbound_spi=os.urandom(4), outbound_spi=None, proposal=None, tsi=child_sa.tsi,
-                                   tsr=child_sa.tsr, mode=child_sa.mode, ipsec_conf=child_sa.ipsec_conf)
+                                   tsr=child_sa.tsr, mode=child_sa.mode, ipsec_conf=child_sa.ipsec_conf,
+                                   cpu=child_sa.cpu)
+            if not self._can_send_request():
+                return self._send_window_request(new_child_sa, child_sa)
             request = self.generate_create_child_sa_request(new_child_sa, child_sa)
         # if this is a hard expire, delete the CHILD SA
         else:
@@ -417,12 +784,71 @@ class IkeSa(object):
 
         return self._send_request(request)
 
+    def _acquire_rekey(self, msg_id):
+        """ Returns whether a rekey exchange can be started now with the indicated message ID
+        """
+        return self.rekey_governor is None or self.rekey_governor.acquire(self.my_spi, msg_id)
+
+    def _is_child_sa_idle(self, child_sa, sa_stats=None):
+        """ Returns whether neither of the IPsec SAs of the CHILD_SA have been used for the configured
+            idle_timeout. Stats are taken from the sa_stats dict (SPI => SaStats) if provided, or queried otherwise
+        """
+        idle_timeout = child_sa.ipsec_conf.idle_timeout
+        if not idle_timeout:
+            return False
+        now = time.time()
+        for addr, spi in ((self.peer_addr, child_sa.outbound_spi), (self.my_addr, child_sa.inbound_spi)):
+            if sa_stats is not None:
+                stats = sa_stats.get(spi)
+            else:
+                stats = self.xfrm.get_sa_stats(addr, child_sa.proposal.protocol_id, spi)
+            # in case of doubt, consider the CHILD_SA as active
+            if stats is None or now - max(stats.last_used, stats.add_time) < idle_timeout:
+                return False
+        return True
+
+    def check_idle_child_sas(self, sa_stats):
+        """ Creates an INFORMATIONAL message deleting the first CHILD_SA that has been idle for longer than its
+            configured idle_timeout, according to the sa_stats dict (SPI => SaStats) obtained from the kernel
+        """
+        if not self._can_send_request():
+            return None
+        for child_sa in self.child_sas:
+            if self._is_child_sa_idle(child_sa, sa_stats):
+                self.log_info('CHILD_SA {} has been idle for more than {} seconds. Deleting it'
+                              ''.format(child_sa, child_sa.ipsec_conf.idle_timeout))
+                request = self.generate_delete_child_sa_request(child_sa)
+                return self._send_request(request)
+        return None
+
+    def update_inbound_traffic(self, sa_stats):
+        """ Resets the DPD timer if any of the inbound IPsec SAs has received traffic since the last call, according
+            to the sa_stats dict (SPI => SaStats) obtained from the kernel, as it proves the peer is alive
+        """
+        inbound_bytes = {}
+        for child_sa in self.child_sas:
+            stats = sa_stats.get(child_sa.inbound_spi)
+            if stats is not None:
+                inbound_bytes[child_sa.inbound_spi] = stats.bytes
+        traffic = any(count > self.inbound_bytes.get(spi, 0) for spi, count in inbound_bytes.items())
+        self.inbound_bytes = inbound_bytes
+        if traffic:
+            self.log_debug('Inbound IPsec traffic detected. Postponing DEAD-PEER-DETECTION')
+            self.start_dpd_at = time.time() + self.configuration.dpd
+        return traffic
+
+    def is_dead_peer_detection_due(self):
+        """ Returns whether the DPD timer has expired
+        """
+        # if state is not ESTABLISHED, the retransmission timer will take care of DPD
+        return self.start_dpd_at < time.time() and self._can_send_request()
+
     def check_dead_peer_detection_timer(self):
         """ Creates an empty INFORMATIONAL message for Dead Peer Detection
         """
-        # if state is not ESTABLISHED, the retransmission timer will take care of DPD
-        if self.start_dpd_at < time.time() and self.state == IkeSa.State.ESTABLISHED:
+        if self.is_dead_peer_detection_due():
             self.log_info('Starting DEAD-PEER-DETECTION')
+            DPD_REQUESTS.inc()
             request = self.generate_dead_peer_detection_request()
             return self._send_request(request)
         return None
@@ -430,13 +856,15 @@ class IkeSa(object):
     def check_rekey_ike_sa_timer(self):
         """ Creates an empty INFORMATIONAL message for Dead Peer Detection
         """
-        if self.state == IkeSa.State.ESTABLISHED:
+        # wait for pipelined CHILD_SA negotiations to finish, as the CHILD_SAs are moved to the new IKE_SA
+        if self.state == IkeSa.State.ESTABLISHED and not self.window:
             now = time.time()
             if self.delete_ike_sa_at < now:
                 self.log_info("Received hard expire for IKE_SA")
                 request = self.generate_delete_ike_sa_request()
                 return self._send_request(request)
-            elif self.rekey_ike_sa_at < now:
+            elif self.rekey_ike_sa_at < now and self._acquire_rekey(self.my_msg_id):
+                REKEYS.inc('ike')
                 request = self.generate_rekey_ike_sa_request()
                 return self._send_request(request)
         return None
@@ -467,7 +895,8 @@ class IkeSa(object):
             raise InvalidKePayload('Invalid DH group used. I want {}'.format(my_dh_group), group=my_dh_group)
         dh = DiffieHellman(payload_ke.dh_group)
         dh.compute_secret(payload_ke.ke_data)
-        self.log_debug('Generated DH shared secret: {}'.format(hexstring(dh.shared_secret)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log_debug('Generated DH shared secret: %s', hexstring(dh.shared_secret))
         response_payload_ke = PayloadKE(dh.group, dh.public_key)
 
         # generate IKE SA key material
@@ -499,7 +928,7 @@ class IkeSa(object):
                            is_response=True,
                            can_use_higher_version=False,
                            is_initiator=self.is_initiator,
-                           message_id=self.peer_msg_id,
+                           message_id=request.message_id,
                            payloads=response_payloads,
                            encrypted_payloads=[],
                            crypto=self.my_crypto)
@@ -542,6 +971,13 @@ class IkeSa(object):
         # create the payload VENDOR
         payload_vendor = PayloadVENDOR(b'pyikev2-0.1')
 
+        # indicate we can be redirected, or who redirected us (RFC 5685)
+        if self.redirected_from is None:
+            payload_redirect = PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.REDIRECT_SUPPORTED, b'', b'')
+        else:
+            payload_redirect = PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.REDIRECTED_FROM, b'',
+                                             PayloadNOTIFY.gw_identity_to_bytes(self.redirected_from))
+
         # generate the message
         self.request = Message(spi_i=self.my_spi,
                                spi_r=b'\0' * 8,
@@ -552,7 +988,7 @@ class IkeSa(object):
                                can_use_higher_version=False,
                                is_initiator=self.is_initiator,
                                message_id=self.my_msg_id,
-                               payloads=ike_sa_payloads + [payload_vendor],
+                               payloads=ike_sa_payloads + [payload_redirect, payload_vendor],
                                encrypted_payloads=[],
                                crypto=self.my_crypto)
 
@@ -574,7 +1010,10 @@ class IkeSa(object):
         # check state
         assert (self.state == IkeSa.State.ESTABLISHED)
 
-        self.new_ike_sa = IkeSa(True, b'', self.configuration, self.my_addr, self.peer_addr)
+        self.new_ike_sa = IkeSa(True, b'', self.configuration, self.my_addr, self.peer_addr, self.ticket_manager,
+                                self.rekey_governor)
+        self.new_ike_sa.peer_window_size = self.peer_window_size
+        self.new_ike_sa.redirected_from = self.redirected_from
 
         # generate the IKE SA negotiation payloads
         ike_sa_payloads = self.new_ike_sa._generate_ike_sa_negotiation_request()
@@ -623,6 +1062,12 @@ class IkeSa(object):
         # genereate USE_TRANSPORT_MODE notify if needed
         if child_sa.mode == xfrm.Mode.TRANSPORT:
             result.append(PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.USE_TRANSPORT_MODE, b'', b''))
+
+        # generate SA_RESOURCE_INFO notify (RFC 9611) if per-CPU CHILD_SAs are enabled, including the CPU
+        if child_sa.ipsec_conf.per_cpu_sas:
+            resource_id = pack('>I', child_sa.cpu) if child_sa.cpu is not None else b''
+            result.append(PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.SA_RESOURCE_INFO, b'',
+                                        resource_id))
         return result
 
     def generate_ike_auth_request(self):
@@ -655,7 +1100,10 @@ class IkeSa(object):
                                is_initiator=self.is_initiator,
                                message_id=self.my_msg_id,
                                payloads=[],
-                               encrypted_payloads=child_sa_payloads + [payload_idi, payload_auth],
+                               encrypted_payloads=(child_sa_payloads + [payload_idi, payload_auth]
+                                                   + self._generate_set_window_size()
+                                                   + self._generate_ticket_request()
+                                                   + [self._generate_msg_id_sync_supported()]),
                                crypto=self.my_crypto)
 
         # transition
@@ -684,7 +1132,8 @@ class IkeSa(object):
         # response_payload_sa = PayloadSA([self.chosen_proposal])
 
         self.dh.compute_secret(payload_ke.ke_data)
-        self.log_debug('Generated DH shared secret: {}'.format(hexstring(self.dh.shared_secret)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.log_debug('Generated DH shared secret: %s', hexstring(self.dh.shared_secret))
 
         # generate IKE SA key material
         self.ike_sa_keyring = self.generate_ike_sa_key_material(
@@ -707,6 +1156,25 @@ class IkeSa(object):
         """
         self._check_in_states(response, [IkeSa.State.INIT_REQ_SENT])
 
+        # Start again with the gateway indicated by the responder
+        redirect = response.get_notifies(PayloadNOTIFY.Type.REDIRECT)
+        if redirect:
+            return self._process_redirect(redirect[0])
+
+        # Resend the request with the COOKIE requested by the responder, as the first payload
+        cookie = response.get_notifies(PayloadNOTIFY.Type.COOKIE)
+        if cookie:
+            self.log_info('COOKIE notification received. Resending IKE_SA_INIT request with it')
+            self.request.payloads = [x for x in self.request.payloads
+                                     if not (x.type == Payload.Type.NOTIFY
+                                             and x.notification_type == PayloadNOTIFY.Type.COOKIE)]
+            self.request.payloads.insert(0, PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.COOKIE, b'',
+                                                          cookie[0].notification_data))
+            # the new IKE_SA_INIT request keeps using message ID 0
+            self.my_msg_id = 0
+            self.ike_sa_init_req_data = self.request.to_bytes()
+            return self.request
+
         # Recover from INVALID_KE_PAYLOAD
         invalid_ke = response.get_notifies(PayloadNOTIFY.Type.INVALID_KE_PAYLOAD)
         if invalid_ke:
@@ -720,6 +1188,8 @@ class IkeSa(object):
             payload_ke = self.request.get_payload(Payload.Type.KE)
             payload_ke.dh_group = new_payload_ke.dh_group
             payload_ke.ke_data = new_payload_ke.ke_data
+            # the new IKE_SA_INIT request keeps using message ID 0
+            self.my_msg_id = 0
             self.ike_sa_init_req_data = self.request.to_bytes()
             return self.request
 
@@ -735,10 +1205,173 @@ class IkeSa(object):
         # return IKE_AUTH request callback
         return self.generate_ike_auth_request()
 
+    def _process_redirect(self, notify):
+        """ Processes a REDIRECT notification (RFC 5685) received in a IKE_SA_INIT response, returning a new
+            IKE_SA_INIT request for the indicated gateway
+        """
+        new_gw_addr, nonce = PayloadNOTIFY.parse_gw_identity(notify.notification_data)
+        # the nonce proves the responder has seen our request
+        if nonce != self.request.get_payload(Payload.Type.NONCE).nonce:
+            raise InvalidSyntax('REDIRECT notification with an invalid nonce')
+        if self.redirects >= IkeSa.MAX_REDIRECTS:
+            raise IkeSaError('Too many redirections. Last one to {}'.format(new_gw_addr))
+        self.log_info('Redirected from {} to {}'.format(self.peer_addr, new_gw_addr))
+        self.redirects += 1
+        if self.redirected_from is None:
+            self.redirected_from = self.peer_addr
+        self.peer_addr = new_gw_addr
+        self.my_msg_id = 0
+        self.state = IkeSa.State.INITIAL
+        return self.generate_ike_sa_init_request(self.creating_child_sa)
+
+    def generate_ike_session_resume_request(self, child_sa, ticket):
+        """ Creates a IKE_SESSION_RESUME request message (RFC 5723), presenting a ticket instead of
+            doing a new DH exchange
+        """
+        assert (self.state == IkeSa.State.INITIAL)
+
+        self.request = Message(spi_i=self.my_spi,
+                               spi_r=b'\0' * 8,
+                               major=2,
+                               minor=0,
+                               exchange_type=Message.Exchange.IKE_SESSION_RESUME,
+                               is_response=False,
+                               can_use_higher_version=False,
+                               is_initiator=self.is_initiator,
+                               message_id=self.my_msg_id,
+                               payloads=[PayloadNONCE(),
+                                         PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.TICKET_OPAQUE, b'',
+                                                       ticket.ticket)],
+                               encrypted_payloads=[],
+                               crypto=None)
+
+        # switch state
+        self.state = IkeSa.State.INIT_REQ_SENT
+
+        # save the message for later authentication
+        self.ike_sa_init_req_data = self.request.to_bytes()
+
+        # store the child sa to be used in the IKE_AUTH exchange, and the ticket for the key derivation
+        self.creating_child_sa = child_sa
+        self.resumption_ticket = ticket
+
+        return self.request
+
+    def process_ike_session_resume_request(self, request):
+        """ Processes a IKE_SESSION_RESUME request and returns a IKE_SESSION_RESUME response. The IKE_SA
+            is deleted after sending a N(TICKET_NACK) if the ticket is not valid
+        """
+        self._check_in_states(request, [IkeSa.State.INITIAL])
+
+        payload_nonce = request.get_payload(Payload.Type.NONCE)
+        ticket = request.get_notifies(PayloadNOTIFY.Type.TICKET_OPAQUE)
+        state = None
+        if ticket and self.ticket_manager is not None and self.configuration.resumption:
+            state = self.ticket_manager.decrypt(ticket[0].notification_data, self._ticket_binding())
+
+        if state is None:
+            self.log_warning('Invalid session resumption ticket received')
+            response_payloads = [PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.TICKET_NACK, b'', b'')]
+            self.state = IkeSa.State.DELETED
+        else:
+            sk_d, proposal, self.resumed_peer_id = state
+            # the resumed IKE_SA keeps the algorithms of the old one, as long as they are still acceptable
+            self.chosen_proposal = self._select_best_ike_sa_proposal(PayloadSA([proposal]))
+            response_payload_nonce = PayloadNONCE()
+            self.ike_sa_keyring = self.generate_ike_sa_key_material(ike_proposal=self.chosen_proposal,
+                                                                    nonce_i=payload_nonce.nonce,
+                                                                    nonce_r=response_payload_nonce.nonce,
+                                                                    spi_i=self.peer_spi, spi_r=self.my_spi,
+                                                                    shared_secret=b'Resumption', old_sk_d=sk_d)
+            response_payloads = [response_payload_nonce]
+            self.resumed = True
+            self.state = IkeSa.State.INIT_RES_SENT
+
+        response = Message(spi_i=request.spi_i,
+                           spi_r=self.my_spi,
+                           major=2,
+                           minor=0,
+                           exchange_type=Message.Exchange.IKE_SESSION_RESUME,
+                           is_response=True,
+                           can_use_higher_version=False,
+                           is_initiator=self.is_initiator,
+                           message_id=request.message_id,
+                           payloads=response_payloads,
+                           encrypted_payloads=[],
+                           crypto=None)
+
+        # store messages for later authentication
+        self.ike_sa_init_req_data = request.to_bytes()
+        self.ike_sa_init_res_data = response.to_bytes()
+
+        return response
+
+    def process_ike_session_resume_response(self, response):
+        """ Processes a IKE_SESSION_RESUME response message. Falls back to a regular IKE_SA_INIT
+            if the responder did not accept the ticket
+        """
+        self._check_in_states(response, [IkeSa.State.INIT_REQ_SENT])
+
+        if response.get_notifies(PayloadNOTIFY.Type.TICKET_NACK):
+            self.log_info('Session resumption ticket rejected. Starting a regular IKE_SA_INIT exchange')
+            self.state = IkeSa.State.INITIAL
+            self.my_msg_id = 0
+            self.resumption_ticket = None
+            return self.generate_ike_sa_init_request(self.creating_child_sa)
+
+        # Check error notifications
+        self.abort_on_error_notifies(response)
+
+        # derive the new keys from the SK_d of the resumed IKE_SA
+        self.chosen_proposal = self.resumption_ticket.proposal
+        self.peer_spi = response.spi_r
+        self.ike_sa_keyring = self.generate_ike_sa_key_material(
+            ike_proposal=self.chosen_proposal,
+            nonce_i=self.request.get_payload(Payload.Type.NONCE).nonce,
+            nonce_r=response.get_payload(Payload.Type.NONCE).nonce,
+            spi_i=self.my_spi,
+            spi_r=self.peer_spi,
+            shared_secret=b'Resumption',
+            old_sk_d=self.resumption_ticket.sk_d)
+        self.resumed = True
+        self.resumption_ticket = None
+
+        # save the message for later authentication
+        self.ike_sa_init_res_data = response.to_bytes()
+
+        # return IKE_AUTH request callback
+        return self.generate_ike_auth_request()
+
+    def _generate_ticket_request(self):
+        if self.ticket_manager is None or not self.configuration.resumption:
+            return []
+        return [PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.TICKET_REQUEST, b'', b'')]
+
+    def _ticket_binding(self):
+        # tickets are only valid under the configuration (peer ID and PSK) they were issued with
+        return hashlib.sha256(bytes(self.configuration.peer_id.to_bytes()) + self.configuration.psk).digest()
+
+    def _generate_ticket(self, payload_idi):
+        if self.ticket_manager is None or not self.configuration.resumption:
+            return [PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.TICKET_NACK, b'', b'')]
+        ticket = self.ticket_manager.issue(self.ike_sa_keyring.sk_d, self.chosen_proposal,
+                                           bytes(payload_idi.to_bytes()), self._ticket_binding())
+        return [PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.TICKET_LT_OPAQUE, b'',
+                              pack('>L', self.ticket_manager.TICKET_LIFETIME) + ticket)]
+
+    def _process_ticket(self, message):
+        ticket = message.get_notifies(PayloadNOTIFY.Type.TICKET_LT_OPAQUE, True)
+        if ticket and self.ticket_manager is not None and len(ticket[0].notification_data) > 4:
+            lifetime = unpack('>L', ticket[0].notification_data[:4])[0]
+            self.ticket_manager.store(self.peer_addr, ticket[0].notification_data[4:], lifetime,
+                                      self.ike_sa_keyring.sk_d, self.chosen_proposal)
+            self.log_info('Received session resumption ticket. Lifetime: {}s'.format(lifetime))
+
     def _generate_psk_auth_payload(self, message_data, nonce, payload_id, sk_p):
         prf = self.peer_crypto.prf.prf
         data_to_be_signed = (message_data + nonce + prf(sk_p, payload_id.to_bytes()))
-        keypad = prf(self.configuration.psk, b'Key Pad for IKEv2')
+        # resumed IKE_SAs use SK_pi/SK_pr as the shared secret (RFC 5723 section 5.1)
+        keypad = prf(sk_p if self.resumed else self.configuration.psk, b'Key Pad for IKEv2')
         return prf(keypad, data_to_be_signed)
 
     def _process_create_child_sa_negotiation_req(self, request):
@@ -798,6 +1431,14 @@ class IkeSa(object):
             if ipsec_conf.mode != mode:
                 raise TsUnacceptable('Invalid mode requested')
 
+            # per-resource CHILD_SAs (RFC 9611) are accepted as long as we have resources for them
+            if request.get_notifies(PayloadNOTIFY.Type.SA_RESOURCE_INFO, True) and ipsec_conf.per_cpu_sas:
+                per_cpu_child_sas = [x for x in self.child_sas if x.ipsec_conf.index == ipsec_conf.index]
+                if not rekey_notify and len(per_cpu_child_sas) > (os.cpu_count() or 1):
+                    raise TsMaxQueue('Maximum number of per-CPU CHILD_SAs reached')
+                response_payloads.append(
+                    PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.SA_RESOURCE_INFO, b'', b''))
+
             # generate the response payload SA with the chosen proposal
             chosen_child_proposal = self._select_best_child_sa_proposal(request_payload_sa, ipsec_conf)
 
@@ -810,24 +1451,10 @@ class IkeSa(object):
             # create the IPsec SAs according to the negotiated CHILD SA
             child_sa = ChildSa(outbound_spi=chosen_child_proposal.spi, inbound_spi=os.urandom(4),
                                proposal=chosen_child_proposal, tsi=chosen_tsr, tsr=chosen_tsi, mode=mode,
-                               ipsec_conf=ipsec_conf)
+                               ipsec_conf=ipsec_conf, keyring=child_sa_keyring, exchange_initiator=False)
 
             self.child_sas.append(child_sa)
-            if ipsec_conf.ipsec_proto == Proposal.Protocol.ESP:
-                encr_transform = chosen_child_proposal.get_transform(Transform.Type.ENCR).id
-            else:
-                encr_transform = None
-            lifetime = ipsec_conf.lifetime + random.randint(0, 5) if ipsec_conf.lifetime != -1 else -1
-            self.xfrm.create_sa(self.my_addr, self.peer_addr, chosen_tsr, chosen_tsi,
-                                chosen_child_proposal.protocol_id,
-                                child_sa.outbound_spi, encr_transform, child_sa_keyring.sk_er,
-                                chosen_child_proposal.get_transform(Transform.Type.INTEG).id,
-                                child_sa_keyring.sk_ar, mode, lifetime)
-            self.xfrm.create_sa(self.peer_addr, self.my_addr, chosen_tsi, chosen_tsr,
-                                chosen_child_proposal.protocol_id,
-                                child_sa.inbound_spi, encr_transform, child_sa_keyring.sk_ei,
-                                chosen_child_proposal.get_transform(Transform.Type.INTEG).id,
-                                child_sa_keyring.sk_ai, mode, lifetime)
+            lifetime = self._create_ipsec_sas(child_sa, child_sa_keyring)
             self.log_info('Created CHILD_SA {} with lifetime = {}'.format(child_sa, lifetime))
 
             # generate the response Payload SA
@@ -839,7 +1466,7 @@ class IkeSa(object):
             response_payloads.append(PayloadTSr([chosen_tsr]))
 
             return response_payloads
-        except (TsUnacceptable, NoProposalChosen, ChildSaNotFound, TemporaryFailure) as ex:
+        except (TsUnacceptable, NoProposalChosen, ChildSaNotFound, TemporaryFailure, TsMaxQueue) as ex:
             self.log_warning('CHILD_SA negotiation failed. {}'.format(ex))
             return [PayloadNOTIFY.from_exception(ex)]
         # Generic error happening while negotiating the CHILD_SA should be reported as NO_PROPOSAL_CHOSEN
@@ -847,6 +1474,39 @@ class IkeSa(object):
             self.log_warning('CHILD_SA negotiation failed. {}'.format(ex))
             return [PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.NO_PROPOSAL_CHOSEN, b'', b'')]
 
+    def _create_ipsec_sas(self, child_sa, child_sa_keyring, oseq=0):
+        """ Installs the outbound and inbound IPsec SAs of a negotiated CHILD_SA.
+            child_sa.tsi always refers to our side and child_sa.tsr to the peer's. The "i" keys belong to the
+            initiator of the exchange that created the CHILD_SA (RFC 7296 section 2.17), not of the IKE_SA.
+            Returns the lifetime used for the IPsec SAs
+        """
+        proposal = child_sa.proposal
+        ipsec_conf = child_sa.ipsec_conf
+        encr_transform = None
+        if proposal.protocol_id == Proposal.Protocol.ESP:
+            encr_transform = proposal.get_transform(Transform.Type.ENCR).id
+        integ_transform = proposal.get_transform(Transform.Type.INTEG).id
+        esn = any(x.id == Transform.EsnId.ESN for x in proposal.get_transforms(Transform.Type.ESN))
+        if child_sa.exchange_initiator:
+            out_sk_e, out_sk_a, in_sk_e, in_sk_a = (child_sa_keyring.sk_ei, child_sa_keyring.sk_ai,
+                                                    child_sa_keyring.sk_er, child_sa_keyring.sk_ar)
+        else:
+            out_sk_e, out_sk_a, in_sk_e, in_sk_a = (child_sa_keyring.sk_er, child_sa_keyring.sk_ar,
+                                                    child_sa_keyring.sk_ei, child_sa_keyring.sk_ai)
+        lifetime = int(RekeyGovernor.jittered(ipsec_conf.lifetime)) if ipsec_conf.lifetime != -1 else -1
+        self.xfrm.create_sa(self.my_addr, self.peer_addr, child_sa.tsi, child_sa.tsr, proposal.protocol_id,
+                            child_sa.outbound_spi, encr_transform, out_sk_e, integ_transform, out_sk_a,
+                            child_sa.mode, lifetime, if_id=ipsec_conf.if_id, mark=ipsec_conf.mark,
+                            replay_window=ipsec_conf.replay_window, esn=esn, cpu=child_sa.cpu,
+                            lifetime_bytes=ipsec_conf.lifetime_bytes, lifetime_packets=ipsec_conf.lifetime_packets,
+                            oseq=oseq)
+        self.xfrm.create_sa(self.peer_addr, self.my_addr, child_sa.tsr, child_sa.tsi, proposal.protocol_id,
+                            child_sa.inbound_spi, encr_transform, in_sk_e, integ_transform, in_sk_a,
+                            child_sa.mode, lifetime, if_id=ipsec_conf.if_id, mark=ipsec_conf.mark,
+                            replay_window=ipsec_conf.replay_window, esn=esn,
+                            lifetime_bytes=ipsec_conf.lifetime_bytes, lifetime_packets=ipsec_conf.lifetime_packets)
+        return lifetime
+
     def _check_in_states(self, message, list_of_valid_states):
         if self.state not in list_of_valid_states:
             raise IkeSaStateError(
@@ -867,15 +1527,168 @@ class IkeSa(object):
             if self.retransmit_at < time.time():
                 if self.retransmissions >= IkeSa.MAX_RETRANSMISSIONS:
                     self.log_warning('Done retransmitting last request. Unilaterally closing the IKE_SA')
+                    RETRANSMISSION_TIMEOUTS.inc()
                     self.state = IkeSa.State.DELETED
                     return None
                 self.retransmissions += 1
+                RETRANSMISSIONS.inc()
                 self.retransmit_at = self.retransmit_at + self.retransmissions * IkeSa.RETRANSMISSION_DELAY
                 ordinal = lambda n: "%d%s" % (n, "tsnrhtdd"[(n / 10 % 10 != 1) * (n % 10 < 4) * n % 10::4])
                 self.log_info('Retransmitting last request for {} time'.format(ordinal(self.retransmissions)))
                 return self.request.to_bytes()
         return None
 
+    def check_window_retransmission_timers(self):
+        """ Returns the list of pipelined requests that need to be retransmitted
+        """
+        result = []
+        now = time.time()
+        for msg_id, window_request in list(self.window.items()):
+            if window_request.retransmit_at < now:
+                if window_request.retransmissions >= IkeSa.MAX_RETRANSMISSIONS:
+                    self.log_warning('Done retransmitting pipelined request. Unilaterally closing the IKE_SA')
+                    RETRANSMISSION_TIMEOUTS.inc()
+                    self.state = IkeSa.State.DELETED
+                    return []
+                retransmissions = window_request.retransmissions + 1
+                RETRANSMISSIONS.inc()
+                self.window[msg_id] = window_request._replace(
+                    retransmissions=retransmissions,
+                    retransmit_at=window_request.retransmit_at + retransmissions * IkeSa.RETRANSMISSION_DELAY)
+                self.log_info('Retransmitting pipelined request with message ID {}'.format(msg_id))
+                result.append(window_request.request.to_bytes())
+        return result
+
+    def _process_set_window_size(self, message):
+        notify = message.get_notifies(PayloadNOTIFY.Type.SET_WINDOW_SIZE, True)
+        if notify and len(notify[0].notification_data) == 4:
+            self.peer_window_size = max(1, unpack('>I', notify[0].notification_data)[0])
+            self.log_info('Peer window size is {}'.format(self.peer_window_size))
+
+    def _generate_set_window_size(self):
+        if self.configuration.window_size > 1:
+            return [PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.SET_WINDOW_SIZE, b'',
+                                  pack('>I', self.configuration.window_size))]
+        return []
+
+    def _generate_msg_id_sync_supported(self):
+        return PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.IKEV2_MESSAGE_ID_SYNC_SUPPORTED, b'', b'')
+
+    def _process_msg_id_sync_supported(self, message):
+        self.msg_id_sync = bool(message.get_notifies(PayloadNOTIFY.Type.IKEV2_MESSAGE_ID_SYNC_SUPPORTED, True))
+
+    def _generate_msg_id_sync_notify(self, nonce):
+        """ Generates a IKEV2_MESSAGE_ID_SYNC notification: Nonce | EXPECTED_SEND_REQ_MESSAGE_ID |
+            EXPECTED_RECV_REQ_MESSAGE_ID
+        """
+        return PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.IKEV2_MESSAGE_ID_SYNC, b'',
+                             pack('>4sLL', nonce, self.my_msg_id, self.peer_msg_id))
+
+    def _sync_msg_ids(self, notify):
+        """ Updates our message IDs with the ones indicated in a IKEV2_MESSAGE_ID_SYNC notification, keeping
+            the highest ones. Returns the nonce of the notification
+        """
+        try:
+            nonce, peer_send_msg_id, peer_recv_msg_id = unpack('>4sLL', notify.notification_data)
+        except struct_error:
+            raise InvalidSyntax('Invalid IKEV2_MESSAGE_ID_SYNC notification')
+        self.my_msg_id = max(self.my_msg_id, peer_recv_msg_id)
+        self.peer_msg_id = max(self.peer_msg_id, peer_send_msg_id)
+        # cached responses refer to message IDs used before the synchronisation
+        self.response_cache.clear()
+        self.processed_msg_ids.clear()
+        return nonce
+
+    def take_over(self, oseqs=None):
+        """ Takes over an IKE_SA replicated from another cluster member: installs the IPsec SAs of its
+            CHILD_SAs, with outbound sequence numbers starting at the indicated values (indexed by
+            outbound SPI), and returns a IKEV2_MESSAGE_ID_SYNC request if supported by the peer
+        """
+        for child_sa in self.child_sas:
+            if child_sa.keyring is None:
+                self.log_warning('No keys for CHILD_SA {}. Cannot install it'.format(child_sa))
+                continue
+            self._create_ipsec_sas(child_sa, child_sa.keyring, oseq=(oseqs or {}).get(child_sa.outbound_spi, 0))
+        return self.sync_message_ids()
+
+    def sync_message_ids(self):
+        """ Returns a IKEV2_MESSAGE_ID_SYNC request if supported by the peer, for restored IKE_SAs whose
+            message IDs might be stale
+        """
+        if not self.msg_id_sync:
+            return None
+        return self._send_request(self.generate_msg_id_sync_request())
+
+    def generate_msg_id_sync_request(self):
+        """ Creates a IKEV2_MESSAGE_ID_SYNC INFORMATIONAL request (RFC 6311), jumping our message IDs
+            ahead of those the previous active cluster member might have used
+        """
+        assert (self.state == IkeSa.State.ESTABLISHED)
+        self.my_msg_id += IkeSa.MSG_ID_JUMP
+        self.peer_msg_id += IkeSa.MSG_ID_JUMP
+        self.response_cache.clear()
+        self.processed_msg_ids.clear()
+        self.msg_id_sync_nonce = os.urandom(4)
+        self.request = Message(spi_i=self.spi_i,
+                               spi_r=self.spi_r,
+                               major=2,
+                               minor=0,
+                               exchange_type=Message.Exchange.INFORMATIONAL,
+                               is_response=False,
+                               can_use_higher_version=False,
+                               is_initiator=self.is_initiator,
+                               message_id=0,
+                               payloads=[],
+                               encrypted_payloads=[self._generate_msg_id_sync_notify(self.msg_id_sync_nonce)],
+                               crypto=self.my_crypto)
+        self.state = IkeSa.State.MSG_ID_SYNC_REQ_SENT
+        return self.request
+
+    def process_msg_id_sync_request(self, request):
+        """ Processes a IKEV2_MESSAGE_ID_SYNC request and returns the response data, or None if the request
+            cannot be accepted now
+        """
+        if not self.msg_id_sync or self.state not in range(IkeSa.State.ESTABLISHED, IkeSa.State.REKEYED):
+            self.log_warning('Unexpected IKEV2_MESSAGE_ID_SYNC request. Omitting.')
+            return None
+        try:
+            nonce = self._sync_msg_ids(request.get_notifies(PayloadNOTIFY.Type.IKEV2_MESSAGE_ID_SYNC, True)[0])
+        except InvalidSyntax as ex:
+            self.log_error(str(ex))
+            return None
+        self.log_info('Message IDs synchronised. Next request: {}. Next expected request: {}'
+                      ''.format(self.my_msg_id, self.peer_msg_id))
+        response = Message(spi_i=request.spi_i,
+                           spi_r=request.spi_r,
+                           major=2,
+                           minor=0,
+                           exchange_type=Message.Exchange.INFORMATIONAL,
+                           is_response=True,
+                           can_use_higher_version=False,
+                           is_initiator=self.is_initiator,
+                           message_id=0,
+                           payloads=[],
+                           encrypted_payloads=[self._generate_msg_id_sync_notify(nonce)],
+                           crypto=self.my_crypto)
+        response_data = response.to_bytes()
+        self.log_message(response, response_data, send=True)
+        return response_data
+
+    def process_msg_id_sync_response(self, response):
+        notify = response.get_notifies(PayloadNOTIFY.Type.IKEV2_MESSAGE_ID_SYNC, True)
+        if not notify or notify[0].notification_data[:4] != self.msg_id_sync_nonce:
+            self.log_warning('Invalid IKEV2_MESSAGE_ID_SYNC response. Omitting.')
+            return
+        try:
+            self._sync_msg_ids(notify[0])
+        except InvalidSyntax as ex:
+            self.log_error(str(ex))
+            return
+        self.log_info('Message IDs synchronised. Next request: {}. Next expected request: {}'
+                      ''.format(self.my_msg_id, self.peer_msg_id))
+        self.msg_id_sync_nonce = None
+        self.state = IkeSa.State.ESTABLISHED
+
     def process_ike_auth_request(self, request):
         """ Processes a IKE_AUTH request message and returns a
             IKE_AUTH response
@@ -900,6 +1713,10 @@ class IkeSa(object):
         if auth_data != request_payload_auth.auth_data:
             raise AuthenticationFailed('Invalid AUTH data received')
 
+        # a resumed IKE_SA can only be used by the identity the ticket was issued to (RFC 5723 section 5.1)
+        if self.resumed and bytes(request_payload_idi.to_bytes()) != self.resumed_peer_id:
+            raise AuthenticationFailed('IDi does not match the one of the session resumption ticket')
+
         # process the CHILD_SA creation negotiation
         response_payloads = self._process_create_child_sa_negotiation_req(request)
 
@@ -915,6 +1732,18 @@ class IkeSa(object):
 
         response_payloads += [response_payload_idr, response_payload_auth]
 
+        # negotiate the window size
+        self._process_set_window_size(request)
+        response_payloads += self._generate_set_window_size()
+
+        # issue a session resumption ticket if requested
+        if request.get_notifies(PayloadNOTIFY.Type.TICKET_REQUEST, True):
+            response_payloads += self._generate_ticket(request_payload_idi)
+
+        # both peers support the message ID synchronisation for HA clusters
+        self._process_msg_id_sync_supported(request)
+        response_payloads.append(self._generate_msg_id_sync_supported())
+
         # generate the message
         response = Message(spi_i=request.spi_i,
                            spi_r=request.spi_r,
@@ -924,7 +1753,7 @@ class IkeSa(object):
                            is_response=True,
                            can_use_higher_version=False,
                            is_initiator=self.is_initiator,
-                           message_id=self.peer_msg_id,
+                           message_id=request.message_id,
                            payloads=[],
                            encrypted_payloads=response_payloads,
                            crypto=self.my_crypto)
@@ -934,9 +1763,12 @@ class IkeSa(object):
 
         return response
 
-    def _process_create_child_sa_negotiation_res(self, response):
+    def _process_create_child_sa_negotiation_res(self, response, request=None, creating_child_sa=None):
+        if request is None:
+            request, creating_child_sa = self.request, self.creating_child_sa
         for error in (PayloadNOTIFY.Type.NO_PROPOSAL_CHOSEN, PayloadNOTIFY.Type.TS_UNACCEPTABLE,
-                      PayloadNOTIFY.Type.CHILD_SA_NOT_FOUND, PayloadNOTIFY.Type.TEMPORARY_FAILURE):
+                      PayloadNOTIFY.Type.CHILD_SA_NOT_FOUND, PayloadNOTIFY.Type.TEMPORARY_FAILURE,
+                      PayloadNOTIFY.Type.TS_MAX_QUEUE):
             if response.get_notifies(error, True):
                 raise IkeSaError('CHILD_SA negotiation failed because {}. Skipping creation of CHILD_SA.'.format(
                     PayloadNOTIFY.Type.safe_name(error)))
@@ -948,10 +1780,10 @@ class IkeSa(object):
         response_transport_mode = response.get_notifies(PayloadNOTIFY.Type.USE_TRANSPORT_MODE, True)
 
         # recover some relevant payloads from the request
-        request_payload_sa = self.request.get_payload(Payload.Type.SA, True)
-        request_payload_tsi = self.request.get_payload(Payload.Type.TSi, True)
-        request_payload_tsr = self.request.get_payload(Payload.Type.TSr, True)
-        request_transport_mode = self.request.get_notifies(PayloadNOTIFY.Type.USE_TRANSPORT_MODE, True)
+        request_payload_sa = request.get_payload(Payload.Type.SA, True)
+        request_payload_tsi = request.get_payload(Payload.Type.TSi, True)
+        request_payload_tsr = request.get_payload(Payload.Type.TSr, True)
+        request_transport_mode = request.get_notifies(PayloadNOTIFY.Type.USE_TRANSPORT_MODE, True)
 
         # source of nonces is different for the initial exchange
         if response.exchange_type == Message.Exchange.IKE_AUTH:
@@ -961,7 +1793,7 @@ class IkeSa(object):
             request_payload_nonce = ike_sa_init_req.get_payload(Payload.Type.NONCE)
             response_payload_nonce = ike_sa_init_res.get_payload(Payload.Type.NONCE)
         else:
-            request_payload_nonce = self.request.get_payload(Payload.Type.NONCE, True)
+            request_payload_nonce = request.get_payload(Payload.Type.NONCE, True)
             response_payload_nonce = response.get_payload(Payload.Type.NONCE, True)
 
         # check mode is consistent
@@ -974,8 +1806,10 @@ class IkeSa(object):
         chosen_child_proposal = response_payload_sa.proposals[0]
         my_proposal = request_payload_sa.proposals[0]
         intersection = my_proposal.intersection(chosen_child_proposal)
-        if intersection != chosen_child_proposal:
+        if intersection is None or set(chosen_child_proposal.transforms) - set(intersection.transforms):
             raise NoProposalChosen('Responder did not choose a valid proposal')
+        # the intersection includes the transforms the responder may omit (i.e. NO_ESN)
+        chosen_child_proposal = intersection
 
         # generate CHILD key material
         child_sa_keyring = self.generate_child_sa_key_material(child_proposal=chosen_child_proposal,
@@ -992,26 +1826,15 @@ class IkeSa(object):
             raise TsUnacceptable('Responder did not select a subset of our proposed TS.')
 
         # recover ipsec configuration from Acquire's Index
-        ipsec_conf = self.creating_child_sa.ipsec_conf
+        ipsec_conf = creating_child_sa.ipsec_conf
 
         # create the IPsec SAs according to the negotiated CHILD SA
         child_sa = ChildSa(outbound_spi=chosen_child_proposal.spi, inbound_spi=request_payload_sa.proposals[0].spi,
                            proposal=chosen_child_proposal, tsi=chosen_tsi, tsr=chosen_tsr, mode=request_mode,
-                           ipsec_conf=ipsec_conf)
+                           ipsec_conf=ipsec_conf, cpu=creating_child_sa.cpu, keyring=child_sa_keyring,
+                           exchange_initiator=True)
         self.child_sas.append(child_sa)
-
-        encr_transform = None
-        if chosen_child_proposal.protocol_id == Proposal.Protocol.ESP:
-            encr_transform = chosen_child_proposal.get_transform(Transform.Type.ENCR).id
-        lifetime = ipsec_conf.lifetime + random.randint(0, 5) if ipsec_conf.lifetime != -1 else -1
-        self.xfrm.create_sa(self.my_addr, self.peer_addr, chosen_tsi, chosen_tsr, chosen_child_proposal.protocol_id,
-                            child_sa.outbound_spi, encr_transform, child_sa_keyring.sk_ei,
-                            chosen_child_proposal.get_transform(Transform.Type.INTEG).id,
-                            child_sa_keyring.sk_ai, request_mode, lifetime)
-        self.xfrm.create_sa(self.peer_addr, self.my_addr, chosen_tsr, chosen_tsi, chosen_child_proposal.protocol_id,
-                            child_sa.inbound_spi, encr_transform, child_sa_keyring.sk_er,
-                            chosen_child_proposal.get_transform(Transform.Type.INTEG).id,
-                            child_sa_keyring.sk_ar, request_mode, lifetime)
+        self._create_ipsec_sas(child_sa, child_sa_keyring)
         self.log_info('Created CHILD_SA {}'.format(child_sa))
 
     def process_ike_auth_response(self, response):
@@ -1037,6 +1860,10 @@ class IkeSa(object):
         if auth_data != response_payload_auth.auth_data:
             raise AuthenticationFailed('Invalid AUTH data received')
 
+        self._process_set_window_size(response)
+        self._process_ticket(response)
+        self._process_msg_id_sync_supported(response)
+
         # process the CHILD_SA creation negotiation
         try:
             self._process_create_child_sa_negotiation_res(response)
@@ -1046,18 +1873,10 @@ class IkeSa(object):
         self.state = IkeSa.State.ESTABLISHED
         return None
 
-    def generate_create_child_sa_request(self, child_sa, rekeyed_child_sa=None):
-        """ Creates a CREATE_CHILD_SA request message for creating a new CHILD or rekeying an existing one
-        """
-        assert (self.state == IkeSa.State.ESTABLISHED)
-
-        # preserve the acquire for the response
-        self.creating_child_sa = child_sa
-
+    def _generate_create_child_sa_message(self, child_sa, rekeyed_child_sa, message_id):
         # generate the CHILD_SA negotiation payloads
         child_sa_payloads = self._generate_child_sa_negotiation_req(child_sa)
         if rekeyed_child_sa is not None:
-            self.rekeying_child_sa = rekeyed_child_sa
             child_sa_payloads.append(PayloadNOTIFY(rekeyed_child_sa.proposal.protocol_id, PayloadNOTIFY.Type.REKEY_SA,
                                                    rekeyed_child_sa.inbound_spi, b''))
 
@@ -1065,18 +1884,30 @@ class IkeSa(object):
         payload_nonce = PayloadNONCE()
 
         # generate the message
-        self.request = Message(spi_i=self.spi_i,
-                               spi_r=self.spi_r,
-                               major=2,
-                               minor=0,
-                               exchange_type=Message.Exchange.CREATE_CHILD_SA,
-                               is_response=False,
-                               can_use_higher_version=False,
-                               is_initiator=self.is_initiator,
-                               message_id=self.my_msg_id,
-                               payloads=[],
-                               encrypted_payloads=child_sa_payloads + [payload_nonce],
-                               crypto=self.my_crypto)
+        return Message(spi_i=self.spi_i,
+                       spi_r=self.spi_r,
+                       major=2,
+                       minor=0,
+                       exchange_type=Message.Exchange.CREATE_CHILD_SA,
+                       is_response=False,
+                       can_use_higher_version=False,
+                       is_initiator=self.is_initiator,
+                       message_id=message_id,
+                       payloads=[],
+                       encrypted_payloads=child_sa_payloads + [payload_nonce],
+                       crypto=self.my_crypto)
+
+    def generate_create_child_sa_request(self, child_sa, rekeyed_child_sa=None):
+        """ Creates a CREATE_CHILD_SA request message for creating a new CHILD or rekeying an existing one
+        """
+        assert (self.state == IkeSa.State.ESTABLISHED)
+
+        # preserve the acquire for the response
+        self.creating_child_sa = child_sa
+        if rekeyed_child_sa is not None:
+            self.rekeying_child_sa = rekeyed_child_sa
+
+        self.request = self._generate_create_child_sa_message(child_sa, rekeyed_child_sa, self.my_msg_id)
 
         # transition
         self.state = (IkeSa.State.NEW_CHILD_REQ_SENT if rekeyed_child_sa is None
@@ -1146,7 +1977,7 @@ class IkeSa(object):
                        is_response=True,
                        can_use_higher_version=False,
                        is_initiator=self.is_initiator,
-                       message_id=self.peer_msg_id,
+                       message_id=request.message_id,
                        payloads=[],
                        encrypted_payloads=response_payloads,
                        crypto=self.my_crypto)
@@ -1167,7 +1998,10 @@ class IkeSa(object):
                 self.log_warning('Cannot process IKE_SA rekeying while doing anything else. Sending TEMPORARY_FAILURE')
                 response_payloads = [PayloadNOTIFY.from_exception(TemporaryFailure())]
             else:
-                self.new_ike_sa = IkeSa(False, proposal.spi, self.configuration, self.my_addr, self.peer_addr)
+                self.new_ike_sa = IkeSa(False, proposal.spi, self.configuration, self.my_addr, self.peer_addr,
+                                        self.ticket_manager, self.rekey_governor)
+                self.new_ike_sa.peer_window_size = self.peer_window_size
+                self.new_ike_sa.redirected_from = self.redirected_from
                 # take over the existing child sas
                 self.new_ike_sa.child_sas = self.child_sas
                 self.child_sas = []
@@ -1187,7 +2021,7 @@ class IkeSa(object):
                        is_response=True,
                        can_use_higher_version=False,
                        is_initiator=self.is_initiator,
-                       message_id=self.peer_msg_id,
+                       message_id=request.message_id,
                        payloads=[],
                        encrypted_payloads=response_payloads,
                        crypto=self.my_crypto)
@@ -1207,7 +2041,8 @@ class IkeSa(object):
                                                              PayloadNOTIFY.Type.NO_PROPOSAL_CHOSEN,
                                                              PayloadNOTIFY.Type.CHILD_SA_NOT_FOUND,
                                                              PayloadNOTIFY.Type.TEMPORARY_FAILURE,
-                                                             PayloadNOTIFY.Type.INVALID_KE_PAYLOAD])
+                                                             PayloadNOTIFY.Type.INVALID_KE_PAYLOAD,
+                                                             PayloadNOTIFY.Type.TS_MAX_QUEUE])
 
         # IKE_SA rekey response
         if self.state == IkeSa.State.REK_IKE_SA_REQ_SENT:
@@ -1328,25 +2163,268 @@ class IkeSa(object):
 
 
 class IkeSaController:
-    def __init__(self, my_addr, configuration):
+    # Seconds between consecutive SAD statistics polls
+    SAD_POLL_INTERVAL = 10
+
+    # Number of half-open IKE_SAs from which COOKIEs are required to initiators
+    COOKIE_THRESHOLD = 50
+
+    # Seconds a half-open IKE_SA is kept before being discarded
+    HALF_OPEN_TIMEOUT = 30
+
+    # Maximum number of datagrams read from the socket and dispatched per main loop iteration
+    MAX_READS_PER_LOOP = 256
+    MAX_DISPATCH_PER_LOOP = 64
+
+    # Load from which new initiators are redirected (RFC 5685) to the gateways configured for them: number of
+    # half-open IKE_SAs, number of established IKE_SAs and 1-minute load average per CPU
+    REDIRECT_HALF_OPEN_THRESHOLD = 1000
+    REDIRECT_ESTABLISHED_THRESHOLD = 10000
+    REDIRECT_LOAD_THRESHOLD = 0.9
+
+    # Peers with auto_start brought up per second (and burst), and seconds before bringing them up again after
+    # their IKE_SA is gone
+    AUTO_START_RATE = 10
+    AUTO_START_BURST = 20
+    AUTO_START_RETRY_DELAY = 30
+
+    # Increment applied to the replicated outbound sequence numbers on HA takeover, to stay ahead of the packets
+    # sent by the previous active member since its last SAD poll
+    HA_OSEQ_JUMP = 1 << 24
+
+    def __init__(self, my_addr, configuration, state_file=None, snapshot_interval=0, ha_role=None, ha_addr=None,
+                 ha_key=None, capture_file=None, capture_decrypted=False, metrics_addr=None):
         print('cannot break?')  # bp
         self.ike_sas = []
+        self.ike_sas_by_spi = {}
+        self.admission = AdmissionScheduler(self._is_known_spi)
         self.configuration = configuration
         self.xfrm = xfrm.Xfrm()
         self.my_addr = my_addr
-
-        # establish policies
+        self.check_sad_at = time.time() + self.SAD_POLL_INTERVAL
+        self.sad_size = 0
+        self.child_sa_count = 0
+        self.idle_child_sas_deleted = 0
+        self.cookie_generator = CookieGenerator()
+        self.ticket_manager = TicketManager()
+        self.rekey_governor = RekeyGovernor()
+        # half-open IKE_SAs (i.e. responders waiting for IKE_AUTH), indexed by (peer address, SPIi)
+        self.half_open_sas = {}
+        # snapshot of the established IKE_SAs, saved on exit (and periodically) for warm restarts
+        self.state_file = state_file
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_at = time.time() + snapshot_interval
+        # HA state replication. The active member keeps what has been replicated of each IKE_SA, indexed by SPI,
+        # the IKE_SAs changed since then and the SPIs of those deleted
+        self.ha_sender = ha.HaSender(ha_addr, ha_key, self._ha_full_state) if ha_role == 'active' else None
+        self.ha_receiver = ha.HaReceiver(ha_addr, ha_key) if ha_role == 'standby' else None
+        self.ha_replicated = {}
+        self.ha_changed = set()
+        self.ha_deleted = []
+        # initiators redirected to each gateway (RFC 5685), and requests to be sent to the gateways we are redirected to
+        self.redirections = Counter()
+        self.redirected_requests = []
+        # IKEV2_MESSAGE_ID_SYNC requests of the IKE_SAs restored from a periodic snapshot
+        self.restored_requests = []
+        # peers with auto_start waiting to be brought up, mapped to the time from which they can be (in order)
+        self.auto_start_bucket = TokenBucket(self.AUTO_START_RATE, self.AUTO_START_BURST)
+        self.auto_start_pending = {peer_addr: 0 for peer_addr, ike_conf in configuration.items() if ike_conf.auto_start}
+        # peers with policies installed. Those configured by network get them once authenticated, and lose them
+        # along with their last IKE_SA
+        self.policy_peers = set()
+        # packet capture, toggled at runtime (e.g. on SIGUSR1) through request_capture_toggle()
+        self.capture_file = capture_file
+        self.capture_decrypted = capture_decrypted
+        self.capture_toggle_requested = False
+        # Prometheus metrics exporter, served from the main loop
+        self.metrics_server = MetricsServer(metrics_addr, on_scrape=self.update_metrics) if metrics_addr else None
+
+        # establish policies. The IPsec SAs are kept if the IKE_SAs they belong to can be restored
         self.xfrm.flush_policies()
-        self.xfrm.flush_sas()
+        if not self.restore_snapshot():
+            self.xfrm.flush_sas()
         for peer_addr, ike_conf in configuration.items():
-            self.xfrm.create_policies(my_addr, peer_addr, ike_conf)
+            self._create_policies(peer_addr, ike_conf)
         print('cannot break?')
 
+    def update_metrics(self):
+        """ Updates the gauges, which are only needed when the metrics are exported
+        """
+        IKE_SAS.clear()
+        for state, count in Counter(x.state for x in self.ike_sas).items():
+            IKE_SAS.set(count, IkeSa.State.safe_name(state))
+        HALF_OPEN_IKE_SAS.set(len(self.half_open_sas))
+        CHILD_SAS.set(sum(len(x.child_sas) for x in self.ike_sas))
+
+    def request_capture_toggle(self):
+        """ Requests the capture to be started or stopped. It is safe to call from a signal handler, as it
+            is toggled by the main loop
+        """
+        self.capture_toggle_requested = True
+
+    def toggle_capture(self):
+        if capture.active() is not None:
+            logging.info('Stopped capture to {} ({} packets)'.format(self.capture_file, capture.active().packets))
+            capture.stop()
+        elif self.capture_file:
+            try:
+                capture.start(self.capture_file, self.capture_decrypted)
+            except OSError as ex:
+                logging.error('Could not start capture to {}: {}'.format(self.capture_file, ex))
+                return
+            # IKE_SAs established before the capture started would not be decryptable otherwise
+            for ike_sa in self.ike_sas:
+                ike_sa.capture_keys()
+            logging.info('Started capture to {}'.format(self.capture_file))
+        else:
+            logging.warning('No capture file has been configured')
+
+    def check_capture_toggle(self):
+        if self.capture_toggle_requested:
+            self.capture_toggle_requested = False
+            self.toggle_capture()
+
+    def _sendto(self, sock, data, addr):
+        active_capture = capture.active()
+        if active_capture is not None:
+            active_capture.write_datagram(data, sock.getsockname(), addr)
+        sock.sendto(data, addr)
+
+    def _create_policies(self, peer_addr, ike_conf):
+        if peer_addr not in self.policy_peers:
+            self.xfrm.create_policies(self.my_addr, peer_addr, ike_conf,
+                                      per_peer=not self.configuration.has_peer(peer_addr))
+            self.policy_peers.add(peer_addr)
+
+    def _delete_policies(self, peer_addr, ike_conf):
+        # the policies of exact peers are kept, as they trigger the ACQUIREs that bring them up again
+        if peer_addr in self.policy_peers and not self.configuration.has_peer(peer_addr):
+            self.xfrm.delete_policies(self.my_addr, peer_addr, ike_conf, per_peer=True)
+            self.policy_peers.remove(peer_addr)
+
+    def restore_snapshot(self):
+        """ Rehydrates the IKE_SAs from the state file, adopting the IPsec SAs still present in the kernel.
+            Returns whether the snapshot could be restored
+        """
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return False
+        try:
+            state = snapshot.load(self.state_file)
+        except SnapshotError as ex:
+            logging.warning('Could not restore the snapshot {}: {}'.format(self.state_file, ex))
+            return False
+        kernel_spis = self.xfrm.get_all_sa_stats()
+        for ike_sa_snapshot in state.ike_sas:
+            if ike_sa_snapshot.delete_ike_sa_at < time.time():
+                continue
+            # the message IDs of periodic snapshots may be behind those used since, so they are only
+            # usable if they can be synchronised with the peer (RFC 6311)
+            if not state.clean and not ike_sa_snapshot.msg_id_sync:
+                continue
+            try:
+                ike_conf = self.configuration.get_ike_configuration(ike_sa_snapshot.peer_addr)
+            except ConfigurationNotFound:
+                continue
+            ike_sa = IkeSa.from_snapshot(ike_sa_snapshot, ike_conf, self.ticket_manager, self.rekey_governor)
+            self._create_policies(ike_sa.peer_addr, ike_conf)
+            # CHILD_SAs whose IPsec SAs are gone (e.g. expired) are forgotten
+            ike_sa.child_sas = [x for x in ike_sa.child_sas
+                                if x.inbound_spi in kernel_spis and x.outbound_spi in kernel_spis]
+            self._add_ike_sa(ike_sa)
+            if not state.clean:
+                self.restored_requests.append((ike_sa.sync_message_ids(), (str(ike_sa.peer_addr), 500)))
+        # IPsec SAs not adopted by any restored CHILD_SA would never be used nor deleted otherwise
+        self.xfrm.delete_sas_except({spi for ike_sa in self.ike_sas for child_sa in ike_sa.child_sas
+                                     for spi in (child_sa.inbound_spi, child_sa.outbound_spi)})
+        logging.info('Restored {} IKE_SAs and {} CHILD_SAs from {}'.format(
+            len(self.ike_sas), sum(len(x.child_sas) for x in self.ike_sas), self.state_file))
+        return True
+
+    def save_snapshot(self, clean=False):
+        """ Writes the snapshot of the established IKE_SAs into the state file. clean indicates that it is
+            written on exit, so no message will be exchanged after it
+        """
+        ike_sa_snapshots = [x for x in (ike_sa.to_snapshot() for ike_sa in self.ike_sas) if x is not None]
+        try:
+            snapshot.save(self.state_file, ike_sa_snapshots, clean)
+        except OSError as ex:
+            logging.error('Could not write the snapshot {}: {}'.format(self.state_file, ex))
+            return
+        logging.debug('Saved {} IKE_SAs into {}'.format(len(ike_sa_snapshots), self.state_file))
+
+    def check_snapshot_timer(self):
+        if self.state_file and self.snapshot_interval and self.snapshot_at < time.time():
+            self.snapshot_at = time.time() + self.snapshot_interval
+            self.save_snapshot()
+
+    def _ha_events(self):
+        """ Returns the HA events describing the changes in the IKE_SAs since the last time they were replicated
+        """
+        events = [ha.delete_event(spi) for spi in self.ha_deleted]
+        self.ha_deleted.clear()
+        for ike_sa in self.ha_changed:
+            # IKE_SAs in the middle of an exchange are replicated once it finishes (i.e. when changed again)
+            ike_sa_snapshot = ike_sa.to_snapshot()
+            if ike_sa_snapshot is None:
+                continue
+            child_sa_spis = tuple(x.inbound_spi for x in ike_sa.child_sas)
+            replicated = (child_sa_spis, ike_sa.my_msg_id, ike_sa.peer_msg_id)
+            previous = self.ha_replicated.get(ike_sa.my_spi)
+            if previous is None or previous[0] != child_sa_spis:
+                events.append(ha.upsert_event(ike_sa_snapshot))
+            elif previous != replicated:
+                events.append(ha.msg_id_event(ike_sa))
+            self.ha_replicated[ike_sa.my_spi] = replicated
+        self.ha_changed.clear()
+        return events
+
+    def _ha_full_state(self):
+        self.ha_replicated.clear()
+        self.ha_deleted.clear()
+        self.ha_changed.update(self.ike_sas)
+        return self._ha_events()
+
+    def replicate(self):
+        """ Streams the changes in the IKE_SAs to the HA standby member
+        """
+        if self.ha_sender is None:
+            return
+        for event_type, data in self._ha_events():
+            self.ha_sender.send(event_type, data)
+        self.ha_sender.flush()
+
+    def take_over(self):
+        """ Becomes the active member, taking over the IKE_SAs replicated from the previous one.
+            Returns a list of (request_data, addr) tuples to be sent
+        """
+        requests = []
+        for ike_sa_snapshot in self.ha_receiver.ike_sas.values():
+            try:
+                ike_conf = self.configuration.get_ike_configuration(ike_sa_snapshot.peer_addr)
+            except ConfigurationNotFound:
+                continue
+            ike_sa = IkeSa.from_snapshot(ike_sa_snapshot, ike_conf, self.ticket_manager, self.rekey_governor)
+            self._create_policies(ike_sa.peer_addr, ike_conf)
+            oseqs = {x.outbound_spi: self.ha_receiver.oseqs.get(x.outbound_spi, 0) + self.HA_OSEQ_JUMP
+                     for x in ike_sa.child_sas}
+            request_data = ike_sa.take_over(oseqs)
+            self._add_ike_sa(ike_sa)
+            if request_data:
+                requests.append((request_data, (str(ike_sa.peer_addr), 500)))
+        logging.info('HA takeover: {} IKE_SAs and {} CHILD_SAs'.format(
+            len(self.ike_sas), sum(len(x.child_sas) for x in self.ike_sas)))
+        self.ha_receiver.close()
+        self.ha_receiver = None
+        return requests
+
     def _get_ike_sa_by_spi(self, spi):
-        return next(x for x in self.ike_sas if x.my_spi == spi)
+        return self.ike_sas_by_spi[spi]
+
+    def _is_known_spi(self, spi):
+        return spi in self.ike_sas_by_spi
 
     def _get_ike_sa_by_peer_addr(self, peer_addr):
-        return next(x for x in self.ike_sas if x.peer_addr == peer_addr)
+        return next(x for x in self.ike_sas if x.peer_addr == peer_addr or x.redirected_from == peer_addr)
 
     def _get_ike_sa_by_child_sa_spi(self, spi):
         for ike_sa in self.ike_sas:
@@ -1355,16 +2433,175 @@ class IkeSaController:
                     return ike_sa
         return None
 
+    def _add_ike_sa(self, ike_sa):
+        self.ike_sas.append(ike_sa)
+        self.ike_sas_by_spi[ike_sa.my_spi] = ike_sa
+        if self.ha_sender is not None:
+            ike_sa.changed_ike_sas = self.ha_changed
+            self.ha_changed.add(ike_sa)
+
+    def _remove_ike_sa(self, ike_sa):
+        ike_sa.delete_child_sas()
+        self.ike_sas.remove(ike_sa)
+        self.ike_sas_by_spi.pop(ike_sa.my_spi, None)
+        self.ha_changed.discard(ike_sa)
+        if self.ha_replicated.pop(ike_sa.my_spi, None) is not None:
+            self.ha_deleted.append(ike_sa.my_spi)
+        self.rekey_governor.release_all(ike_sa.my_spi)
+        ike_sa.forget_capture_keys()
+        # the policies of redirected IKE_SAs (RFC 5685) point back to the original gateway once the last one is gone
+        if (ike_sa.redirected_from is not None
+                and not any(x.redirected_from == ike_sa.redirected_from for x in self.ike_sas)):
+            self.xfrm.create_policies(ike_sa.my_addr, ike_sa.redirected_from, ike_sa.configuration, update=True)
+        if not any(x.peer_addr == ike_sa.peer_addr for x in self.ike_sas):
+            self._delete_policies(ike_sa.peer_addr, ike_sa.configuration)
+        # auto_start peers are brought up again, whoever started the IKE_SA, unless there is another IKE_SA with
+        # them (e.g. after a rekey)
+        peer_addr = ike_sa.redirected_from or ike_sa.peer_addr
+        if ike_sa.configuration.auto_start and self.configuration.has_peer(peer_addr):
+            self.auto_start_pending.setdefault(peer_addr, time.time() + self.AUTO_START_RETRY_DELAY)
+        self._discard_half_open_sa(ike_sa)
+        logging.info('Deleted IKE_SA with SPI={}. Count={}'.format(hexstring(ike_sa.my_spi), len(self.ike_sas)))
+
+    def _generate_cookie_response(self, request, peer_addr):
+        """ Returns a stateless IKE_SA_INIT response with a N(COOKIE), or None if the request already
+            contains a valid one
+        """
+        nonce = request.get_payload(Payload.Type.NONCE).nonce
+        addr = ip_address(peer_addr[0]).packed
+        cookie = request.get_notifies(PayloadNOTIFY.Type.COOKIE)
+        if cookie and self.cookie_generator.verify(cookie[0].notification_data, nonce, addr, request.spi_i):
+            return None
+        logging.info('Too many half-open IKE_SAs ({}). Requesting a COOKIE to {}'
+                     ''.format(len(self.half_open_sas), peer_addr[0]))
+        response = Message(spi_i=request.spi_i,
+                           spi_r=b'\0' * 8,
+                           major=2,
+                           minor=0,
+                           exchange_type=Message.Exchange.IKE_SA_INIT,
+                           is_response=True,
+                           can_use_higher_version=False,
+                           is_initiator=False,
+                           message_id=request.message_id,
+                           payloads=[PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.COOKIE, b'',
+                                                   self.cookie_generator.generate(nonce, addr, request.spi_i))],
+                           encrypted_payloads=[],
+                           crypto=None)
+        return response.to_bytes()
+
+    def _select_redirect_gateway(self, ike_conf):
+        """ Returns the gateway new initiators are redirected to when this one is overloaded, or None if they
+            can be served here. The configured gateway that has received less initiators from us is selected
+        """
+        if not ike_conf.redirect:
+            return None
+        established = len(self.ike_sas) - len(self.half_open_sas)
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if (len(self.half_open_sas) < self.REDIRECT_HALF_OPEN_THRESHOLD
+                and established < self.REDIRECT_ESTABLISHED_THRESHOLD and load < self.REDIRECT_LOAD_THRESHOLD):
+            return None
+        return min(ike_conf.redirect, key=lambda x: self.redirections[x])
+
+    def _generate_redirect_response(self, request, new_gw_addr):
+        """ Returns a stateless IKE_SA_INIT response with a N(REDIRECT) to the indicated gateway, or None if the
+            initiator does not support it (or has already been redirected)
+        """
+        if (not request.get_notifies(PayloadNOTIFY.Type.REDIRECT_SUPPORTED)
+                or request.get_notifies(PayloadNOTIFY.Type.REDIRECTED_FROM)):
+            return None
+        nonce = request.get_payload(Payload.Type.NONCE).nonce
+        logging.info('Too much load ({} IKE_SAs, {} half-open). Redirecting IKE_SA_INIT request to {}'
+                     ''.format(len(self.ike_sas), len(self.half_open_sas), new_gw_addr))
+        self.redirections[new_gw_addr] += 1
+        response = Message(spi_i=request.spi_i,
+                           spi_r=b'\0' * 8,
+                           major=2,
+                           minor=0,
+                           exchange_type=Message.Exchange.IKE_SA_INIT,
+                           is_response=True,
+                           can_use_higher_version=False,
+                           is_initiator=False,
+                           message_id=request.message_id,
+                           payloads=[PayloadNOTIFY(Proposal.Protocol.NONE, PayloadNOTIFY.Type.REDIRECT, b'',
+                                                   PayloadNOTIFY.gw_identity_to_bytes(new_gw_addr) + nonce)],
+                           encrypted_payloads=[],
+                           crypto=None)
+        return response.to_bytes()
+
+    def _discard_half_open_sa(self, ike_sa):
+        key = (str(ike_sa.peer_addr), ike_sa.peer_spi)
+        half_open_sa = self.half_open_sas.get(key)
+        if half_open_sa is not None and half_open_sa.ike_sa is ike_sa:
+            del self.half_open_sas[key]
+
+    def check_half_open_timers(self):
+        """ Discards the half-open IKE_SAs that have not completed the IKE_AUTH exchange in time
+        """
+        now = time.time()
+        for half_open_sa in list(self.half_open_sas.values()):
+            if half_open_sa.expires_at < now:
+                logging.info('Half-open IKE_SA with SPI={} timed out'.format(hexstring(half_open_sa.ike_sa.my_spi)))
+                self._remove_ike_sa(half_open_sa.ike_sa)
+
     def dispatch_message(self, data, my_addr, peer_addr):
+        start = time.perf_counter()
+        try:
+            return self._dispatch_message(data, my_addr, peer_addr)
+        finally:
+            DISPATCH_SECONDS.observe(time.perf_counter() - start)
+
+    def _dispatch_message(self, data, my_addr, peer_addr):
         header = Message.parse(data, header_only=True)
+        MESSAGES_RECEIVED.inc(Message.Exchange.safe_name(header.exchange_type),
+                              'request' if header.is_request else 'response')
+
+        # if IKE_SA_INIT or IKE_SESSION_RESUME request, then a new IkeSa must be created
+        request_hash = None
+        if (header.exchange_type in (Message.Exchange.IKE_SA_INIT, Message.Exchange.IKE_SESSION_RESUME)
+                and header.is_request):
+            # retransmissions of the IKE_SA_INIT request get the cached response, without doing any DH work
+            request_hash = hashlib.sha256(data).digest()
+            half_open_sa = self.half_open_sas.get((peer_addr[0], header.spi_i))
+            if half_open_sa is not None:
+                if half_open_sa.request_hash == request_hash:
+                    logging.warning('IKE_SA_INIT retransmission detected for IKE_SA with SPI={}. Sending last '
+                                    'sent message'.format(hexstring(half_open_sa.ike_sa.my_spi)))
+                    return half_open_sa.ike_sa.last_sent_response_data
+                logging.warning('Received a different IKE_SA_INIT request for half-open IKE_SA with SPI={}. '
+                                'Omitting.'.format(hexstring(half_open_sa.ike_sa.my_spi)))
+                return None
+
+            # under load, only accept requests with a valid COOKIE, without creating any state
+            if (header.exchange_type == Message.Exchange.IKE_SA_INIT
+                    and len(self.half_open_sas) >= self.COOKIE_THRESHOLD):
+                try:
+                    cookie_response = self._generate_cookie_response(Message.parse(data), peer_addr)
+                except IkeSaError as ex:
+                    logging.warning('Received invalid IKE_SA_INIT request: %s. Omitting.', ex)
+                    return None
+                if cookie_response:
+                    return cookie_response
 
-        # if IKE_SA_INIT request, then a new IkeSa must be created
-        if (header.exchange_type == Message.Exchange.IKE_SA_INIT and header.is_request):
             # look for matching configuration
             ike_conf = self.configuration.get_ike_configuration(peer_addr[0])
+
+            # when overloaded, send new initiators to a less loaded gateway, without creating any state
+            new_gw_addr = None
+            if header.exchange_type == Message.Exchange.IKE_SA_INIT:
+                new_gw_addr = self._select_redirect_gateway(ike_conf)
+            if new_gw_addr is not None:
+                try:
+                    redirect_response = self._generate_redirect_response(Message.parse(data), new_gw_addr)
+                except IkeSaError as ex:
+                    logging.warning('Received invalid IKE_SA_INIT request: %s. Omitting.', ex)
+                    return None
+                if redirect_response:
+                    return redirect_response
+
             ike_sa = IkeSa(is_initiator=False, peer_spi=header.spi_i, configuration=ike_conf,
-                           my_addr=ip_address(my_addr[0]), peer_addr=ip_address(peer_addr[0]))
-            self.ike_sas.append(ike_sa)
+                           my_addr=ip_address(my_addr[0]), peer_addr=ip_address(peer_addr[0]),
+                           ticket_manager=self.ticket_manager, rekey_governor=self.rekey_governor)
+            self._add_ike_sa(ike_sa)
             logging.info('Starting the creation of IKE SA with SPI={}. Count={}'.format(hexstring(ike_sa.my_spi),
                                                                                         len(self.ike_sas)))
         # else, look for the IkeSa in the dict
@@ -1372,51 +2609,84 @@ class IkeSaController:
             my_spi = header.spi_r if header.is_initiator else header.spi_i
             try:
                 ike_sa = self._get_ike_sa_by_spi(my_spi)
-            except StopIteration:
-                logging.warning('Received message for unknown SPI={}. Omitting.'.format(hexstring(my_spi)))
-                logging.debug(json.dumps(header.to_dict(), indent=logging.indent))
+            except KeyError:
+                UNKNOWN_SPI_MESSAGES.inc()
+                logging.warning('Received message for unknown SPI=%s. Omitting.', hexstring(my_spi))
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(json.dumps(header.to_dict(), indent=logging.indent))
                 return None
 
         # generate the reply (if any)
-        reply = ike_sa.process_message(data, peer_addr)
+        reply = ike_sa.process_message(data)
+
+        # keep track of half-open IKE_SAs
+        if ike_sa.state == IkeSa.State.INIT_RES_SENT:
+            if request_hash is not None:
+                self.half_open_sas[(peer_addr[0], header.spi_i)] = HalfOpenSa(
+                    ike_sa, request_hash, time.time() + self.HALF_OPEN_TIMEOUT)
+        else:
+            self._discard_half_open_sa(ike_sa)
+
+        # peers configured by network get their policies once authenticated
+        if ike_sa.state == IkeSa.State.ESTABLISHED:
+            self._create_policies(ike_sa.peer_addr, ike_sa.configuration)
 
         # if rekeyed, add the new IkeSa
         if ike_sa.state in (IkeSa.State.REKEYED, IkeSa.State.DEL_AFTER_REKEY_IKE_SA_REQ_SENT):
-            self.ike_sas.append(ike_sa.new_ike_sa)
+            self._add_ike_sa(ike_sa.new_ike_sa)
             logging.info('IKE SA with SPI={} created by rekey. Count={}'.format(hexstring(ike_sa.new_ike_sa.my_spi),
                                                                                 len(self.ike_sas)))
 
         # if the IKE_SA needs to be closed
         if ike_sa.state == IkeSa.State.DELETED:
-            ike_sa.delete_child_sas()
-            self.ike_sas.remove(ike_sa)
-            logging.info('Deleted IKE_SA with SPI={}. Count={}'.format(hexstring(ike_sa.my_spi), len(self.ike_sas)))
+            self._remove_ike_sa(ike_sa)
+
+        # redirected IKE_SAs (RFC 5685) continue with the new gateway, which the policies must point to
+        if reply is not None and str(ike_sa.peer_addr) != peer_addr[0]:
+            self.xfrm.create_policies(ike_sa.my_addr, ike_sa.peer_addr, ike_sa.configuration, update=True)
+            self.redirected_requests.append((reply, (str(ike_sa.peer_addr), 500)))
+            return None
 
         return reply
 
-    def process_acquire(self, xfrm_acquire):
-        peer_addr = xfrm_acquire.id.daddr.to_ipaddr()
+    def process_acquire(self, xfrm_acquire, attributes=None):
+        # the ACQUIRE does not indicate the family of the SA addresses, so take the one of the selector
+        family = xfrm_acquire.sel.family
+        peer_addr = xfrm_acquire.id.daddr.to_ipaddr(family)
         logging.debug('Received acquire for {}'.format(peer_addr))
 
-        # look for an active IKE_SA with the peer
+        # look for an active IKE_SA with the peer (or with the gateway it redirected us to)
         # TODO: Probably need to check state to see if we can use it or not
         try:
             ike_sa = self._get_ike_sa_by_peer_addr(peer_addr)
         except StopIteration:
-            my_addr = xfrm_acquire.saddr.to_ipaddr()
-            ike_conf = self.configuration.get_ike_configuration(peer_addr)
+            my_addr = xfrm_acquire.saddr.to_ipaddr(family)
+            try:
+                ike_conf = self.configuration.get_ike_configuration(peer_addr)
+            except ConfigurationNotFound:
+                logging.warning('Received acquire for {}, which is not configured. Omitting'.format(peer_addr))
+                return None, None
             # create new IKE_SA (for now)
             ike_sa = IkeSa(is_initiator=True, peer_spi=b'\0' * 8, configuration=ike_conf, my_addr=my_addr,
-                           peer_addr=peer_addr)
-            self.ike_sas.append(ike_sa)
+                           peer_addr=peer_addr, ticket_manager=self.ticket_manager,
+                           rekey_governor=self.rekey_governor)
+            self._add_ike_sa(ike_sa)
             logging.info('Starting the creation of IKE SA with SPI={}. Count={}'
                          ''.format(hexstring(ike_sa.my_spi), len(self.ike_sas)))
 
-        small_tsi = TrafficSelector.from_network(ip_network(xfrm_acquire.sel.saddr.to_ipaddr()),
-                                                 xfrm_acquire.sel.sport, xfrm_acquire.sel.proto)
-        small_tsr = TrafficSelector.from_network(ip_network(xfrm_acquire.sel.daddr.to_ipaddr()),
-                                                 xfrm_acquire.sel.dport, xfrm_acquire.sel.proto)
-        request = ike_sa.process_acquire(small_tsi, small_tsr, xfrm_acquire.policy.index >> 3)
+        small_tsi = TrafficSelector.from_address(xfrm_acquire.sel.saddr.to_ipaddr(family), xfrm_acquire.sel.sport,
+                                                 xfrm_acquire.sel.proto)
+        small_tsr = TrafficSelector.from_address(xfrm_acquire.sel.daddr.to_ipaddr(family), xfrm_acquire.sel.dport,
+                                                 xfrm_acquire.sel.proto)
+        # per-CPU ACQUIREs indicate the CPU that requires the SA
+        cpu = None
+        if attributes and xfrm.XFRMA_SA_PCPU in attributes:
+            cpu = attributes[xfrm.XFRMA_SA_PCPU].cpu
+        # the indexes of the policies of peers configured by network do not identify their "protect" configuration
+        index = xfrm_acquire.policy.index >> 3
+        if peer_addr in self.policy_peers and not self.configuration.has_peer(peer_addr):
+            index = None
+        request = ike_sa.process_acquire(small_tsi, small_tsr, index, cpu)
 
         # look for ipsec configuration
         return request, (str(ike_sa.peer_addr), 500)
@@ -1427,15 +2697,114 @@ class IkeSaController:
         logging.debug('Received EXPIRE for spi {}. Hard={}'.format(hexstring(spi), hard))
         ike_sa = self._get_ike_sa_by_child_sa_spi(spi)
         if (ike_sa):
-            request = ike_sa.process_expire(spi)
+            request = ike_sa.process_expire(spi, hard)
             return request, (str(ike_sa.peer_addr), 500)
         return None, None
 
+    def start_ike_sa(self, peer_addr, ike_conf):
+        """ Starts the negotiation of an IKE_SA with a peer, along with the CHILD_SAs of all its "protect"
+            configurations, without waiting for the traffic to trigger ACQUIREs. Returns the request data
+        """
+        ike_sa = IkeSa(is_initiator=True, peer_spi=b'\0' * 8, configuration=ike_conf, my_addr=self.my_addr,
+                       peer_addr=peer_addr, ticket_manager=self.ticket_manager, rekey_governor=self.rekey_governor)
+        self._add_ike_sa(ike_sa)
+        logging.info('Starting the creation of IKE SA with SPI={} (auto_start). Count={}'
+                     ''.format(hexstring(ike_sa.my_spi), len(self.ike_sas)))
+        # the first CHILD_SA is negotiated along with the IKE_SA, the rest are queued until it is established
+        requests = []
+        for ipsec_conf in ike_conf.protect:
+            tsi = TrafficSelector.from_network(ipsec_conf.my_subnet, ipsec_conf.my_port, ipsec_conf.ip_proto)
+            tsr = TrafficSelector.from_network(ipsec_conf.peer_subnet, ipsec_conf.peer_port, ipsec_conf.ip_proto)
+            requests.append(ike_sa.process_acquire(tsi, tsr, ipsec_conf.index))
+        return requests[0]
+
+    def check_auto_start(self):
+        """ Brings up the pending auto_start peers, as fast as the auto_start token bucket allows.
+            Returns a list of (request_data, addr) tuples to be sent
+        """
+        requests = []
+        now = time.time()
+        while self.auto_start_pending:
+            peer_addr, start_at = next(iter(self.auto_start_pending.items()))
+            if start_at > now or not self.auto_start_bucket.consume():
+                break
+            del self.auto_start_pending[peer_addr]
+            if any(x.peer_addr == peer_addr or x.redirected_from == peer_addr for x in self.ike_sas):
+                continue
+            try:
+                ike_conf = self.configuration.get_ike_configuration(peer_addr)
+            except ConfigurationNotFound:
+                continue
+            request_data = self.start_ike_sa(peer_addr, ike_conf)
+            if request_data:
+                requests.append((request_data, (str(peer_addr), 500)))
+        return requests
+
+    def check_deferred_rekeys(self):
+        """ Resumes the CHILD_SA rekeys deferred by the rekey governor, while there is budget for them.
+            Returns a list of (request_data, addr) tuples to be sent
+        """
+        requests = []
+        while self.rekey_governor.deferred and self.rekey_governor.has_budget():
+            spi = self.rekey_governor.deferred.popleft()
+            # the CHILD_SA might have moved to a new IKE_SA (rekeyed meanwhile), or be gone
+            ike_sa = self._get_ike_sa_by_child_sa_spi(spi)
+            if ike_sa is None:
+                continue
+            request_data = ike_sa.process_expire(spi)
+            if request_data:
+                requests.append((request_data, (str(ike_sa.peer_addr), 500)))
+        return requests
+
+    def check_sad_timer(self, force=False):
+        """ Periodically dumps the kernel SAD statistics, updates the SAD size metrics, postpones DPD for the
+            peers with inbound IPsec traffic and deletes the idle CHILD_SAs.
+            Returns a list of (request_data, addr) tuples to be sent
+        """
+        if self.check_sad_at > time.time() and not force:
+            return []
+        self.check_sad_at = time.time() + self.SAD_POLL_INTERVAL
+        sa_stats = self.xfrm.get_all_sa_stats()
+        self.sad_size = len(sa_stats)
+        self.child_sa_count = sum(len(ike_sa.child_sas) for ike_sa in self.ike_sas)
+        logging.info('SAD size: {} IPsec SAs. CHILD_SAs: {}. IKE_SAs: {}. Idle CHILD_SAs deleted: {}'
+                     ''.format(self.sad_size, self.child_sa_count, len(self.ike_sas), self.idle_child_sas_deleted))
+        if self.admission.drops:
+            logging.info('Admission control. Accepted: {}. Dropped: {}'
+                         ''.format(dict(self.admission.accepted), dict(self.admission.drops)))
+        if self.rekey_governor.deferrals:
+            logging.info('Rekeys in flight: {}. Deferred CHILD_SA rekeys: {}. Total deferrals: {}'
+                         ''.format(len(self.rekey_governor.in_flight), len(self.rekey_governor.deferred),
+                                   self.rekey_governor.deferrals))
+        requests = []
+        for ike_sa in self.ike_sas:
+            # replicate the outbound sequence numbers, so the standby member can continue them
+            if self.ha_sender is not None:
+                for child_sa in ike_sa.child_sas:
+                    stats = sa_stats.get(child_sa.outbound_spi)
+                    if stats is not None:
+                        self.ha_sender.send(*ha.oseq_event(child_sa.outbound_spi, stats.packets))
+            ike_sa.update_inbound_traffic(sa_stats)
+            request_data = ike_sa.check_idle_child_sas(sa_stats)
+            if request_data:
+                self.idle_child_sas_deleted += 1
+                requests.append((request_data, (str(ike_sa.peer_addr), 500)))
+        return requests
+
     def main_loop(self):
+        # standby members just keep the replica of the active member's IKE_SAs until it is lost
+        takeover_requests = []
+        while self.ha_receiver is not None:
+            self.ha_receiver.receive(timeout=1)
+            if self.ha_receiver.is_active_lost():
+                logging.warning('HA active member lost. Taking over')
+                takeover_requests = self.take_over()
+
         # create network socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # bp
         port = 500
         sock.bind((str(self.my_addr), port))
+        sock.setblocking(False)
         logging.info('Listening from {}:{}'.format(self.my_addr, port))
 
         # create XFRM socket
@@ -1443,14 +2812,38 @@ class IkeSaController:
         xfrm_socket = xfrm_obj.get_socket()
         logging.info('Listening XFRM events.')
 
+        for request_data, addr in takeover_requests + self.restored_requests:
+            self._sendto(sock, request_data, addr)
+        self.restored_requests.clear()
+
         # do server
         while True:
-            readable = select([sock, xfrm_socket], [], [], 1)[0]
+            # do not block if there are queued messages waiting to be dispatched
+            metrics_sockets = self.metrics_server.get_sockets() if self.metrics_server is not None else []
+            readable = select([sock, xfrm_socket] + metrics_sockets, [], [], 0 if len(self.admission) else 1)[0]
             if sock in readable:
-                data, addr = sock.recvfrom(4096)
+                # drain the socket into the admission scheduler
+                for _ in range(self.MAX_READS_PER_LOOP):
+                    try:
+                        data, addr = sock.recvfrom(4096)
+                    except BlockingIOError:
+                        break
+                    if capture.active() is not None:
+                        capture.active().write_datagram(data, addr, sock.getsockname())
+                    self.admission.submit(data, addr)
+
+            # dispatch the queued messages, established IKE_SAs first
+            for _ in range(self.MAX_DISPATCH_PER_LOOP):
+                queued = self.admission.get()
+                if queued is None:
+                    break
+                data, addr = queued
                 data = self.dispatch_message(data, sock.getsockname(), addr)
                 if data:
-                    sock.sendto(data, addr)
+                    self._sendto(sock, data, addr)
+            for request_data, addr in self.redirected_requests:
+                self._sendto(sock, request_data, addr)
+            self.redirected_requests.clear()
 
             # TODO: Wrong. _parse_message should not be used here
             if xfrm_socket in readable:
@@ -1458,34 +2851,78 @@ class IkeSaController:
                 header, msg, attributes = xfrm_obj.parse_message(data)
                 reply_data, addr = None, None
                 if header.type == xfrm.XFRM_MSG_ACQUIRE:
-                    reply_data, addr = self.process_acquire(msg)
+                    reply_data, addr = self.process_acquire(msg, attributes)
                 elif header.type == xfrm.XFRM_MSG_EXPIRE:
                     reply_data, addr = self.process_expire(msg)
                 if reply_data:
-                    sock.sendto(reply_data, addr)
+                    self._sendto(sock, reply_data, addr)
 
             # check retransmissions
-            for ikesa in self.ike_sas:
+            for ikesa in list(self.ike_sas):
                 request_data = ikesa.check_retransmission_timer()
                 if request_data:
-                    sock.sendto(request_data, (str(ikesa.peer_addr), 500))
+                    self._sendto(sock, request_data, (str(ikesa.peer_addr), 500))
+                for request_data in ikesa.check_window_retransmission_timers():
+                    self._sendto(sock, request_data, (str(ikesa.peer_addr), 500))
                 if ikesa.state == IkeSa.State.DELETED:
-                    ikesa.delete_child_sas()
-                    self.ike_sas.remove(ikesa)
-                    logging.info('Deleted IKE_SA {}. Count={}'.format(ikesa, len(self.ike_sas)))
+                    self._remove_ike_sa(ikesa)
+
+            # discard stale half-open IKE_SAs
+            self.check_half_open_timers()
+
+            # refresh the SAD statistics before any DPD, so peers with inbound IPsec traffic are not probed
+            if any(ikesa.child_sas and ikesa.is_dead_peer_detection_due() for ikesa in self.ike_sas):
+                for request_data, addr in self.check_sad_timer(force=True):
+                    self._sendto(sock, request_data, addr)
 
             # start DPD
             for ikesa in self.ike_sas:
                 request_data = ikesa.check_dead_peer_detection_timer()
                 if request_data:
-                    sock.sendto(request_data, (str(ikesa.peer_addr), 500))
+                    self._sendto(sock, request_data, (str(ikesa.peer_addr), 500))
 
             # start IKE_SA rekeyings
             for ikesa in self.ike_sas:
                 request_data = ikesa.check_rekey_ike_sa_timer()
                 if request_data:
-                    sock.sendto(request_data, (str(ikesa.peer_addr), 500))
+                    self._sendto(sock, request_data, (str(ikesa.peer_addr), 500))
+
+            # resume the CHILD_SA rekeys deferred by the rekey governor
+            for request_data, addr in self.check_deferred_rekeys():
+                self._sendto(sock, request_data, addr)
+
+            # bring up the auto_start peers
+            for request_data, addr in self.check_auto_start():
+                self._sendto(sock, request_data, addr)
+
+            # poll SAD statistics and delete idle CHILD_SAs
+            for request_data, addr in self.check_sad_timer():
+                self._sendto(sock, request_data, addr)
+
+            # save the periodic snapshot
+            self.check_snapshot_timer()
+
+            # start or stop the capture, if requested
+            self.check_capture_toggle()
+
+            # serve the metrics requests
+            if self.metrics_server is not None:
+                self.metrics_server.process(readable)
+
+            # replicate the changes to the HA standby member
+            self.replicate()
 
     def close(self):
+        if self.ha_sender is not None:
+            self.ha_sender.close()
+        if self.ha_receiver is not None:
+            self.ha_receiver.close()
+        capture.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        # keep the kernel state for the next run if it is going to be restored
+        if self.state_file:
+            self.save_snapshot(clean=True)
+            return
         self.xfrm.flush_policies()
         self.xfrm.flush_sas()
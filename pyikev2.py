@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 #
 import argparse
+import atexit
 import logging
 import signal
 import socket
@@ -10,8 +11,10 @@ from ipaddress import ip_address
 
 import yaml
 
+import log
 from configuration import Configuration
 from protocol_ import IkeSaController
+from rekey import RekeyGovernor
 
 __author__ = 'Alejandro Perez <alejandro.perez.mendez@gmail.com>'
 __version__ = "0.2"
@@ -28,6 +31,55 @@ parser.add_argument('--configuration-file', '-c', required=True, metavar='FILE',
                     help='Configuration file.')
 parser.add_argument('--no-indent', '-ni', action='store_true',
                     help='Disables JSON indentation to provide a more compact log output.')
+parser.add_argument('--state-file', '-s', metavar='FILE',
+                    help='File where the established SAs are saved on exit, and restored from on start, '
+                         'so they survive restarts.')
+parser.add_argument('--snapshot-interval', type=int, default=0, metavar='SECONDS',
+                    help='Also save the state file periodically. Disabled by default.')
+parser.add_argument('--ha-role', choices=['active', 'standby'],
+                    help='Role of the daemon in an active/standby HA pair. The active member replicates its SAs '
+                         'to the standby one, which takes over them if the active member stops responding.')
+parser.add_argument('--ha-address', metavar='IPADDR:PORT|PATH',
+                    help='TCP address or Unix socket path where the standby member listens for the replication '
+                         'stream.')
+parser.add_argument('--ha-key-file', metavar='FILE',
+                    help='File with the key shared by the HA members, used to authenticate and encrypt the '
+                         'replication stream (which carries the SA keys).')
+parser.add_argument('--log-queue-size', type=int, default=10000, metavar='RECORDS',
+                    help='Maximum number of log records waiting to be written. Further records are dropped '
+                         '(and counted) until there is room again.')
+parser.add_argument('--log-rate-limit', action='store_true',
+                    help='Limit repetitive warnings and errors (e.g. messages for unknown SPIs) to a few every '
+                         '{} seconds.'.format(log.RateLimitFilter.INTERVAL))
+parser.add_argument('--capture-file', metavar='FILE',
+                    help='pcapng file where the IKE exchanges are captured, while capturing is enabled. '
+                         'SIGUSR1 starts and stops the capture.')
+parser.add_argument('--capture', action='store_true',
+                    help='Start capturing right away, instead of waiting for SIGUSR1.')
+parser.add_argument('--capture-decrypted', action='store_true',
+                    help='Also capture the decrypted messages, and write the IKE_SA keys to a Wireshark '
+                         'ikev2_decryption_table file next to the capture file. WARNING: This will make your key '
+                         'material available to whoever can read those files!')
+parser.add_argument('--metrics-address', metavar='IPADDR:PORT|PATH',
+                    help='TCP address or Unix socket path where the metrics are served in the Prometheus text '
+                         'format (e.g. 127.0.0.1:9500).')
+parser.add_argument('--redirect-half-open', type=int, default=IkeSaController.REDIRECT_HALF_OPEN_THRESHOLD,
+                    metavar='COUNT',
+                    help='Half-open IKE_SAs from which new initiators are redirected to the gateways configured '
+                         'for them. Default: %(default)s.')
+parser.add_argument('--redirect-established', type=int, default=IkeSaController.REDIRECT_ESTABLISHED_THRESHOLD,
+                    metavar='COUNT',
+                    help='Established IKE_SAs from which new initiators are redirected. Default: %(default)s.')
+parser.add_argument('--redirect-load', type=float, default=IkeSaController.REDIRECT_LOAD_THRESHOLD,
+                    metavar='LOAD',
+                    help='1-minute load average per CPU from which new initiators are redirected. '
+                         'Default: %(default)s.')
+parser.add_argument('--rekey-jitter', type=float, default=RekeyGovernor.JITTER, metavar='FRACTION',
+                    help='Maximum fraction of the lifetime by which rekeys are brought forward, to spread them. '
+                         'Default: %(default)s.')
+parser.add_argument('--rekey-max-in-flight', type=int, default=RekeyGovernor.MAX_IN_FLIGHT, metavar='COUNT',
+                    help='Maximum number of rekey exchanges in flight. Further CHILD_SA rekeys are deferred. '
+                         'Default: %(default)s.')
 parser.add_argument('--version', action='version', version='%(prog)s {}'.format(__version__))
 args = parser.parse_args()
 
@@ -40,10 +92,46 @@ except ValueError as ex:
     print(ex)
     sys.exit(1)
 
-# set logger
-logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
-                    format='[%(asctime)s.%(msecs)03d] [%(levelname)-7s] %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+if not 0 <= args.rekey_jitter < 1 or args.rekey_max_in_flight < 1:
+    print('--rekey-jitter must be in [0, 1) and --rekey-max-in-flight at least 1')
+    sys.exit(1)
+
+ha_addr, ha_key = None, None
+if args.ha_role:
+    if not args.ha_address or not args.ha_key_file:
+        print('--ha-address and --ha-key-file are required when --ha-role is used')
+        sys.exit(1)
+    ha_addr = args.ha_address
+    if '/' not in ha_addr:
+        if ':' not in ha_addr:
+            print('--ha-address must be IPADDR:PORT or the path of a Unix socket')
+            sys.exit(1)
+        ha_host, ha_port = ha_addr.rsplit(':', 1)
+        ha_addr = (ha_host.strip('[]'), int(ha_port))
+    try:
+        with open(args.ha_key_file, 'rb') as file:
+            ha_key = file.read().strip()
+    except OSError as ex:
+        print(ex)
+        sys.exit(1)
+    if not ha_key:
+        print('{} does not contain any key'.format(args.ha_key_file))
+        sys.exit(1)
+
+metrics_addr = args.metrics_address
+if metrics_addr and '/' not in metrics_addr:
+    if ':' not in metrics_addr:
+        print('--metrics-address must be IPADDR:PORT or the path of a Unix socket')
+        sys.exit(1)
+    metrics_host, metrics_port = metrics_addr.rsplit(':', 1)
+    metrics_addr = (metrics_host.strip('[]'), int(metrics_port))
+
+# set logger (records are written by a separate thread, so slow outputs do not stall the daemon)
+log_listener = log.setup(level=logging.DEBUG if args.verbose else logging.INFO,
+                         fmt='[%(asctime)s.%(msecs)03d] [%(levelname)-7s] %(message)s',
+                         datefmt='%Y-%m-%d %H:%M:%S', queue_size=args.log_queue_size,
+                         rate_limit=args.log_rate_limit)
+atexit.register(log_listener.stop)
 logging.indent = None if args.no_indent else 2
 
 
@@ -59,7 +147,17 @@ except (FileNotFoundError, yaml.YAMLError) as ex:
 configuration = Configuration(ip, conf_dict)
 
 # create IkeSaController
-ike_sa_controller = IkeSaController(ip_address(ip), configuration=configuration)
+IkeSaController.REDIRECT_HALF_OPEN_THRESHOLD = args.redirect_half_open
+IkeSaController.REDIRECT_ESTABLISHED_THRESHOLD = args.redirect_established
+IkeSaController.REDIRECT_LOAD_THRESHOLD = args.redirect_load
+RekeyGovernor.JITTER = args.rekey_jitter
+RekeyGovernor.MAX_IN_FLIGHT = args.rekey_max_in_flight
+ike_sa_controller = IkeSaController(ip_address(ip), configuration=configuration, state_file=args.state_file,
+                                    snapshot_interval=args.snapshot_interval, ha_role=args.ha_role,
+                                    ha_addr=ha_addr, ha_key=ha_key, capture_file=args.capture_file,
+                                    capture_decrypted=args.capture_decrypted, metrics_addr=metrics_addr)
+if args.capture:
+    ike_sa_controller.toggle_capture()
 
 
 def signal_handler(*unused):
@@ -68,6 +166,11 @@ def signal_handler(*unused):
     sys.exit(0)
 
 
+def capture_signal_handler(*unused):
+    ike_sa_controller.request_capture_toggle()
+
+
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGUSR1, capture_signal_handler)
 
 ike_sa_controller.main_loop()  # bp
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the rekey governor, which spreads the IKE_SA and CHILD_SA rekeys over time and
+    limits how many of them are in flight at once
+"""
+import random
+from collections import deque
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class RekeyGovernor:
+    """ SAs established together (e.g. after an outage) would otherwise rekey together, lifetime after
+        lifetime. Rekeys are brought forward by a random fraction of the lifetime (up to JITTER), so they
+        spread over a window proportional to it, and at most MAX_IN_FLIGHT rekey exchanges are in flight
+        at any time. Rekeys exceeding that budget are deferred until some of the in flight ones finish.
+    """
+    JITTER = 0.1
+    MAX_IN_FLIGHT = 32
+
+    def __init__(self):
+        # in flight rekeys, as (IKE_SA SPI, message ID) tuples
+        self.in_flight = set()
+        # SPIs of the CHILD_SAs whose rekey has been deferred. The IKE_SA they belong to is looked up when
+        # resumed, as it might have been rekeyed in the meantime
+        self.deferred = deque()
+        # number of CHILD_SA rekeys deferred so far
+        self.deferrals = 0
+
+    @classmethod
+    def jittered(cls, lifetime):
+        """ Returns the time after which an SA with the indicated lifetime has to be rekeyed
+        """
+        return lifetime - random.uniform(0, lifetime * cls.JITTER)
+
+    def has_budget(self):
+        return len(self.in_flight) < self.MAX_IN_FLIGHT
+
+    def acquire(self, spi, msg_id):
+        """ Reserves a slot for a rekey exchange using the indicated message ID. Returns False if there is
+            no budget left for it
+        """
+        if not self.has_budget():
+            return False
+        self.in_flight.add((spi, msg_id))
+        return True
+
+    def release(self, spi, msg_id):
+        self.in_flight.discard((spi, msg_id))
+
+    def release_all(self, spi):
+        """ Releases the slots of an IKE_SA (e.g. when it gets deleted in the middle of a rekey)
+        """
+        self.in_flight = {x for x in self.in_flight if x[0] != spi}
+
+    def defer(self, spi):
+        """ Defers the rekey of a CHILD_SA until there is budget for it
+        """
+        self.deferrals += 1
+        self.deferred.append(spi)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the ticket management for IKEv2 session resumption (RFC 5723)
+"""
+import os
+import time
+from collections import namedtuple
+from struct import error as struct_error, pack, unpack_from
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from message import InvalidSyntax, Proposal
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+# Ticket received from a responder, along with the IKE_SA state required to use it
+ResumptionTicket = namedtuple('ResumptionTicket', ['ticket', 'sk_d', 'proposal', 'expires_at'])
+
+
+class TicketManager:
+    """ Issues the opaque tickets sent to the initiators (as responder) and stores the ones received
+        from the responders (as initiator).
+        Tickets are <VersionIDofKey> | IV | AES-GCM(expiration | SK_d | IDi | IKE proposal), so the responder
+        does not keep any state for them. The binding of the configuration the IKE_SA was authenticated with
+        is part of the associated data, so a ticket is only accepted under that same configuration, and the
+        IDi it holds must be the one the initiator presents when resuming (RFC 5723 section 4.3.2).
+        The key is rotated every KEY_LIFETIME seconds, and tickets protected with the previous one are
+        still accepted until they expire.
+    """
+    TICKET_LIFETIME = 3600
+    KEY_LIFETIME = 3600
+
+    def __init__(self):
+        self.version = 0
+        self.keys = {self.version: AESGCM.generate_key(bit_length=128)}
+        self.rotate_at = time.time() + self.KEY_LIFETIME
+        # tickets received from responders, indexed by peer address
+        self.tickets = {}
+
+    def _rotate_key(self):
+        if self.rotate_at < time.time():
+            previous_version = self.version
+            self.version = (self.version + 1) % 256
+            self.keys = {previous_version: self.keys[previous_version],
+                         self.version: AESGCM.generate_key(bit_length=128)}
+            self.rotate_at = time.time() + self.KEY_LIFETIME
+
+    def issue(self, sk_d, proposal, peer_id, binding):
+        """ Generates a ticket holding the SK_d, the authenticated IDi (as bytes) and the IKE proposal of
+            an IKE_SA. binding identifies the configuration used for authenticating it
+        """
+        self._rotate_key()
+        plaintext = (pack('>LH', int(time.time()) + self.TICKET_LIFETIME, len(sk_d)) + sk_d
+                     + pack('>H', len(peer_id)) + peer_id + proposal.to_bytes())
+        iv = os.urandom(12)
+        version = bytes([self.version])
+        return version + iv + AESGCM(self.keys[self.version]).encrypt(iv, plaintext, version + binding)
+
+    def decrypt(self, ticket, binding):
+        """ Returns the (sk_d, proposal, peer_id) tuple stored in a ticket, or None if the ticket is not valid,
+            has expired or was issued for a different configuration binding
+        """
+        self._rotate_key()
+        if len(ticket) < 13 or ticket[0] not in self.keys:
+            return None
+        try:
+            plaintext = AESGCM(self.keys[ticket[0]]).decrypt(ticket[1:13], ticket[13:], ticket[:1] + binding)
+            expires_at, sk_d_len = unpack_from('>LH', plaintext)
+            sk_d = plaintext[6:6 + sk_d_len]
+            offset = 6 + sk_d_len
+            peer_id_len, = unpack_from('>H', plaintext, offset)
+            peer_id = plaintext[offset + 2:offset + 2 + peer_id_len]
+            proposal = Proposal.parse(plaintext[offset + 2 + peer_id_len:])
+        except (InvalidTag, InvalidSyntax, struct_error):
+            return None
+        if expires_at < time.time():
+            return None
+        return sk_d, proposal, peer_id
+
+    def store(self, peer_addr, ticket, lifetime, sk_d, proposal):
+        """ Stores a ticket received from a responder, to be used for resuming the IKE_SA later
+        """
+        self.tickets[peer_addr] = ResumptionTicket(ticket, sk_d, proposal, time.time() + lifetime)
+
+    def pop(self, peer_addr):
+        """ Returns (and forgets, as tickets are single use) the stored ticket for a peer, if any and not expired
+        """
+        ticket = self.tickets.pop(peer_addr, None)
+        if ticket is None or ticket.expires_at < time.time():
+            return None
+        return ticket
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines the binary snapshot format used to save the established IKE_SAs and
+    restore them after a restart
+"""
+import os
+import time
+from collections import namedtuple
+from ipaddress import ip_address
+from struct import calcsize, error as struct_error, pack, unpack_from
+
+from message import InvalidSyntax, Proposal, TrafficSelector
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+MAGIC = b'PYIKEV2S'
+VERSION = 4
+
+# clean tells whether the snapshot was written on exit. Periodic ones may have stale message IDs
+Snapshot = namedtuple('Snapshot', ['clean', 'ike_sas'])
+IkeSaSnapshot = namedtuple('IkeSaSnapshot', ['is_initiator', 'resumed', 'my_spi', 'peer_spi', 'my_msg_id',
+                                             'peer_msg_id', 'peer_window_size', 'rekey_ike_sa_at',
+                                             'delete_ike_sa_at', 'my_addr', 'peer_addr', 'proposal', 'keyring',
+                                             'child_sas', 'msg_id_sync'])
+# keyring holds the (sk_ai, sk_ar, sk_ei, sk_er) keys of the CHILD_SA, if known. exchange_initiator tells which of
+# them are the outbound ones
+ChildSaSnapshot = namedtuple('ChildSaSnapshot', ['inbound_spi', 'outbound_spi', 'proposal', 'tsi', 'tsr', 'mode',
+                                                 'index', 'cpu', 'keyring', 'exchange_initiator'])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class _Reader:
+    """ Sequential reader of the snapshot fields
+    """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = unpack_from(fmt, self.data, self.offset)
+        self.offset += calcsize(fmt)
+        return values
+
+    def bytes(self):
+        length, = self.unpack('>H')
+        if self.offset + length > len(self.data):
+            raise SnapshotError('Truncated snapshot')
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return bytes(value)
+
+
+def _pack_bytes(value):
+    return pack('>H', len(value)) + bytes(value)
+
+
+def _write_ike_sa(ike_sa):
+    data = bytearray(pack('>BBB8s8sLLLdd', ike_sa.is_initiator, ike_sa.resumed, ike_sa.msg_id_sync, ike_sa.my_spi,
+                          ike_sa.peer_spi, ike_sa.my_msg_id, ike_sa.peer_msg_id, ike_sa.peer_window_size,
+                          ike_sa.rekey_ike_sa_at, ike_sa.delete_ike_sa_at))
+    data += _pack_bytes(ike_sa.my_addr.packed) + _pack_bytes(ike_sa.peer_addr.packed)
+    data += _pack_bytes(ike_sa.proposal.to_bytes())
+    for key in ike_sa.keyring:
+        data += _pack_bytes(key)
+    data += pack('>H', len(ike_sa.child_sas))
+    for child_sa in ike_sa.child_sas:
+        data += _pack_bytes(child_sa.inbound_spi) + _pack_bytes(child_sa.outbound_spi)
+        data += _pack_bytes(child_sa.proposal.to_bytes())
+        data += _pack_bytes(child_sa.tsi.to_bytes()) + _pack_bytes(child_sa.tsr.to_bytes())
+        data += pack('>BLlBB', child_sa.mode, child_sa.index, -1 if child_sa.cpu is None else child_sa.cpu,
+                     child_sa.keyring is not None, bool(child_sa.exchange_initiator))
+        for key in child_sa.keyring or ():
+            data += _pack_bytes(key)
+    return data
+
+
+def _read_ike_sa(reader):
+    (is_initiator, resumed, msg_id_sync, my_spi, peer_spi, my_msg_id, peer_msg_id, peer_window_size, rekey_ike_sa_at,
+     delete_ike_sa_at) = reader.unpack('>BBB8s8sLLLdd')
+    my_addr = ip_address(reader.bytes())
+    peer_addr = ip_address(reader.bytes())
+    proposal = Proposal.parse(reader.bytes())
+    keyring = tuple(reader.bytes() for _ in range(7))
+    child_sas = []
+    for _ in range(reader.unpack('>H')[0]):
+        inbound_spi, outbound_spi = reader.bytes(), reader.bytes()
+        child_proposal = Proposal.parse(reader.bytes())
+        tsi, tsr = TrafficSelector.parse(reader.bytes()), TrafficSelector.parse(reader.bytes())
+        mode, index, cpu, has_keyring, exchange_initiator = reader.unpack('>BLlBB')
+        child_keyring = tuple(reader.bytes() for _ in range(4)) if has_keyring else None
+        child_sas.append(ChildSaSnapshot(inbound_spi, outbound_spi, child_proposal, tsi, tsr, mode, index,
+                                         None if cpu < 0 else cpu, child_keyring, bool(exchange_initiator)))
+    return IkeSaSnapshot(bool(is_initiator), bool(resumed), my_spi, peer_spi, my_msg_id, peer_msg_id,
+                         peer_window_size, rekey_ike_sa_at, delete_ike_sa_at, my_addr, peer_addr, proposal, keyring,
+                         child_sas, bool(msg_id_sync))
+
+
+def ike_sa_to_bytes(ike_sa):
+    """ Serialises a single IkeSaSnapshot (e.g. to be replicated)
+    """
+    return bytes(_write_ike_sa(ike_sa))
+
+
+def ike_sa_from_bytes(data):
+    """ Parses a single IkeSaSnapshot
+    """
+    reader = _Reader(data)
+    try:
+        ike_sa = _read_ike_sa(reader)
+    except (struct_error, InvalidSyntax, ValueError) as ex:
+        raise SnapshotError('Invalid IKE_SA snapshot: {}'.format(ex)) from ex
+    if reader.offset != len(data):
+        raise SnapshotError('Unexpected data at the end of the IKE_SA snapshot')
+    return ike_sa
+
+
+def to_bytes(ike_sas, clean=False):
+    """ Serialises a list of IkeSaSnapshot
+    """
+    data = bytearray(MAGIC + pack('>BBdL', VERSION, clean, time.time(), len(ike_sas)))
+    for ike_sa in ike_sas:
+        data += _write_ike_sa(ike_sa)
+    return bytes(data)
+
+
+def parse(data):
+    """ Parses a snapshot, returning a Snapshot with the list of IkeSaSnapshot it contains
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError('Not a snapshot file')
+    reader = _Reader(data)
+    reader.offset = len(MAGIC)
+    try:
+        version, = reader.unpack('>B')
+        if version != VERSION:
+            raise SnapshotError('Unsupported snapshot version {}'.format(version))
+        clean, _, count = reader.unpack('>BdL')
+        ike_sas = [_read_ike_sa(reader) for _ in range(count)]
+    except (struct_error, InvalidSyntax, ValueError) as ex:
+        raise SnapshotError('Invalid snapshot: {}'.format(ex)) from ex
+    if reader.offset != len(data):
+        raise SnapshotError('Unexpected data at the end of the snapshot')
+    return Snapshot(bool(clean), ike_sas)
+
+
+def save(filename, ike_sas, clean=False):
+    """ Writes the snapshot atomically, so a crash while writing never leaves a corrupted file behind.
+        It holds the IKE_SA keys, so it is only readable by the owner
+    """
+    tmp_filename = '{}.tmp'.format(filename)
+    # a leftover from a crash while writing is removed, but never followed if replaced by a link
+    try:
+        os.remove(tmp_filename)
+    except FileNotFoundError:
+        pass
+    fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(to_bytes(ike_sas, clean))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def load(filename):
+    """ Reads a snapshot file
+    """
+    try:
+        with open(filename, 'rb') as file:
+            return parse(file.read())
+    except OSError as ex:
+        raise SnapshotError(str(ex)) from ex
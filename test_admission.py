@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the admission module
+"""
+import unittest
+
+from admission import AdmissionScheduler, TokenBucket
+from message import Message
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+def create_message(exchange_type, spi_i, spi_r=b'\0' * 8, is_response=False, is_initiator=True):
+    return Message(spi_i=spi_i, spi_r=spi_r, major=2, minor=0, exchange_type=exchange_type,
+                   is_response=is_response, can_use_higher_version=False, is_initiator=is_initiator,
+                   message_id=0, payloads=[], encrypted_payloads=[], crypto=None).to_bytes()
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume(self):
+        bucket = TokenBucket(rate=0, burst=2)
+        self.assertTrue(bucket.is_full)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertFalse(bucket.is_full)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        self.assertTrue(bucket.consume())
+        bucket.updated_at -= 1
+        self.assertTrue(bucket.consume())
+
+
+class TestAdmissionScheduler(unittest.TestCase):
+    def setUp(self):
+        self.known_spi = b'K' * 8
+        self.scheduler = AdmissionScheduler(lambda spi: spi == self.known_spi, peer_rate=0, peer_burst=2,
+                                            global_rate=0, global_burst=3)
+        self.new_request = create_message(Message.Exchange.IKE_SA_INIT, b'I' * 8)
+        self.established = create_message(Message.Exchange.INFORMATIONAL, b'I' * 8, self.known_spi)
+
+    def test_priority(self):
+        self.assertTrue(self.scheduler.submit(self.new_request, ('192.168.0.1', 500)))
+        self.assertTrue(self.scheduler.submit(self.established, ('192.168.0.2', 500)))
+        self.assertEqual(len(self.scheduler), 2)
+        self.assertEqual(self.scheduler.get(), (self.established, ('192.168.0.2', 500)))
+        self.assertEqual(self.scheduler.get(), (self.new_request, ('192.168.0.1', 500)))
+        self.assertIsNone(self.scheduler.get())
+
+    def test_response_to_initiator(self):
+        response = create_message(Message.Exchange.IKE_SA_INIT, self.known_spi, b'R' * 8, is_response=True,
+                                  is_initiator=False)
+        self.assertTrue(self.scheduler.submit(response, ('192.168.0.1', 500)))
+        self.assertEqual(self.scheduler.accepted['ESTABLISHED'], 1)
+
+    def test_drops(self):
+        self.assertFalse(self.scheduler.submit(b'garbage', ('192.168.0.1', 500)))
+        unknown = create_message(Message.Exchange.INFORMATIONAL, b'I' * 8, b'U' * 8)
+        self.assertFalse(self.scheduler.submit(unknown, ('192.168.0.1', 500)))
+        self.assertEqual(self.scheduler.drops['malformed'], 1)
+        self.assertEqual(self.scheduler.drops['unknown_spi'], 1)
+
+    def test_rate_limits(self):
+        for i in range(3):
+            self.scheduler.submit(self.new_request, ('192.168.0.1', 500))
+        self.assertEqual(self.scheduler.drops['peer_rate'], 1)
+        # no bucket is created for the peers dropped by the global rate
+        for i in range(2):
+            self.scheduler.submit(self.new_request, ('192.168.0.2', 500))
+        self.assertEqual(self.scheduler.drops['global_rate'], 2)
+        self.assertEqual(list(self.scheduler.peer_buckets), ['192.168.0.1'])
+        self.assertEqual(self.scheduler.accepted['NEW'], 2)
+        # established IKE_SAs are not rate limited
+        self.assertTrue(self.scheduler.submit(self.established, ('192.168.0.1', 500)))
+
+    def test_peer_buckets_lru(self):
+        self.scheduler.MAX_PEER_BUCKETS = 2
+        self.scheduler.global_bucket = TokenBucket(rate=0, burst=10)
+        for peer_ip in ('192.168.0.1', '192.168.0.2', '192.168.0.1', '192.168.0.3'):
+            self.assertTrue(self.scheduler.submit(self.new_request, (peer_ip, 500)))
+        # the least recently used peer is evicted
+        self.assertEqual(list(self.scheduler.peer_buckets), ['192.168.0.1', '192.168.0.3'])
+
+    def test_queue_full(self):
+        self.scheduler.MAX_QUEUE_LENGTH = {AdmissionScheduler.Priority.ESTABLISHED: 1,
+                                           AdmissionScheduler.Priority.NEW: 1}
+        self.assertTrue(self.scheduler.submit(self.established, ('192.168.0.1', 500)))
+        self.assertFalse(self.scheduler.submit(self.established, ('192.168.0.1', 500)))
+        self.assertEqual(self.scheduler.drops['queue_full'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the capture module
+"""
+import os
+import tempfile
+import unittest
+from collections import namedtuple
+from struct import unpack_from
+
+import capture
+from capture import BLOCK_EPB, BLOCK_IDB, BLOCK_SHB, LINKTYPE_RAW, Capture, _checksum, ip_udp_packet
+from message import Proposal, Transform
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+Keyring = namedtuple('Keyring', ['sk_d', 'sk_ai', 'sk_ar', 'sk_ei', 'sk_er', 'sk_pi', 'sk_pr'])
+
+
+def read_blocks(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        block_type, length = unpack_from('<LL', data, offset)
+        assert unpack_from('<L', data, offset + length - 4)[0] == length
+        blocks.append((block_type, data[offset + 8:offset + length - 4]))
+        offset += length
+    return blocks
+
+
+class TestIpUdpPacket(unittest.TestCase):
+    def test_ipv4(self):
+        packet = ip_udp_packet(b'ike data', ('192.168.0.1', 500), ('192.168.0.2', 4500))
+        self.assertEqual(len(packet), 20 + 8 + 8)
+        self.assertEqual(_checksum(packet[:20]), 0)
+        self.assertEqual(packet[12:20], bytes([192, 168, 0, 1, 192, 168, 0, 2]))
+        self.assertEqual(unpack_from('>HHH', packet, 20), (500, 4500, 16))
+        self.assertEqual(packet[28:], b'ike data')
+
+    def test_ipv6(self):
+        packet = ip_udp_packet(b'ike data', ('2001:db8::1', 500), ('2001:db8::2', 500))
+        self.assertEqual(len(packet), 40 + 8 + 8)
+        self.assertEqual(packet[0] >> 4, 6)
+        self.assertEqual(unpack_from('>HBB', packet, 4), (16, 17, 64))
+        self.assertNotEqual(unpack_from('>H', packet, 46)[0], 0)
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'ike.pcapng')
+
+    def tearDown(self):
+        capture.stop()
+        self.tmpdir.cleanup()
+
+    def test_write(self):
+        cap = Capture(self.path)
+        cap.write_datagram(b'request', ('192.168.0.1', 500), ('192.168.0.2', 500))
+        cap.write_decrypted(b'cleartext', ('192.168.0.2', 500), ('192.168.0.1', 500))
+        # writes are buffered until flushed
+        self.assertEqual(os.path.getsize(self.path), 0)
+        cap.close()
+        blocks = read_blocks(self.path)
+        self.assertEqual([x[0] for x in blocks], [BLOCK_SHB, BLOCK_IDB, BLOCK_EPB, BLOCK_EPB])
+        self.assertEqual(unpack_from('<H', blocks[1][1])[0], LINKTYPE_RAW)
+        interface, _, _, captured, length = unpack_from('<LLLLL', blocks[2][1])
+        self.assertEqual((interface, captured, length), (0, 20 + 8 + 7, 20 + 8 + 7))
+        self.assertEqual(blocks[2][1][20 + 28:20 + 35], b'request')
+        self.assertIn(b'Decrypted', blocks[3][1])
+        self.assertEqual(cap.packets, 2)
+
+        # a new capture appends a new section
+        Capture(self.path).close()
+        self.assertEqual([x[0] for x in read_blocks(self.path)][4:], [BLOCK_SHB, BLOCK_IDB])
+
+    def test_rotate(self):
+        cap = Capture(self.path)
+        cap.MAX_SIZE = 1000
+        cap.MAX_FILES = 2
+        for _ in range(100):
+            cap.write_datagram(b'x' * 100, ('192.168.0.1', 500), ('192.168.0.2', 500))
+        cap.close()
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['ike.pcapng', 'ike.pcapng.1', 'ike.pcapng.2'])
+        for name in os.listdir(self.tmpdir.name):
+            blocks = read_blocks(os.path.join(self.tmpdir.name, name))
+            self.assertEqual([x[0] for x in blocks[:2]], [BLOCK_SHB, BLOCK_IDB])
+            self.assertLess(os.path.getsize(os.path.join(self.tmpdir.name, name)), 1000 + 200)
+
+    def test_write_keys(self):
+        cap = capture.start(self.path, decrypted=True)
+        self.assertIs(capture.active(), cap)
+        proposal = Proposal(1, Proposal.Protocol.IKE, b'', [
+            Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256),
+            Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA2_256_128)])
+        cap.write_keys(b'\x01' * 8, b'\x02' * 8, proposal, Keyring(b'd', b'\xa1', b'\xa2', b'\xe1', b'\xe2', b'p', b'p'))
+        capture.stop()
+        self.assertIsNone(capture.active())
+        with open(self.path + '.ikev2_decryption_table') as file:
+            self.assertEqual(file.read(), '"0101010101010101","0202020202020202","e1","e2","AES-CBC-256 [RFC3602]",'
+                                          '"a1","a2","HMAC_SHA2_256_128 [RFC4868]"\n')
+        self.assertEqual(os.stat(self.path + '.ikev2_decryption_table').st_mode & 0o777, 0o600)
+
+    def test_rotate_keys(self):
+        proposal = Proposal(1, Proposal.Protocol.IKE, b'', [
+            Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 128),
+            Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA1_96)])
+        keyring = Keyring(b'd', b'\xa1', b'\xa2', b'\xe1', b'\xe2', b'p', b'p')
+        cap = Capture(self.path, decrypted=True)
+        cap.MAX_SIZE = 1000
+        cap.write_keys(b'\x01' * 8, b'\x02' * 8, proposal, keyring)
+        cap.write_keys(b'\x03' * 8, b'\x04' * 8, proposal, keyring)
+        cap.forget_keys(b'\x03' * 8, b'\x04' * 8)
+        for _ in range(10):
+            cap.write_datagram(b'x' * 100, ('192.168.0.1', 500), ('192.168.0.2', 500))
+        cap.close()
+        with open(self.path + '.1.ikev2_decryption_table') as file:
+            self.assertEqual(len(file.read().splitlines()), 2)
+        # the new table only has the keys of the IKE_SAs still alive
+        with open(self.path + '.ikev2_decryption_table') as file:
+            self.assertEqual([x[:18] for x in file.read().splitlines()], ['"0101010101010101"'])
+        self.assertEqual(os.stat(self.path + '.ikev2_decryption_table').st_mode & 0o777, 0o600)
+
+
+if __name__ == '__main__':
+    unittest.main()
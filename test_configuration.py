@@ -3,11 +3,14 @@
 
 """ This module defines test configuration system
 """
+import random
 import unittest
-from ipaddress import ip_address
+from ipaddress import ip_address, ip_network
 
 from configuration import (
-    Configuration, ConfigurationError, ConfigurationNotFound)
+    Configuration, ConfigurationError, ConfigurationNotFound, PrefixTrie, ProtectIndex, ProtectList)
+from message import Transform, TrafficSelector
+from xfrm import Mode
 
 __author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
 
@@ -65,6 +68,176 @@ class TestConfiguration(unittest.TestCase):
         with self.assertRaises(ConfigurationNotFound):
             conf.get_ike_configuration('192.168.2.5')
 
+    def test_network_peers(self):
+        conf = Configuration(self.my_addr, {
+            '10.0.0.0/8': {'psk': 'wide'},
+            '10.1.0.0/16': {'psk': 'narrow'},
+            '10.1.0.5': {'psk': 'exact'},
+        })
+        self.assertEqual(conf.get_ike_configuration('10.1.0.5').psk, b'exact')
+        self.assertEqual(conf.get_ike_configuration('10.1.2.3').psk, b'narrow')
+        self.assertEqual(conf.get_ike_configuration('10.2.0.1').psk, b'wide')
+        self.assertEqual(conf.get_ike_configuration('10.1.2.3').protect[0].peer_subnet, ip_network('10.1.0.0/16'))
+        with self.assertRaises(ConfigurationNotFound):
+            conf.get_ike_configuration('11.0.0.1')
+        # only exact peers get policies at startup
+        self.assertEqual([x[0] for x in conf.items()], [ip_address('10.1.0.5')])
+        with self.assertRaises(ConfigurationError):
+            Configuration(self.my_addr, {'10.0.0.1/8': {}})
+
+    def test_prefix_trie(self):
+        trie = PrefixTrie()
+        trie.insert(ip_network('0.0.0.0/0'), 'default')
+        trie.insert(ip_network('192.168.0.0/24'), 'lan')
+        trie.insert(ip_network('2001:db8::/32'), 'v6')
+        self.assertEqual(trie.lookup(ip_address('192.168.0.7')), 'lan')
+        self.assertEqual(trie.lookup(ip_address('192.168.1.7')), 'default')
+        self.assertEqual(trie.lookup(ip_address('2001:db8::1')), 'v6')
+        self.assertIsNone(trie.lookup(ip_address('2001:db9::1')))
+
+    def test_protect_index(self):
+        rand = random.Random(0)
+        subnets = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3/32', '172.16.0.0/12', '0.0.0.0/0']
+        conf = Configuration(self.my_addr, {
+            '192.168.1.5': {
+                'protect': [{'my_subnet': rand.choice(subnets), 'peer_subnet': rand.choice(subnets),
+                             'my_port': rand.choice([0, 80]), 'ip_proto': rand.choice(['any', 'tcp']),
+                             'index': i} for i in range(100)]
+            }
+        })
+        protect = conf.get_ike_configuration('192.168.1.5').protect
+        self.assertIsInstance(protect, ProtectList)
+
+        def linear_lookup(tsi, tsr):
+            for ipsec_conf in protect:
+                conf_tsi = TrafficSelector.from_network(ipsec_conf.my_subnet, ipsec_conf.my_port, ipsec_conf.ip_proto)
+                conf_tsr = TrafficSelector.from_network(ipsec_conf.peer_subnet, ipsec_conf.peer_port,
+                                                        ipsec_conf.ip_proto)
+                if tsi.is_subset(conf_tsi) and tsr.is_subset(conf_tsr):
+                    return ipsec_conf, tsi, tsr
+                elif conf_tsi.is_subset(tsi) and conf_tsr.is_subset(tsr):
+                    return ipsec_conf, conf_tsi, conf_tsr
+            return None
+
+        for _ in range(200):
+            tsi = TrafficSelector.from_network(ip_network(rand.choice(subnets + ['10.1.2.4/31'])), rand.choice([0, 80]),
+                                               rand.choice([TrafficSelector.IpProtocol.ANY,
+                                                            TrafficSelector.IpProtocol.UDP]))
+            tsr = TrafficSelector.from_network(ip_network(rand.choice(subnets)), 0, TrafficSelector.IpProtocol.ANY)
+            self.assertEqual(protect.ts_index.lookup(tsi, tsr), linear_lookup(tsi, tsr))
+
+        # modifying the list rebuilds the index
+        tsi = TrafficSelector.from_network(ip_network('192.168.0.0/24'), 0, TrafficSelector.IpProtocol.ANY)
+        first = protect.ts_index.lookup(tsi, tsi)[0]
+        protect[0] = protect[0]._replace(my_subnet=ip_network('192.168.0.0/16'),
+                                         peer_subnet=ip_network('192.168.0.0/16'), my_port=0,
+                                         ip_proto=TrafficSelector.IpProtocol.ANY)
+        self.assertNotEqual(protect[0], first)
+        self.assertEqual(protect.ts_index.lookup(tsi, tsi), (protect[0], tsi, tsi))
+        self.assertIsNone(ProtectIndex([]).lookup(tsi, tsi))
+
+    def test_route_based(self):
+        conf = Configuration(self.my_addr, {
+            '192.168.1.5': {
+                'protect': [
+                    {
+                        'if_id': 7
+                    }
+                ]
+            }
+        })
+        ipsec_conf = conf.get_ike_configuration('192.168.1.5').protect[0]
+        self.assertEqual(ipsec_conf.if_id, 7)
+        self.assertEqual(ipsec_conf.mode, Mode.TUNNEL)
+        self.assertEqual(ipsec_conf.my_subnet, ip_network('0.0.0.0/0'))
+        self.assertEqual(ipsec_conf.peer_subnet, ip_network('0.0.0.0/0'))
+
+    def test_esn(self):
+        conf = Configuration(self.my_addr, {
+            '192.168.1.5': {
+                'protect': [
+                    {
+                        'esn': ['esn', 'noesn'],
+                        'replay_window': 1024
+                    }
+                ]
+            }
+        })
+        ipsec_conf = conf.get_ike_configuration('192.168.1.5').protect[0]
+        self.assertEqual([x.id for x in ipsec_conf.esn], [Transform.EsnId.ESN, Transform.EsnId.NO_ESN])
+        self.assertEqual(ipsec_conf.replay_window, 1024)
+
+    def test_esn_fallback(self):
+        conf = Configuration(self.my_addr, {
+            '192.168.1.5': {'protect': [{'esn': ['esn']}]},
+            '192.168.1.6': {'protect': [{}]},
+        })
+        # NO_ESN is always acceptable, after the configured ones
+        self.assertEqual([x.id for x in conf.get_ike_configuration('192.168.1.5').protect[0].esn],
+                         [Transform.EsnId.ESN, Transform.EsnId.NO_ESN])
+        self.assertEqual([x.id for x in conf.get_ike_configuration('192.168.1.6').protect[0].esn],
+                         [Transform.EsnId.NO_ESN])
+
+    def test_traffic_lifetimes(self):
+        conf = Configuration(self.my_addr, {
+            '192.168.1.5': {
+                'protect': [
+                    {
+                        'lifetime_bytes': 1000000,
+                        'lifetime_packets': 5000,
+                        'idle_timeout': 60
+                    }
+                ]
+            }
+        })
+        ipsec_conf = conf.get_ike_configuration('192.168.1.5').protect[0]
+        self.assertEqual(ipsec_conf.lifetime_bytes, 1000000)
+        self.assertEqual(ipsec_conf.lifetime_packets, 5000)
+        self.assertEqual(ipsec_conf.idle_timeout, 60)
+
+    def test_window_size(self):
+        conf = Configuration(self.my_addr, {'192.168.1.5': {'window_size': 10}})
+        self.assertEqual(conf.get_ike_configuration('192.168.1.5').window_size, 10)
+        with self.assertRaises(ConfigurationError):
+            Configuration(self.my_addr, {'192.168.1.5': {'window_size': 0}})
+
+    def test_redirect(self):
+        conf = Configuration(self.my_addr, {'192.168.1.5': {'redirect': ['192.168.1.2', '192.168.1.3']}})
+        self.assertEqual(conf.get_ike_configuration('192.168.1.5').redirect,
+                         [ip_address('192.168.1.2'), ip_address('192.168.1.3')])
+        with self.assertRaises(ConfigurationError):
+            Configuration(self.my_addr, {'192.168.1.5': {'redirect': ['gateway']}})
+
+    def test_auto_start(self):
+        conf = Configuration(self.my_addr, {'192.168.1.5': {'auto_start': True}, '192.168.1.6': {}})
+        self.assertTrue(conf.get_ike_configuration('192.168.1.5').auto_start)
+        self.assertFalse(conf.get_ike_configuration('192.168.1.6').auto_start)
+
+    def test_invalid_replay_window(self):
+        with self.assertRaises(ConfigurationError):
+            Configuration(self.my_addr, {
+                '192.168.1.5': {
+                    'protect': [
+                        {
+                            'replay_window': 10000
+                        }
+                    ]
+                }
+            })
+
+    def test_esn_without_replay_window(self):
+        with self.assertRaises(ConfigurationError):
+            Configuration(self.my_addr, {
+                '192.168.1.5': {
+                    'protect': [
+                        {
+                            'replay_window': 0,
+                            'esn': ['esn']
+                        }
+                    ]
+                }
+            })
+
     def test_invalid_dh(self):
         with self.assertRaises(ConfigurationError):
             Configuration(self.my_addr, {
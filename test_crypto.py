@@ -5,7 +5,7 @@
 """
 import unittest
 
-from crypto import Prf, Cipher, DiffieHellman, Integrity
+from crypto import Prf, Cipher, CookieGenerator, DiffieHellman, Integrity
 from message import Transform
 
 __author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
@@ -54,5 +54,17 @@ class TestCrypto(unittest.TestCase):
         checksum = integrity.compute(b'supersecret', b'This is a long message')
         self.assertEqual(checksum, b'\x0e\xb2\x8a\xa0N\x14\x0b$\x9a\x8c/\x9d<\x83\xd2\xf8\x94\x12\x1a\xbc\xd4b~\xd5\xd0\xa5\x02-\x0f\x8fcC')
 
+    def test_cookie(self):
+        generator = CookieGenerator()
+        cookie = generator.generate(b'nonce', b'\xc0\xa8\x00\x01', b'12345678')
+        self.assertTrue(generator.verify(cookie, b'nonce', b'\xc0\xa8\x00\x01', b'12345678'))
+        self.assertFalse(generator.verify(cookie, b'nonce', b'\xc0\xa8\x00\x02', b'12345678'))
+        self.assertFalse(generator.verify(b'', b'nonce', b'\xc0\xa8\x00\x01', b'12345678'))
+        # cookies from the previous secret are still valid, but not from older ones
+        generator.rotate_at = 0
+        self.assertTrue(generator.verify(cookie, b'nonce', b'\xc0\xa8\x00\x01', b'12345678'))
+        generator.rotate_at = 0
+        self.assertFalse(generator.verify(cookie, b'nonce', b'\xc0\xa8\x00\x01', b'12345678'))
+
 if __name__ == '__main__':
     unittest.main()
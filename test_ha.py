@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the ha module
+"""
+import logging
+import os
+import socket
+import tempfile
+import time
+import unittest
+from ipaddress import ip_address, ip_network
+from struct import pack
+from unittest.mock import patch
+
+from configuration import Configuration
+from ha import HaEvent, HaReceiver, HaSender, delete_event, oseq_event, upsert_event
+from message import Proposal, TrafficSelector, Transform
+from protocol_ import IkeSa, IkeSaController
+from snapshot import IkeSaSnapshot
+from xfrm import SaStats
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+logging.indent = 2
+
+
+def create_ike_sa_snapshot():
+    proposal = Proposal(1, Proposal.Protocol.IKE, b'',
+                        [Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256),
+                         Transform(Transform.Type.PRF, Transform.PrfId.PRF_HMAC_SHA2_256),
+                         Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA2_256_128),
+                         Transform(Transform.Type.DH, Transform.DhId.DH_14)])
+    return IkeSaSnapshot(True, False, b'A' * 8, b'B' * 8, 5, 3, 1, 100.5, 130.5, ip_address('192.168.0.1'),
+                         ip_address('192.168.0.2'), proposal, tuple(bytes([x]) * 32 for x in range(7)), [], True)
+
+
+def receive_until(receiver, condition, sender=None, timeout=2):
+    """ Runs the receiver (and the sender, if any, as both sides of the connection make progress without
+        blocking) until the condition is met
+    """
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        if sender is not None:
+            sender.flush()
+        receiver.receive(timeout=0.05)
+
+
+class TestHaStream(unittest.TestCase):
+    def setUp(self):
+        self.receiver = HaReceiver(('127.0.0.1', 0), b'key')
+        self.full_state = []
+        self.sender = HaSender(self.receiver.listen_sock.getsockname(), b'key', lambda: self.full_state)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def connect(self):
+        receive_until(self.receiver, lambda: self.sender.connected and self.receiver.sock is not None, self.sender)
+        self.assertTrue(self.sender.connected)
+        self.assertIsNotNone(self.receiver.sock)
+
+    def test_events(self):
+        ike_sa = create_ike_sa_snapshot()
+        self.full_state = [upsert_event(ike_sa)]
+        # events sent before connecting are superseded by the full state
+        self.sender.send(*oseq_event(b'1234', 10))
+        self.sender.flush()
+        self.connect()
+        self.assertEqual(self.receiver.ike_sas, {ike_sa.my_spi: ike_sa})
+        self.assertEqual(self.receiver.oseqs, {})
+
+        self.sender.send(*oseq_event(b'1234', 20))
+        self.sender.send(*delete_event(ike_sa.my_spi))
+        self.sender.flush()
+        receive_until(self.receiver, lambda: not self.receiver.ike_sas)
+        self.assertEqual(self.receiver.ike_sas, {})
+        self.assertEqual(self.receiver.oseqs, {b'1234': 20})
+
+    def test_batches(self):
+        self.sender.BATCH_SIZE = 2
+        self.connect()
+        for i in range(5):
+            self.sender.send(*oseq_event(b'1234', i))
+        # full batches are sent as soon as they are completed
+        self.assertEqual(len(self.sender.events), 1)
+        receive_until(self.receiver, lambda: self.receiver.oseqs.get(b'1234') == 3)
+        self.assertEqual(self.receiver.oseqs, {b'1234': 3})
+
+    def test_heartbeat(self):
+        self.connect()
+        self.receiver.last_seen = 0
+        self.assertTrue(self.receiver.is_active_lost())
+        self.sender.heartbeat_at = 0
+        self.sender.flush()
+        receive_until(self.receiver, lambda: not self.receiver.is_active_lost())
+        self.assertFalse(self.receiver.is_active_lost())
+
+    def test_wrong_key(self):
+        self.full_state = [upsert_event(create_ike_sa_snapshot())]
+        self.receiver.key = b'other key'
+        self.receiver.last_seen = 0
+        receive_until(self.receiver, lambda: self.sender.reconnect_at, self.sender)
+        # the sender does not stream anything to a standby member not knowing the key
+        self.assertFalse(self.sender.connected)
+        self.assertIsNone(self.sender.sock)
+        self.assertEqual(self.receiver.ike_sas, {})
+        self.assertTrue(self.receiver.is_active_lost())
+
+    def test_intruder(self):
+        self.connect()
+        sock = self.receiver.sock
+        last_seen = self.receiver.last_seen
+        # connections not knowing the key neither feed events nor displace the active member
+        intruder = socket.create_connection(self.receiver.listen_sock.getsockname())
+        intruder.sendall(bytes(16) + pack('>L', 7) + b'garbage')
+        intruder.setblocking(False)
+
+        def intruder_disconnected():
+            try:
+                return intruder.recv(4096) == b''
+            except BlockingIOError:
+                return False
+        receive_until(self.receiver, intruder_disconnected)
+        intruder.close()
+        self.assertIs(self.receiver.sock, sock)
+        self.assertEqual(list(self.receiver.connections), [sock])
+        self.assertEqual(self.receiver.last_seen, last_seen)
+
+    def test_tampered_batch(self):
+        self.connect()
+        self.sender.pending += pack('>L', 7) + b'garbage'
+        self.sender.send(*oseq_event(b'1234', 10))
+        self.sender.flush()
+        receive_until(self.receiver, lambda: self.receiver.sock is None)
+        self.assertIsNone(self.receiver.sock)
+        self.assertEqual(self.receiver.oseqs, {})
+
+    def test_unix_socket(self):
+        self.tearDown()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ha')
+            self.receiver = HaReceiver(path, b'key')
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.sender = HaSender(path, b'key', lambda: [oseq_event(b'1234', 10)])
+            receive_until(self.receiver, lambda: self.receiver.oseqs, self.sender)
+            self.assertEqual(self.receiver.oseqs, {b'1234': 10})
+            self.receiver.close()
+            self.assertFalse(os.path.exists(path))
+
+    def test_invalid_event(self):
+        self.receiver.apply(HaEvent.UPSERT, b'garbage')
+        self.receiver.apply(HaEvent.OSEQ, b'1234')
+        self.assertEqual(self.receiver.ike_sas, {})
+        self.assertEqual(self.receiver.oseqs, {})
+
+
+class TestHaTakeOver(unittest.TestCase):
+    @patch('xfrm.Xfrm')
+    def setUp(self, mockclass):
+        self.ip1 = ip_address("192.168.0.1")
+        self.ip2 = ip_address("192.168.0.2")
+        self.configuration = Configuration(self.ip1, {"192.168.0.2": {"psk": "testing", "protect": [{"index": 1}]}})
+        self.peer_configuration = Configuration(self.ip2,
+                                                {"192.168.0.1": {"psk": "testing", "protect": [{"index": 1}]}})
+        self.standby = IkeSaController(self.ip1, self.configuration, ha_role='standby', ha_addr=('127.0.0.1', 0),
+                                       ha_key=b'key')
+        self.active = IkeSaController(self.ip1, self.configuration, ha_role='active',
+                                      ha_addr=self.standby.ha_receiver.listen_sock.getsockname(), ha_key=b'key')
+        self.my_addr = (str(self.ip1), 500)
+        self.peer_addr = (str(self.ip2), 500)
+
+    def tearDown(self):
+        self.active.ha_sender.close()
+        if self.standby.ha_receiver is not None:
+            self.standby.ha_receiver.close()
+
+    @patch('xfrm.Xfrm')
+    def test_take_over(self, mockclass):
+        initiator = IkeSa(is_initiator=True, peer_spi=b'\0' * 8,
+                          configuration=self.peer_configuration.get_ike_configuration(self.ip1), my_addr=self.ip2,
+                          peer_addr=self.ip1)
+        tsi = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 0, TrafficSelector.IpProtocol.ANY)
+        tsr = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 0, TrafficSelector.IpProtocol.ANY)
+        ike_sa_init_req = initiator.process_acquire(tsi, tsr, 1)
+        ike_sa_init_res = self.active.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(self.active.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        self.assertTrue(initiator.msg_id_sync)
+        ike_sa = self.active.ike_sas[0]
+        child_sa = ike_sa.child_sas[0]
+
+        # replicate the IKE_SA and the outbound sequence number of its CHILD_SA
+        self.active.xfrm.get_all_sa_stats.return_value = {
+            child_sa.outbound_spi: SaStats(bytes=1000, packets=10, add_time=0, last_used=0)}
+        self.active.check_sad_timer(force=True)
+        self.active.replicate()
+        receiver = self.standby.ha_receiver
+        receive_until(receiver, lambda: ike_sa.my_spi in receiver.ike_sas, self.active.ha_sender)
+        self.active.check_sad_timer(force=True)
+        self.active.replicate()
+        receive_until(receiver, lambda: receiver.oseqs)
+        self.assertEqual(receiver.oseqs, {child_sa.outbound_spi: 10})
+
+        # IKE_SAs are not snapshotted again until they change
+        with patch.object(IkeSa, 'to_snapshot') as to_snapshot:
+            self.assertEqual(self.active._ha_events(), [])
+            to_snapshot.assert_not_called()
+
+        # message ID advances are replicated
+        dpd_req = initiator.generate_dead_peer_detection_request()
+        dpd_res = self.active.dispatch_message(initiator._send_request(dpd_req), self.my_addr, self.peer_addr)
+        self.assertIsNone(initiator.process_message(dpd_res))
+        self.active.replicate()
+        receive_until(receiver, lambda: receiver.ike_sas[ike_sa.my_spi].peer_msg_id == ike_sa.peer_msg_id)
+        self.assertEqual(receiver.ike_sas[ike_sa.my_spi].peer_msg_id, ike_sa.peer_msg_id)
+
+        # the standby member installs the IPsec SAs and synchronises the message IDs with the peer
+        mockclass.return_value.reset_mock()
+        requests = self.standby.take_over()
+        self.assertIsNone(self.standby.ha_receiver)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(len(self.standby.ike_sas), 1)
+        new_ike_sa = self.standby.ike_sas[0]
+        self.assertEqual(new_ike_sa.child_sas, [child_sa])
+        oseqs = {x[0][5]: x[1].get('oseq', 0) for x in mockclass.return_value.create_sa.call_args_list}
+        self.assertEqual(oseqs, {child_sa.inbound_spi: 0, child_sa.outbound_spi: 10 + IkeSaController.HA_OSEQ_JUMP})
+
+        sync_req_data, addr = requests[0]
+        self.assertEqual(addr, self.peer_addr)
+        sync_res_data = initiator.process_message(sync_req_data)
+        self.assertIsNone(self.standby.dispatch_message(sync_res_data, self.my_addr, self.peer_addr))
+        self.assertEqual(new_ike_sa.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(initiator.peer_msg_id, new_ike_sa.my_msg_id)
+        self.assertGreater(new_ike_sa.my_msg_id, ike_sa.my_msg_id)
+
+        # the peer keeps using the IKE_SA with the standby member, without a new handshake
+        dpd_req = initiator.generate_dead_peer_detection_request()
+        dpd_res = self.standby.dispatch_message(initiator._send_request(dpd_req), self.my_addr, self.peer_addr)
+        self.assertIsNone(initiator.process_message(dpd_res))
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+
+        # deletions are replicated too
+        self.active._remove_ike_sa(ike_sa)
+        self.assertEqual(self.active._ha_events(), [delete_event(ike_sa.my_spi)])
+
+
+if __name__ == '__main__':
+    unittest.main()
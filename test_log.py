@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the log module
+"""
+import io
+import sys
+import logging
+import unittest
+
+from log import BoundedQueueHandler, RateLimitFilter, setup
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+def make_record(msg, *args, level=logging.WARNING, created=0.0):
+    record = logging.LogRecord('test', level, __file__, 0, msg, args, None)
+    record.created = created
+    return record
+
+
+class TestBoundedQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = BoundedQueueHandler(2)
+
+    def test_drop(self):
+        for i in range(5):
+            self.handler.handle(make_record('Message %d', i))
+        self.assertEqual(self.handler.queue.qsize(), 2)
+        self.assertEqual(self.handler.dropped, 3)
+        self.assertEqual(self.handler.dropped_total, 3)
+        self.assertEqual([self.handler.queue.get_nowait().getMessage() for _ in range(2)],
+                         ['Message 0', 'Message 1'])
+
+        # the drops are reported as soon as there is room again
+        self.handler.handle(make_record('Message 5'))
+        self.assertEqual([self.handler.queue.get_nowait().getMessage() for _ in range(2)],
+                         ['Dropped 3 log records. The log queue was full', 'Message 5'])
+        self.assertEqual(self.handler.dropped, 0)
+        self.assertEqual(self.handler.dropped_total, 3)
+
+    def test_prepare(self):
+        arg = ['mutable']
+        self.handler.handle(make_record('Message %s', arg))
+        arg.append('changed')
+        record = self.handler.queue.get_nowait()
+        self.assertEqual(record.getMessage(), "Message ['mutable']")
+        # the formatting is left to the listener
+        self.assertFalse(hasattr(record, 'asctime'))
+
+    def test_exception(self):
+        try:
+            raise ValueError('wrong')
+        except ValueError:
+            self.handler.handle(logging.LogRecord('test', logging.ERROR, __file__, 0, 'Failed', None,
+                                                  sys.exc_info()))
+        record = self.handler.queue.get_nowait()
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ValueError: wrong', record.exc_text)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+    def setUp(self):
+        self.filter = RateLimitFilter()
+
+    def test_limit(self):
+        passed = [self.filter.filter(make_record('Unknown SPI=%s', i, created=i / 100)) for i in range(20)]
+        self.assertEqual(passed, [True] * RateLimitFilter.BURST + [False] * (20 - RateLimitFilter.BURST))
+        self.assertEqual(self.filter.suppressed_total, 20 - RateLimitFilter.BURST)
+
+        # other templates have their own window
+        self.assertTrue(self.filter.filter(make_record('Other %s', 1, created=1)))
+
+        # the next window starts indicating the suppressed ones
+        record = make_record('Unknown SPI=%s', 'abcd', created=RateLimitFilter.INTERVAL)
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.getMessage(), 'Unknown SPI=abcd ({} similar messages suppressed)'
+                                              ''.format(20 - RateLimitFilter.BURST))
+        record = make_record('Unknown SPI=%s', 'abcd', created=RateLimitFilter.INTERVAL)
+        self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.getMessage(), 'Unknown SPI=abcd')
+
+    def test_min_level(self):
+        self.assertTrue(all(self.filter.filter(make_record('Debug', level=logging.DEBUG)) for _ in range(20)))
+        self.assertEqual(self.filter.windows, {})
+
+    def test_max_templates(self):
+        self.filter.MAX_TEMPLATES = 10
+        for i in range(10):
+            self.filter.filter(make_record('Template {}'.format(i), created=0))
+        self.filter.filter(make_record('New template', created=RateLimitFilter.INTERVAL))
+        self.assertEqual(list(self.filter.windows), [(logging.WARNING, 'New template')])
+
+
+class TestSetup(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger()
+        self.old_level, self.old_handlers = self.logger.level, self.logger.handlers
+
+    def tearDown(self):
+        self.logger.handlers = self.old_handlers
+        self.logger.setLevel(self.old_level)
+
+    def test_setup(self):
+        listener = setup(logging.INFO, '[%(levelname)s] %(message)s', rate_limit=True)
+        output = io.StringIO()
+        listener.handlers[0].setStream(output)
+        for i in range(RateLimitFilter.BURST + 5):
+            logging.warning('Received message for unknown SPI=%s. Omitting.', i)
+        logging.debug('Not shown')
+        listener.stop()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines, ['[WARNING] Received message for unknown SPI={}. Omitting.'.format(i)
+                                 for i in range(RateLimitFilter.BURST)])
+
+
+if __name__ == '__main__':
+    unittest.main()
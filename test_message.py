@@ -4,6 +4,7 @@
 """ This module defines test for protocol messages.
 """
 import unittest
+from copy import deepcopy
 from ipaddress import ip_address
 from ipaddress import ip_network
 
@@ -12,7 +13,7 @@ from message import (
     PayloadNONCE, PayloadKE, PayloadVENDOR, PayloadSK, InvalidSyntax,
     Transform, Proposal, PayloadSA, Message, UnsupportedCriticalPayload,
     PayloadID, TrafficSelector, PayloadTS, PayloadAUTH, PayloadNOTIFY,
-    PayloadDELETE
+    PayloadDELETE, ProposalTable
 )
 
 __author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
@@ -111,6 +112,11 @@ class TestTransformWithKeylen(TestPayloadMixin, unittest.TestCase):
         another = Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256)
         self.assertNotEqual(self.object, another)
 
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.object.keylen = 256
+        self.assertEqual(deepcopy(self.object), self.object)
+
 
 class TestTransformWithoutKeylen(TestPayloadMixin, unittest.TestCase):
     def setUp(self):
@@ -190,6 +196,37 @@ class TestProposal(TestPayloadMixin, unittest.TestCase):
         self.assertNotEqual(self.object, proposal3)
 
 
+class TestProposalTable(unittest.TestCase):
+    def setUp(self):
+        self.aes128 = Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 128)
+        self.aes256 = Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256)
+        self.sha1 = Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA1_96)
+        self.sha256 = Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA2_256_128)
+        self.table = ProposalTable.get(Proposal.Protocol.ESP, (self.aes256, self.aes128, self.sha256, self.sha1))
+
+    def test_negotiate(self):
+        peer_proposal = Proposal(3, Proposal.Protocol.ESP, b'1234', [self.sha1, self.aes128, self.sha256, self.aes256])
+        self.assertEqual(self.table.negotiate(peer_proposal),
+                         Proposal(3, Proposal.Protocol.ESP, b'1234', [self.aes256, self.sha256]))
+        # transforms of types we do not use are ignored
+        peer_proposal = Proposal(3, Proposal.Protocol.ESP, b'1234',
+                                 [self.aes128, self.sha1, Transform(Transform.Type.ESN, Transform.EsnId.NO_ESN)])
+        self.assertEqual(self.table.negotiate(peer_proposal).transforms, [self.aes128, self.sha1])
+
+    def test_no_match(self):
+        self.assertIsNone(self.table.negotiate(Proposal(1, Proposal.Protocol.ESP, b'', [self.aes128])))
+        self.assertIsNone(self.table.negotiate(Proposal(1, Proposal.Protocol.AH, b'', [self.aes128, self.sha1])))
+
+    def test_shared(self):
+        transforms = (Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256), self.aes128, self.sha256,
+                      self.sha1)
+        self.assertIs(ProposalTable.get(Proposal.Protocol.ESP, transforms), self.table)
+        self.assertEqual(self.table.by_type[Transform.Type.ENCR], frozenset([self.aes128, self.aes256]))
+        self.assertEqual(self.table.to_proposal(b'5678'),
+                         Proposal(1, Proposal.Protocol.ESP, b'5678',
+                                  [self.aes256, self.aes128, self.sha256, self.sha1]))
+
+
 class TestPayloadSA(TestPayloadMixin, unittest.TestCase):
     def setUp(self):
         super(TestPayloadSA, self).setUp()
@@ -214,6 +251,11 @@ class TestPayloadSA(TestPayloadMixin, unittest.TestCase):
         with self.assertRaises(InvalidSyntax):
             PayloadSA([])
 
+    def test_parse_proposals(self):
+        # proposals of different lengths, the longest one last
+        proposals = list(reversed(self.object.proposals))
+        self.assertEqual(PayloadSA.parse(PayloadSA(proposals).to_bytes()).proposals, proposals)
+
 
 class TestPayloadNOTIFY(TestPayloadMixin, unittest.TestCase):
     def setUp(self):
@@ -229,6 +271,15 @@ class TestPayloadNOTIFY(TestPayloadMixin, unittest.TestCase):
         payload = PayloadNOTIFY.parse(data)
         self.assertEqual(payload.spi, b'')
 
+    def test_gw_identity(self):
+        for addr in (ip_address('192.168.0.1'), ip_address('2001:db8::1')):
+            data = PayloadNOTIFY.gw_identity_to_bytes(addr) + b'nonce'
+            self.assertEqual(PayloadNOTIFY.parse_gw_identity(data), (addr, b'nonce'))
+        with self.assertRaises(InvalidSyntax):
+            PayloadNOTIFY.parse_gw_identity(b'\x03\x07example')
+        with self.assertRaises(InvalidSyntax):
+            PayloadNOTIFY.parse_gw_identity(b'\x01')
+
 
 class TestPayloadIDIpAddr(TestPayloadMixin, unittest.TestCase):
     def setUp(self):
@@ -282,6 +333,26 @@ class TestTrafficSelector(TestPayloadMixin, unittest.TestCase):
                               ip_address('192.168.10.10'))
         self.assertEqual(ts2.get_network(), ip_network('192.168.0.0/20'))
 
+    def test_ipv6(self):
+        ts = TrafficSelector.from_network(ip_network('2001:db8::/48'), 443, TrafficSelector.IpProtocol.TCP)
+        self.assertEqual(ts.ts_type, TrafficSelector.Type.TS_IPV6_ADDR_RANGE)
+        self.assertEqual(ts.end_addr, ip_address('2001:db8:0:ffff:ffff:ffff:ffff:ffff'))
+        self.assertEqual(ts.get_prefix(), (int(ip_address('2001:db8::')), 48))
+        self.assertEqual(ts.get_network(), ip_network('2001:db8::/48'))
+        self.assertEqual(TrafficSelector.parse(ts.to_bytes()), ts)
+        self.assertFalse(ts.is_subset(TrafficSelector.from_network(ip_network('0.0.0.0/0'), 0, 0)))
+        self.assertTrue(ts.is_subset(TrafficSelector.from_network(ip_network('::/0'), 0, 0)))
+
+    def test_int_addresses(self):
+        ts = TrafficSelector(TrafficSelector.Type.TS_IPV4_ADDR_RANGE, TrafficSelector.IpProtocol.ANY, 0, 65535,
+                             int(ip_address('10.0.0.0')), int(ip_address('10.0.0.255')))
+        self.assertEqual(ts, TrafficSelector.from_network(ip_network('10.0.0.0/24'), 0, 0))
+        self.assertEqual(ts.start_addr, ip_address('10.0.0.0'))
+        self.assertEqual(TrafficSelector.from_address(ip_address('10.0.0.1'), 0, 0).get_prefix(),
+                         (int(ip_address('10.0.0.1')), 32))
+        with self.assertRaises(AttributeError):
+            ts.other = 1
+
 
 class TestPayloadTS(TestPayloadMixin, unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the metrics module
+"""
+import os
+import socket
+import tempfile
+import unittest
+from select import select
+
+from metrics import MetricsServer, Registry
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('test_total', 'Test counter.', ('exchange',))
+        counter.inc('IKE_AUTH')
+        counter.inc('IKE_AUTH', amount=2)
+        counter.inc('INFORMATIONAL')
+        self.assertEqual(counter.get('IKE_AUTH'), 3)
+        self.assertEqual(self.registry.to_text(), '# HELP test_total Test counter.\n'
+                                                  '# TYPE test_total counter\n'
+                                                  'test_total{exchange="IKE_AUTH"} 3\n'
+                                                  'test_total{exchange="INFORMATIONAL"} 1\n')
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('test', 'Test gauge.')
+        gauge.set(5)
+        gauge.dec(amount=2)
+        self.assertEqual(gauge.get(), 3)
+        self.assertIn('\ntest 3\n', self.registry.to_text())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('test_seconds', 'Test histogram.', ('role',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, 'initiator')
+        self.assertEqual(histogram.get_count('initiator'), 4)
+        self.assertEqual(histogram.get_count('responder'), 0)
+        self.assertEqual(self.registry.to_text().splitlines()[2:], [
+            'test_seconds_bucket{role="initiator",le="0.1"} 2',
+            'test_seconds_bucket{role="initiator",le="1"} 3',
+            'test_seconds_bucket{role="initiator",le="+Inf"} 4',
+            'test_seconds_sum{role="initiator"} 2.65',
+            'test_seconds_count{role="initiator"} 4'])
+
+    def test_escape(self):
+        self.registry.counter('test_total', 'Test counter.', ('name',)).inc('a "b"\\\n')
+        self.assertIn(r'test_total{name="a \"b\"\\\n"} 1', self.registry.to_text())
+
+    def test_duplicated(self):
+        self.registry.counter('test_total', 'Test counter.')
+        with self.assertRaises(ValueError):
+            self.registry.gauge('test_total', 'Test gauge.')
+
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = self.registry.counter('test_total', 'Test counter.')
+        self.scrapes = 0
+
+    def on_scrape(self):
+        self.scrapes += 1
+        self.counter.inc()
+
+    def get(self, server, family, addr, request=b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n'):
+        client = socket.socket(family, socket.SOCK_STREAM)
+        client.connect(addr)
+        client.sendall(request)
+        client.setblocking(False)
+        response = bytearray()
+        while True:
+            server.process(select(server.get_sockets(), [], [], 0.1)[0])
+            try:
+                data = client.recv(65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                break
+            response += data
+        client.close()
+        return bytes(response)
+
+    def test_tcp(self):
+        server = MetricsServer(('127.0.0.1', 0), self.registry, self.on_scrape)
+        try:
+            addr = server.listen_sock.getsockname()
+            response = self.get(server, socket.AF_INET, addr)
+            self.assertTrue(response.startswith(b'HTTP/1.0 200 OK\r\n'))
+            self.assertTrue(response.endswith(b'\ntest_total 1\n'))
+            self.assertEqual(self.scrapes, 1)
+            self.assertTrue(self.get(server, socket.AF_INET, addr, b'GET /other HTTP/1.1\r\n\r\n')
+                            .startswith(b'HTTP/1.0 404 Not Found\r\n'))
+            self.assertTrue(self.get(server, socket.AF_INET, addr, b'POST /metrics HTTP/1.1\r\n\r\n')
+                            .startswith(b'HTTP/1.0 405 Method Not Allowed\r\n'))
+            self.assertEqual(self.scrapes, 1)
+            self.assertEqual(server.clients, {})
+        finally:
+            server.close()
+
+    def test_unix(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'metrics.sock')
+            server = MetricsServer(path, self.registry)
+            try:
+                self.assertTrue(self.get(server, socket.AF_UNIX, path).endswith(b'\ntest_total 0\n'))
+            finally:
+                server.close()
+            self.assertFalse(os.path.exists(path))
+
+            # other files are never removed
+            with open(path, 'w'):
+                pass
+            with self.assertRaises(FileExistsError):
+                MetricsServer(path, self.registry)
+            self.assertTrue(os.path.exists(path))
+
+    def test_timeout(self):
+        server = MetricsServer(('127.0.0.1', 0), self.registry)
+        server.TIMEOUT = -1
+        try:
+            client = socket.create_connection(server.listen_sock.getsockname())
+            server.process(select(server.get_sockets(), [], [], 1)[0])
+            server.process([])
+            self.assertEqual(server.clients, {})
+            client.close()
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,15 +7,26 @@
 __author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
 
 import logging
+import os
+import socket
+import tempfile
 import time
 from ipaddress import ip_address, ip_network
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+import capture
+import protocol_
+import snapshot
 import xfrm
+from admission import TokenBucket
 from configuration import Configuration
-from message import TrafficSelector, Transform, Proposal, Message, Payload, PayloadAUTH, PayloadNOTIFY
-from protocol_ import IkeSa
+from message import (TrafficSelector, Transform, Proposal, Message, Payload, PayloadAUTH, PayloadID,
+                     PayloadNOTIFY)
+from protocol_ import IkeSa, IkeSaController
+from rekey import RekeyGovernor
+from resumption import TicketManager
+from xfrm import SaStats, XfrmAddress, XfrmId, XfrmSelector, XfrmUserAcquire, XfrmUserPolicyInfo
 
 logging.indent = 2
 logging.basicConfig(level=logging.INFO,
@@ -95,6 +106,113 @@ class TestIkeSa(TestCase):
         self.assertEqual(len(self.ike_sa1.child_sas), 1)
         self.assertEqual(len(self.ike_sa2.child_sas), 1)
 
+    @patch('xfrm.Xfrm')
+    def test_lazy_logging(self, mockclass):
+        # with INFO logging, neither the JSON dumps nor the key material get formatted
+        with patch.object(Message, 'to_dict', side_effect=AssertionError), \
+                patch('protocol_.hexstring', wraps=protocol_.hexstring) as hexstring, \
+                self.assertLogs(level=logging.INFO) as logs:
+            self.test_initial_exchanges_transport()
+        self.assertNotIn(self.ike_sa1.ike_sa_keyring.sk_d, [x[0][0] for x in hexstring.call_args_list])
+        self.assertTrue(any(x.startswith('INFO:root:IKE_SA: {}. Sent IKE_SA_INIT request'.format(self.ike_sa1))
+                            for x in logs.output))
+
+        # with DEBUG logging they do, and are prefixed with the SPI of the IKE_SA
+        with self.assertLogs(level=logging.DEBUG) as logs:
+            self.ike_sa1.generate_ike_sa_key_material(self.ike_sa1.chosen_proposal, b'1' * 32, b'2' * 32, b'3' * 8,
+                                                       b'4' * 8, b'5' * 32)
+        self.assertTrue(all(x.startswith('DEBUG:root:IKE_SA: {}. Generated'.format(self.ike_sa1))
+                            for x in logs.output))
+        self.assertEqual(len(logs.output), 8)
+
+    @patch('xfrm.Xfrm')
+    def test_capture(self, mockclass):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'ike.pcapng')
+            capture.start(path, decrypted=True)
+            try:
+                with patch.object(capture.Capture, 'write_decrypted') as write_decrypted:
+                    self.test_initial_exchanges_transport()
+            finally:
+                capture.stop()
+            with open(path + '.ikev2_decryption_table') as file:
+                lines = file.read().splitlines()
+        # both ends write the keys of the IKE_SA
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('"{}","{}"'.format(self.ike_sa1.my_spi.hex(), self.ike_sa1.peer_spi.hex())))
+        # the IKE_AUTH request and response are written in cleartext, as sent and as received
+        self.assertEqual(write_decrypted.call_count, 4)
+        data, src, dst = write_decrypted.call_args_list[0][0]
+        self.assertEqual((src, dst), (('192.168.0.1', 500), ('192.168.0.2', 500)))
+        message = Message.parse(data)
+        self.assertEqual(message.exchange_type, Message.Exchange.IKE_AUTH)
+        self.assertIn(Payload.Type.IDi, [x.type for x in message.payloads])
+
+    @patch('xfrm.Xfrm')
+    def test_initial_exchanges_esn(self, mockclass):
+        esn = Transform(Transform.Type.ESN, Transform.EsnId.ESN)
+        no_esn = Transform(Transform.Type.ESN, Transform.EsnId.NO_ESN)
+        self.ike_sa1.configuration.protect[0] = self.ike_sa1.configuration.protect[0]._replace(esn=[esn, no_esn])
+        self.ike_sa2.configuration.protect[0] = self.ike_sa2.configuration.protect[0]._replace(esn=[esn])
+        self.test_initial_exchanges_transport()
+        self.assertEqual(self.ike_sa1.child_sas[0].proposal.get_transform(Transform.Type.ESN), esn)
+        self.assertEqual(self.ike_sa2.child_sas[0].proposal.get_transform(Transform.Type.ESN), esn)
+        # both IkeSa objects share the same mocked Xfrm instance
+        self.assertEqual(self.ike_sa1.xfrm.create_sa.call_count, 4)
+        for call in self.ike_sa1.xfrm.create_sa.call_args_list:
+            self.assertTrue(call[1]['esn'])
+            self.assertEqual(call[1]['replay_window'], 32)
+
+    @patch('xfrm.Xfrm')
+    def test_initial_exchanges_mixed_esn(self, mockclass):
+        esn = Transform(Transform.Type.ESN, Transform.EsnId.ESN)
+        no_esn = Transform(Transform.Type.ESN, Transform.EsnId.NO_ESN)
+        # only the initiator enables ESN, and the responder does not send any ESN transform
+        self.ike_sa1.configuration.protect[0] = self.ike_sa1.configuration.protect[0]._replace(esn=[esn, no_esn])
+        self.ike_sa2.configuration.protect[0] = self.ike_sa2.configuration.protect[0]._replace(esn=[])
+        self.test_initial_exchanges_transport()
+        self.assertEqual(self.ike_sa1.child_sas[0].proposal.get_transform(Transform.Type.ESN), no_esn)
+        for call in self.ike_sa1.xfrm.create_sa.call_args_list:
+            self.assertFalse(call[1]['esn'])
+
+    @patch('xfrm.Xfrm')
+    def test_create_child_per_cpu(self, mockclass):
+        for ike_sa in (self.ike_sa1, self.ike_sa2):
+            ike_sa.configuration.protect[0] = ike_sa.configuration.protect[0]._replace(per_cpu_sas=True)
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        ike_sa_init_req = self.ike_sa1.process_acquire(small_tsi, small_tsr, 1, cpu=3)
+        ike_sa_init_res = self.ike_sa2.process_message(ike_sa_init_req)
+        ike_auth_req = self.ike_sa1.process_message(ike_sa_init_res)
+        ike_auth_res = self.ike_sa2.process_message(ike_auth_req)
+        self.assertIsNone(self.ike_sa1.process_message(ike_auth_res))
+        self.assertMessageHasNotification(ike_auth_res, self.ike_sa2, PayloadNOTIFY.Type.SA_RESOURCE_INFO)
+        # the first CHILD_SA is the fallback one, not bound to any CPU
+        self.assertIsNone(self.ike_sa1.child_sas[0].cpu)
+        create_child_req = self.ike_sa1.process_acquire(small_tsi, small_tsr, 1, cpu=3)
+        create_child_res = self.ike_sa2.process_message(create_child_req)
+        self.assertIsNone(self.ike_sa1.process_message(create_child_res))
+        self.assertEqual(len(self.ike_sa1.child_sas), 2)
+        self.assertEqual(len(self.ike_sa2.child_sas), 2)
+        self.assertEqual(self.ike_sa1.child_sas[1].cpu, 3)
+        self.assertEqual(self.ike_sa1.xfrm.create_sa.call_args_list[-2][1]['cpu'], 3)
+        # a second ACQUIRE for the same CPU is omitted
+        self.assertIsNone(self.ike_sa1.process_acquire(small_tsi, small_tsr, 1, cpu=3))
+
+    @patch('os.cpu_count', return_value=1)
+    @patch('xfrm.Xfrm')
+    def test_create_child_per_cpu_max_queue(self, mockclass, cpu_count):
+        self.test_create_child_per_cpu()
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        create_child_req = self.ike_sa1.process_acquire(small_tsi, small_tsr, 1, cpu=4)
+        create_child_res = self.ike_sa2.process_message(create_child_req)
+        self.assertMessageHasNotification(create_child_res, self.ike_sa2, PayloadNOTIFY.Type.TS_MAX_QUEUE)
+        self.assertIsNone(self.ike_sa1.process_message(create_child_res))
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(len(self.ike_sa1.child_sas), 2)
+        self.assertEqual(len(self.ike_sa2.child_sas), 2)
+
     @patch('xfrm.Xfrm')
     def test_create_child_ok(self, mockclass):
         self.test_initial_exchanges_transport()
@@ -109,9 +227,43 @@ class TestIkeSa(TestCase):
         self.assertEqual(len(self.ike_sa1.child_sas), 2)
         self.assertEqual(len(self.ike_sa2.child_sas), 2)
 
+    @patch('xfrm.Xfrm')
+    def test_create_child_by_responder(self, mockclass):
+        self.test_initial_exchanges_transport()
+        self.ike_sa1.xfrm, self.ike_sa2.xfrm = MagicMock(), MagicMock()
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        create_child_req = self.ike_sa2.process_acquire(small_tsi, small_tsr, 2)
+        create_child_res = self.ike_sa1.process_message(create_child_req)
+        self.assertIsNone(self.ike_sa2.process_message(create_child_res))
+
+        # the initiator of the CREATE_CHILD_SA exchange (the IKE responder) owns the "i" keys
+        def installed_keys(ike_sa, src, spi):
+            [call] = [x for x in ike_sa.xfrm.create_sa.call_args_list if x[0][0] == src and x[0][5] == spi]
+            return call[0][7], call[0][9]
+
+        for ike_sa, exchange_initiator in ((self.ike_sa2, True), (self.ike_sa1, False)):
+            child_sa = ike_sa.child_sas[-1]
+            self.assertEqual(child_sa.exchange_initiator, exchange_initiator)
+            keyring = child_sa.keyring
+            outbound_keys = (keyring.sk_ei, keyring.sk_ai) if exchange_initiator else (keyring.sk_er, keyring.sk_ar)
+            inbound_keys = (keyring.sk_er, keyring.sk_ar) if exchange_initiator else (keyring.sk_ei, keyring.sk_ai)
+            self.assertEqual(installed_keys(ike_sa, ike_sa.my_addr, child_sa.outbound_spi), outbound_keys)
+            self.assertEqual(installed_keys(ike_sa, ike_sa.peer_addr, child_sa.inbound_spi), inbound_keys)
+
+        # and keeps them when the CHILD_SA is restored
+        ike_sa_snapshot = snapshot.parse(snapshot.to_bytes([self.ike_sa2.to_snapshot()])).ike_sas[0]
+        restored = IkeSa.from_snapshot(ike_sa_snapshot, self.ike_sa2.configuration)
+        self.assertEqual(restored.child_sas, self.ike_sa2.child_sas)
+        restored.xfrm.create_sa.reset_mock()
+        restored.take_over()
+        child_sa = restored.child_sas[-1]
+        self.assertEqual(installed_keys(restored, restored.my_addr, child_sa.outbound_spi),
+                         (child_sa.keyring.sk_ei, child_sa.keyring.sk_ai))
+
     @patch('xfrm.Xfrm')
     def test_ike_sa_init_no_proposal_chosen(self, mockclass):
-        self.ike_sa1.configuration.dh[0].id = Transform.DhId.DH_16
+        self.ike_sa1.configuration.dh[0] = Transform(Transform.Type.DH, Transform.DhId.DH_16)
         small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
         small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
         ike_sa_init_req = self.ike_sa1.process_acquire(small_tsi, small_tsr, 1)
@@ -262,8 +414,10 @@ class TestIkeSa(TestCase):
         create_child_sa_req = self.ike_sa1.check_retransmission_timer()
         self.assertIsNone(create_child_sa_req)
         self.ike_sa1.retransmit_at = time.time()
+        retransmissions = protocol_.RETRANSMISSIONS.get()
         create_child_sa_req = self.ike_sa1.check_retransmission_timer()
         self.assertIsNotNone(create_child_sa_req)
+        self.assertEqual(protocol_.RETRANSMISSIONS.get(), retransmissions + 1)
         create_child_sa_res2 = self.ike_sa2.process_message(create_child_sa_req)
         request = self.ike_sa1.process_message(create_child_sa_res2)
         self.assertIsNone(request)
@@ -273,6 +427,184 @@ class TestIkeSa(TestCase):
         self.assertEqual(len(self.ike_sa1.child_sas), 2)
         self.assertEqual(len(self.ike_sa2.child_sas), 2)
 
+    @patch('xfrm.Xfrm')
+    def test_retransmit_without_decryption(self, mockclass):
+        self.test_initial_exchanges_transport()
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        create_child_sa_req = self.ike_sa1.process_acquire(small_tsi, small_tsr, 1)
+        create_child_sa_res = self.ike_sa2.process_message(create_child_sa_req)
+        # the retransmission is answered parsing its header only
+        with patch.object(Message, 'parse', wraps=Message.parse) as parse:
+            self.assertEqual(self.ike_sa2.process_message(create_child_sa_req), create_child_sa_res)
+        self.assertTrue(all(x[1].get('header_only') for x in parse.call_args_list))
+        self.assertEqual(len(self.ike_sa2.child_sas), 2)
+
+    def _establish_with_window(self, window_size):
+        self.ike_sa1.configuration = self.ike_sa1.configuration._replace(window_size=window_size)
+        self.ike_sa2.configuration = self.ike_sa2.configuration._replace(window_size=window_size)
+        self.test_initial_exchanges_transport()
+        self.assertEqual(self.ike_sa1.peer_window_size, window_size)
+        self.assertEqual(self.ike_sa2.peer_window_size, window_size)
+
+    @patch('xfrm.Xfrm')
+    def test_window_pipelined_create_child_sas(self, mockclass):
+        self._establish_with_window(4)
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        requests = [self.ike_sa1.process_acquire(small_tsi, small_tsr, 1) for i in range(5)]
+        # only 4 requests fit in the window, the last one is queued
+        self.assertIsNone(requests.pop())
+        self.assertEqual(len(self.ike_sa1.pending_events), 1)
+        self.assertEqual(sorted(self.ike_sa1.window), [3, 4, 5])
+        # responder processes them out of order
+        responses = [self.ike_sa2.process_message(x) for x in reversed(requests)]
+        self.assertEqual(self.ike_sa2.peer_msg_id, 6)
+        # retransmissions of any of them are answered from the cache
+        self.assertEqual(self.ike_sa2.process_message(requests[1]), responses[2])
+        # responses are processed out of order too, and the queued request is sent once there is room
+        self.assertIsNone(self.ike_sa1.process_message(responses[0]))
+        self.assertIsNone(self.ike_sa1.process_message(responses[1]))
+        queued_request = self.ike_sa1.process_message(responses[3])
+        self.assertIsNotNone(queued_request)
+        self.assertIsNone(self.ike_sa1.process_message(responses[2]))
+        self.assertIsNone(self.ike_sa1.process_message(self.ike_sa2.process_message(queued_request)))
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(self.ike_sa1.window, {})
+        self.assertEqual(len(self.ike_sa1.child_sas), 6)
+        self.assertEqual(len(self.ike_sa2.child_sas), 6)
+
+    @patch('xfrm.Xfrm')
+    def test_window_pipelined_rekey(self, mockclass):
+        self._establish_with_window(2)
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        create_child_sa_req = self.ike_sa1.process_acquire(small_tsi, small_tsr, 1)
+        rekey_req = self.ike_sa1.process_expire(self.ike_sa1.child_sas[0].inbound_spi)
+        self.assertEqual(len(self.ike_sa1.window), 1)
+        # pipelined requests are retransmitted on their own
+        self.assertEqual(self.ike_sa1.check_window_retransmission_timers(), [])
+        self.ike_sa1.window[3] = self.ike_sa1.window[3]._replace(retransmit_at=0)
+        self.assertEqual(len(self.ike_sa1.check_window_retransmission_timers()), 1)
+        rekey_res = self.ike_sa2.process_message(rekey_req)
+        create_child_sa_res = self.ike_sa2.process_message(create_child_sa_req)
+        self.assertIsNone(self.ike_sa1.process_message(rekey_res))
+        delete_req = self.ike_sa1.process_message(create_child_sa_res)
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.DEL_CHILD_REQ_SENT)
+        self.ike_sa1.process_message(self.ike_sa2.process_message(delete_req))
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(len(self.ike_sa1.child_sas), 2)
+        self.assertEqual(len(self.ike_sa2.child_sas), 2)
+
+    @patch('xfrm.Xfrm')
+    def test_no_window(self, mockclass):
+        self.test_initial_exchanges_transport()
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        self.ike_sa1.process_acquire(small_tsi, small_tsr, 1)
+        self.assertIsNone(self.ike_sa1.process_acquire(small_tsi, small_tsr, 1))
+        self.assertEqual(len(self.ike_sa1.pending_events), 1)
+
+    def _enable_resumption(self):
+        for ike_sa in (self.ike_sa1, self.ike_sa2):
+            ike_sa.configuration = ike_sa.configuration._replace(resumption=True)
+            ike_sa.ticket_manager = TicketManager()
+
+    def _resume(self, responder_ticket_manager):
+        """ Creates a new pair of IKE_SAs, where the initiator resumes the previous IKE_SA
+        """
+        initiator = IkeSa(is_initiator=True, peer_spi=b'\0' * 8, configuration=self.ike_sa1.configuration,
+                          my_addr=self.ip1, peer_addr=self.ip2, ticket_manager=self.ike_sa1.ticket_manager)
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        request = initiator.process_acquire(small_tsi, small_tsr, 1)
+        responder = IkeSa(is_initiator=False, peer_spi=initiator.my_spi, configuration=self.ike_sa2.configuration,
+                          my_addr=self.ip2, peer_addr=self.ip1, ticket_manager=responder_ticket_manager)
+        return initiator, responder, request
+
+    @patch('xfrm.Xfrm')
+    def test_session_resumption(self, mockclass):
+        self._enable_resumption()
+        self.test_initial_exchanges_transport()
+        self.assertIn(self.ip2, self.ike_sa1.ticket_manager.tickets)
+
+        initiator, responder, resume_req = self._resume(self.ike_sa2.ticket_manager)
+        self.assertEqual(Message.parse(resume_req).exchange_type, Message.Exchange.IKE_SESSION_RESUME)
+        self.assertNotIn(self.ip2, initiator.ticket_manager.tickets)
+        with patch('protocol_.DiffieHellman') as dh:
+            resume_res = responder.process_message(resume_req)
+            ike_auth_req = initiator.process_message(resume_res)
+            ike_auth_res = responder.process_message(ike_auth_req)
+            self.assertIsNone(initiator.process_message(ike_auth_res))
+            dh.assert_not_called()
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(responder.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(len(initiator.child_sas), 1)
+        self.assertNotEqual(initiator.ike_sa_keyring.sk_d, self.ike_sa1.ike_sa_keyring.sk_d)
+        # a new ticket is issued for the resumed IKE_SA
+        self.assertIn(self.ip2, initiator.ticket_manager.tickets)
+
+    @patch('xfrm.Xfrm')
+    def test_session_resumption_rejected(self, mockclass):
+        self._enable_resumption()
+        self.test_initial_exchanges_transport()
+
+        # the responder has been restarted, and does not know the ticket key anymore
+        initiator, responder, resume_req = self._resume(TicketManager())
+        resume_res = responder.process_message(resume_req)
+        self.assertMessageHasNotification(resume_res, responder, PayloadNOTIFY.Type.TICKET_NACK)
+        self.assertEqual(responder.state, IkeSa.State.DELETED)
+        ike_sa_init_req = initiator.process_message(resume_res)
+        self.assertEqual(Message.parse(ike_sa_init_req).exchange_type, Message.Exchange.IKE_SA_INIT)
+        self.assertEqual(Message.parse(ike_sa_init_req).message_id, 0)
+
+    @patch('xfrm.Xfrm')
+    def test_session_resumption_other_configuration(self, mockclass):
+        self._enable_resumption()
+        self.test_initial_exchanges_transport()
+
+        # the ticket is not valid under a configuration with a different PSK
+        initiator, responder, resume_req = self._resume(self.ike_sa2.ticket_manager)
+        responder.configuration = responder.configuration._replace(psk=b'other')
+        resume_res = responder.process_message(resume_req)
+        self.assertMessageHasNotification(resume_res, responder, PayloadNOTIFY.Type.TICKET_NACK)
+        self.assertEqual(responder.state, IkeSa.State.DELETED)
+
+    @patch('xfrm.Xfrm')
+    def test_session_resumption_other_identity(self, mockclass):
+        self._enable_resumption()
+        self.test_initial_exchanges_transport()
+
+        # the ticket cannot be used for authenticating as a different identity
+        initiator, responder, resume_req = self._resume(self.ike_sa2.ticket_manager)
+        initiator.configuration = initiator.configuration._replace(
+            id=PayloadID(PayloadID.Type.ID_FQDN, b'other.example.com'))
+        resume_res = responder.process_message(resume_req)
+        ike_auth_req = initiator.process_message(resume_res)
+        ike_auth_res = responder.process_message(ike_auth_req)
+        self.assertIsNone(initiator.process_message(ike_auth_res))
+        self.assertMessageHasNotification(ike_auth_res, responder, PayloadNOTIFY.Type.AUTHENTICATION_FAILED)
+        self.assertNotEqual(responder.state, IkeSa.State.ESTABLISHED)
+
+    @patch('xfrm.Xfrm')
+    def test_snapshot_restore(self, mockclass):
+        self.test_initial_exchanges_transport()
+        ike_sa_snapshot = snapshot.parse(snapshot.to_bytes([self.ike_sa1.to_snapshot()])).ike_sas[0]
+        restored = IkeSa.from_snapshot(ike_sa_snapshot, self.ike_sa1.configuration)
+        self.assertEqual(restored.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(restored.my_spi, self.ike_sa1.my_spi)
+        self.assertEqual(restored.child_sas, self.ike_sa1.child_sas)
+        # the restored IKE_SA keeps talking to the peer with the same keys and message IDs
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        create_child_req = restored.process_acquire(small_tsi, small_tsr, 1)
+        create_child_res = self.ike_sa2.process_message(create_child_req)
+        self.assertIsNone(restored.process_message(create_child_res))
+        self.assertEqual(len(restored.child_sas), 2)
+        # IKE_SAs in the middle of an exchange are not saved
+        self.ike_sa1.generate_delete_ike_sa_request()
+        self.assertIsNone(self.ike_sa1.to_snapshot())
+
     @patch('xfrm.Xfrm')
     def test_max_retransmit(self, mockclass):
         self.test_initial_exchanges_transport()
@@ -401,6 +733,59 @@ class TestIkeSa(TestCase):
         self.assertEqual(len(self.ike_sa1.child_sas), 1)
         self.assertEqual(len(self.ike_sa2.child_sas), 1)
 
+    @patch('xfrm.Xfrm')
+    def test_rekey_child_sa_idle(self, mockclass):
+        self.test_initial_exchanges_transport()
+        child_sa = self.ike_sa1.child_sas[0]
+        self.ike_sa1.child_sas[0] = child_sa._replace(ipsec_conf=child_sa.ipsec_conf._replace(idle_timeout=60))
+        self.ike_sa1.xfrm.get_sa_stats.return_value = xfrm.SaStats(bytes=100, packets=1, add_time=time.time() - 120,
+                                                                   last_used=time.time() - 90)
+        delete_child_sa_req = self.ike_sa1.process_expire(child_sa.inbound_spi)
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.DEL_CHILD_REQ_SENT)
+        delete_child_sa_res = self.ike_sa2.process_message(delete_child_sa_req)
+        request = self.ike_sa1.process_message(delete_child_sa_res)
+        self.assertIsNone(request)
+        self.assertEqual(len(self.ike_sa1.child_sas), 0)
+        self.assertEqual(len(self.ike_sa2.child_sas), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_rekey_child_sa_not_idle(self, mockclass):
+        self.test_initial_exchanges_transport()
+        child_sa = self.ike_sa1.child_sas[0]
+        self.ike_sa1.child_sas[0] = child_sa._replace(ipsec_conf=child_sa.ipsec_conf._replace(idle_timeout=60))
+        self.ike_sa1.xfrm.get_sa_stats.return_value = xfrm.SaStats(bytes=100, packets=1, add_time=time.time() - 120,
+                                                                   last_used=time.time() - 10)
+        self.ike_sa1.process_expire(child_sa.inbound_spi)
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.REK_CHILD_REQ_SENT)
+
+    @patch('xfrm.Xfrm')
+    def test_delete_idle_child_sa(self, mockclass):
+        self.test_initial_exchanges_transport()
+        child_sa = self.ike_sa1.child_sas[0]
+        self.ike_sa1.child_sas[0] = child_sa._replace(ipsec_conf=child_sa.ipsec_conf._replace(idle_timeout=60))
+        stats = xfrm.SaStats(bytes=100, packets=1, add_time=time.time() - 120, last_used=time.time() - 90)
+        self.assertIsNone(self.ike_sa1.check_idle_child_sas({}))
+        request = self.ike_sa1.check_idle_child_sas({child_sa.inbound_spi: stats, child_sa.outbound_spi: stats})
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.DEL_CHILD_REQ_SENT)
+        response = self.ike_sa2.process_message(request)
+        self.assertIsNone(self.ike_sa1.process_message(response))
+        self.assertEqual(len(self.ike_sa1.child_sas), 0)
+        self.assertEqual(len(self.ike_sa2.child_sas), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_dpd_skipped_with_inbound_traffic(self, mockclass):
+        self.test_initial_exchanges_transport()
+        child_sa = self.ike_sa1.child_sas[0]
+        stats = xfrm.SaStats(bytes=100, packets=1, add_time=time.time(), last_used=time.time())
+        self.ike_sa1.start_dpd_at = 0
+        self.assertTrue(self.ike_sa1.update_inbound_traffic({child_sa.inbound_spi: stats}))
+        self.assertIsNone(self.ike_sa1.check_dead_peer_detection_timer())
+        # no new traffic since last update
+        self.ike_sa1.start_dpd_at = 0
+        self.assertFalse(self.ike_sa1.update_inbound_traffic({child_sa.inbound_spi: stats}))
+        self.assertIsNotNone(self.ike_sa1.check_dead_peer_detection_timer())
+        self.assertEqual(self.ike_sa1.state, IkeSa.State.DPD_REQ_SENT)
+
     @patch('xfrm.Xfrm')
     def test_rekey_child_sa_from_responder(self, mockclass):
         self.test_initial_exchanges_transport()
@@ -550,6 +935,29 @@ class TestIkeSa(TestCase):
         self.assertEqual(self.ike_sa1.state, IkeSa.State.ESTABLISHED)
         self.assertEqual(self.ike_sa2.state, IkeSa.State.ESTABLISHED)
 
+    @patch('xfrm.Xfrm')
+    def test_rekey_governor(self, mockclass):
+        self.test_initial_exchanges_transport()
+        governor = RekeyGovernor()
+        governor.MAX_IN_FLIGHT = 1
+        self.ike_sa1.rekey_governor = governor
+        create_child_sa_req = self.ike_sa1.process_expire(self.ike_sa1.child_sas[0].inbound_spi)
+        self.assertEqual(governor.in_flight, {(self.ike_sa1.my_spi, self.ike_sa1.my_msg_id)})
+        # no budget for the IKE_SA rekey nor for other CHILD_SA rekeys
+        other_ike_sa = IkeSa(is_initiator=True, peer_spi=b'\0' * 8, configuration=self.ike_sa1.configuration,
+                             my_addr=self.ip1, peer_addr=self.ip2, rekey_governor=governor)
+        other_ike_sa.state = IkeSa.State.ESTABLISHED
+        other_ike_sa.rekey_ike_sa_at = time.time()
+        self.assertIsNone(other_ike_sa.check_rekey_ike_sa_timer())
+        other_ike_sa.child_sas = list(self.ike_sa1.child_sas)
+        self.assertIsNone(other_ike_sa.process_expire(other_ike_sa.child_sas[0].inbound_spi))
+        self.assertEqual(list(governor.deferred), [other_ike_sa.child_sas[0].inbound_spi])
+        # the slot is released with the response
+        create_child_sa_res = self.ike_sa2.process_message(create_child_sa_req)
+        self.ike_sa1.process_message(create_child_sa_res)
+        self.assertEqual(governor.in_flight, set())
+        self.assertIsNotNone(other_ike_sa.check_rekey_ike_sa_timer())
+
     @patch('xfrm.Xfrm')
     def test_delete_ike_sa(self, mockclass):
         self.test_initial_exchanges_transport()
@@ -791,3 +1199,449 @@ class TestIkeSa(TestCase):
         small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
         create_child_req_1 = self.ike_sa1.process_acquire(small_tsi, small_tsr, 9)
         self.assertIsNone(create_child_req_1)
+
+    @patch('xfrm.Xfrm')
+    def test_acquire_without_index(self, mockclass):
+        self.test_initial_exchanges_transport()
+        # the "protect" configuration is found by the selectors
+        small_tsi = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 8765, TrafficSelector.IpProtocol.TCP)
+        small_tsr = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        self.assertIsNotNone(self.ike_sa1.process_acquire(small_tsi, small_tsr, None))
+        small_tsr = TrafficSelector.from_network(ip_network("10.0.0.2/32"), 23, TrafficSelector.IpProtocol.TCP)
+        self.assertIsNone(self.ike_sa1.process_acquire(small_tsi, small_tsr, None))
+
+
+class TestIkeSaController(TestCase):
+    @patch('xfrm.Xfrm')
+    def setUp(self, mockclass):
+        self.ip1 = ip_address("192.168.0.1")
+        self.ip2 = ip_address("192.168.0.2")
+        self.configuration = Configuration(
+            self.ip1,
+            {
+                "192.168.0.2": {
+                    "psk": "testing",
+                    "protect": [{
+                        "index": 1,
+                        "idle_timeout": 60,
+                    }]
+                }
+            })
+        self.peer_configuration = Configuration(
+            self.ip2,
+            {
+                "192.168.0.1": {
+                    "psk": "testing",
+                    "protect": [{
+                        "index": 1,
+                    }]
+                }
+            })
+        self.controller = IkeSaController(self.ip1, self.configuration)
+        self.my_addr = (str(self.ip1), 500)
+        self.peer_addr = (str(self.ip2), 500)
+
+    def _create_initiator(self):
+        ike_sa = IkeSa(is_initiator=True, peer_spi=b'\0' * 8,
+                       configuration=self.peer_configuration.get_ike_configuration(self.ip1), my_addr=self.ip2,
+                       peer_addr=self.ip1)
+        tsi = TrafficSelector.from_network(ip_network("192.168.0.2/32"), 0, TrafficSelector.IpProtocol.ANY)
+        tsr = TrafficSelector.from_network(ip_network("192.168.0.1/32"), 0, TrafficSelector.IpProtocol.ANY)
+        return ike_sa, ike_sa.process_acquire(tsi, tsr, 1)
+
+    @patch('xfrm.Xfrm')
+    def test_cookie(self, mockclass):
+        self.controller.COOKIE_THRESHOLD = 0
+        initiator, ike_sa_init_req = self._create_initiator()
+        cookie_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        self.assertEqual(len(self.controller.ike_sas), 0)
+        self.assertEqual(len(Message.parse(cookie_res).get_notifies(PayloadNOTIFY.Type.COOKIE)), 1)
+        ike_sa_init_req = initiator.process_message(cookie_res)
+        self.assertEqual(Message.parse(ike_sa_init_req).payloads[0].notification_type, PayloadNOTIFY.Type.COOKIE)
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        self.assertEqual(len(self.controller.ike_sas), 1)
+        self.assertEqual(len(self.controller.half_open_sas), 1)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        ike_auth_res = self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr)
+        initiator.process_message(ike_auth_res)
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(self.controller.ike_sas[0].state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(len(self.controller.half_open_sas), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_invalid_cookie(self, mockclass):
+        self.controller.COOKIE_THRESHOLD = 0
+        initiator, ike_sa_init_req = self._create_initiator()
+        cookie_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_sa_init_req = initiator.process_message(cookie_res)
+        # cookie was bound to a different address
+        response = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, ('192.168.0.3', 500))
+        self.assertEqual(len(Message.parse(response).get_notifies(PayloadNOTIFY.Type.COOKIE)), 1)
+        self.assertEqual(len(self.controller.ike_sas), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_metrics(self, mockclass):
+        # metrics are process-wide, so only their increments are checked
+        received = protocol_.MESSAGES_RECEIVED.get('IKE_AUTH', 'request')
+        dispatched = protocol_.DISPATCH_SECONDS.get_count()
+        handshakes = protocol_.HANDSHAKE_SECONDS.get_count('responder')
+        requests = protocol_.REQUEST_SECONDS.get_count('IKE_AUTH', 'ok')
+        unknown_spi = protocol_.UNKNOWN_SPI_MESSAGES.get()
+
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        ike_auth_res = self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr)
+        initiator.process_message(ike_auth_res)
+        self.assertIsNone(self.controller.dispatch_message(ike_auth_req[:8] + b'\1' * 8 + ike_auth_req[16:],
+                                                          self.my_addr, self.peer_addr))
+
+        self.assertEqual(protocol_.MESSAGES_RECEIVED.get('IKE_AUTH', 'request'), received + 2)
+        self.assertEqual(protocol_.DISPATCH_SECONDS.get_count(), dispatched + 3)
+        self.assertEqual(protocol_.HANDSHAKE_SECONDS.get_count('responder'), handshakes + 1)
+        self.assertEqual(protocol_.REQUEST_SECONDS.get_count('IKE_AUTH', 'ok'), requests + 1)
+        self.assertEqual(protocol_.UNKNOWN_SPI_MESSAGES.get(), unknown_spi + 1)
+        self.controller.update_metrics()
+        self.assertEqual(protocol_.IKE_SAS.values, {('ESTABLISHED',): 1})
+        self.assertEqual(protocol_.CHILD_SAS.get(), 1)
+        self.assertEqual(protocol_.HALF_OPEN_IKE_SAS.get(), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_ike_sa_init_retransmission(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        with patch('protocol_.IkeSa.process_message') as process_message:
+            retransmitted_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+            process_message.assert_not_called()
+        self.assertEqual(retransmitted_res, ike_sa_init_res)
+        self.assertEqual(len(self.controller.ike_sas), 1)
+        # a different request reusing the same SPIi is not processed
+        _, other_req = self._create_initiator()
+        other_req = initiator.my_spi + other_req[8:]
+        self.assertIsNone(self.controller.dispatch_message(other_req, self.my_addr, self.peer_addr))
+        self.assertEqual(len(self.controller.ike_sas), 1)
+        # once established, the IKE_SA is no longer half-open
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr)
+        self.assertEqual(len(self.controller.half_open_sas), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_half_open_timeout(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        self.assertEqual(len(self.controller.half_open_sas), 1)
+        self.controller.check_half_open_timers()
+        self.assertEqual(len(self.controller.ike_sas), 1)
+        key, half_open_sa = next(iter(self.controller.half_open_sas.items()))
+        self.controller.half_open_sas[key] = half_open_sa._replace(expires_at=0)
+        self.controller.check_half_open_timers()
+        self.assertEqual(len(self.controller.ike_sas), 0)
+        self.assertEqual(len(self.controller.half_open_sas), 0)
+
+    @patch('xfrm.Xfrm')
+    def test_restore_snapshot(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        child_sa = self.controller.ike_sas[0].child_sas[0]
+        with tempfile.TemporaryDirectory() as directory:
+            self.controller.state_file = os.path.join(directory, 'state')
+            self.controller.close()
+            mockclass.return_value.reset_mock()
+            mockclass.return_value.get_all_sa_stats.return_value = {child_sa.inbound_spi: None,
+                                                                    child_sa.outbound_spi: None}
+            controller = IkeSaController(self.ip1, self.configuration, state_file=self.controller.state_file)
+        # kernel SAs are adopted instead of flushed, and only those not adopted are deleted
+        mockclass.return_value.flush_sas.assert_not_called()
+        mockclass.return_value.delete_sas_except.assert_called_once_with({child_sa.inbound_spi,
+                                                                          child_sa.outbound_spi})
+        self.assertEqual(len(controller.ike_sas), 1)
+        self.assertEqual(controller.ike_sas[0].child_sas, [child_sa])
+        self.assertEqual(controller.restored_requests, [])
+        # the peer keeps using the IKE_SA
+        dpd_req = initiator.generate_dead_peer_detection_request()
+        dpd_res = controller.dispatch_message(initiator._send_request(dpd_req), self.my_addr, self.peer_addr)
+        self.assertIsNone(initiator.process_message(dpd_res))
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+
+    @patch('xfrm.Xfrm')
+    def test_restore_periodic_snapshot(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        child_sa = self.controller.ike_sas[0].child_sas[0]
+        mockclass.return_value.get_all_sa_stats.return_value = {child_sa.inbound_spi: None,
+                                                                child_sa.outbound_spi: None}
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'state')
+            self.controller.state_file = state_file
+            self.controller.save_snapshot()
+            # messages exchanged after the snapshot make its message IDs stale
+            dpd_req = initiator.generate_dead_peer_detection_request()
+            dpd_res = self.controller.dispatch_message(initiator._send_request(dpd_req), self.my_addr, self.peer_addr)
+            self.assertIsNone(initiator.process_message(dpd_res))
+            controller = IkeSaController(self.ip1, self.configuration, state_file=state_file)
+
+            # without IKEV2_MESSAGE_ID_SYNC support, the IKE_SA cannot be restored from a periodic snapshot
+            self.controller.ike_sas[0].msg_id_sync = False
+            self.controller.save_snapshot()
+            mockclass.return_value.reset_mock()
+            unsynced_controller = IkeSaController(self.ip1, self.configuration, state_file=state_file)
+        self.assertEqual(unsynced_controller.ike_sas, [])
+        mockclass.return_value.delete_sas_except.assert_called_once_with(set())
+
+        # the message IDs are synchronised with the peer before using the IKE_SA
+        self.assertEqual(len(controller.restored_requests), 1)
+        sync_req, addr = controller.restored_requests[0]
+        self.assertEqual(addr, (str(self.ip2), 500))
+        sync_res = initiator.process_message(sync_req)
+        self.assertIsNone(controller.dispatch_message(sync_res, self.my_addr, self.peer_addr))
+        self.assertEqual(controller.ike_sas[0].state, IkeSa.State.ESTABLISHED)
+        dpd_req = initiator.generate_dead_peer_detection_request()
+        dpd_res = controller.dispatch_message(initiator._send_request(dpd_req), self.my_addr, self.peer_addr)
+        self.assertIsNone(initiator.process_message(dpd_res))
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+
+    @patch('xfrm.Xfrm')
+    def test_redirect(self, mockclass):
+        ip3 = ip_address("192.168.0.3")
+        peer_conf = {"psk": "testing", "redirect": ["192.168.0.3"], "protect": [{"index": 1}]}
+        self.controller.configuration = Configuration(self.ip1, {"192.168.0.2": peer_conf})
+        self.controller.REDIRECT_ESTABLISHED_THRESHOLD = 0
+        new_gw = IkeSaController(ip3, Configuration(ip3, {"192.168.0.2": dict(peer_conf, redirect=["192.168.0.1"])}))
+        new_gw.REDIRECT_ESTABLISHED_THRESHOLD = 0
+        peer_controller = IkeSaController(self.ip2, self.peer_configuration)
+        initiator, ike_sa_init_req = self._create_initiator()
+        peer_controller._add_ike_sa(initiator)
+
+        # the overloaded gateway redirects the initiator without creating any state
+        redirect_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        self.assertEqual(self.controller.ike_sas, [])
+        self.assertEqual(self.controller.redirections, {ip3: 1})
+
+        # the initiator starts again with the new gateway
+        mockclass.return_value.reset_mock()
+        self.assertIsNone(peer_controller.dispatch_message(redirect_res, self.peer_addr, self.my_addr))
+        self.assertEqual(initiator.peer_addr, ip3)
+        self.assertEqual(initiator.redirected_from, self.ip1)
+        mockclass.return_value.create_policies.assert_called_once_with(self.ip2, ip3, initiator.configuration,
+                                                                       update=True)
+        [(ike_sa_init_req, addr)] = peer_controller.redirected_requests
+        self.assertEqual(addr, (str(ip3), 500))
+
+        # which does not redirect it again
+        new_gw_addr = (str(ip3), 500)
+        ike_sa_init_res = new_gw.dispatch_message(ike_sa_init_req, new_gw_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        self.assertIsNone(initiator.process_message(new_gw.dispatch_message(ike_auth_req, new_gw_addr,
+                                                                            self.peer_addr)))
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(len(new_gw.ike_sas), 1)
+
+        # ACQUIREs for the original gateway use the IKE_SA with the new one
+        acquire = XfrmUserAcquire(id=XfrmId(daddr=XfrmAddress.from_ipaddr(self.ip1)),
+                                  saddr=XfrmAddress.from_ipaddr(self.ip2),
+                                  sel=XfrmSelector(family=socket.AF_INET, daddr=XfrmAddress.from_ipaddr(self.ip1),
+                                                   saddr=XfrmAddress.from_ipaddr(self.ip2)),
+                                  policy=XfrmUserPolicyInfo(index=1 << 3))
+        self.assertEqual(peer_controller.process_acquire(acquire)[1], new_gw_addr)
+        self.assertEqual(len(peer_controller.ike_sas), 1)
+
+        # once the IKE_SA is gone, the policies point to the original gateway again
+        mockclass.return_value.reset_mock()
+        peer_controller._remove_ike_sa(initiator)
+        mockclass.return_value.create_policies.assert_called_once_with(self.ip2, self.ip1, initiator.configuration,
+                                                                       update=True)
+        # and ACQUIREs for gateways not configured are ignored
+        acquire.id.daddr = XfrmAddress.from_ipaddr(ip3)
+        acquire.sel.daddr = XfrmAddress.from_ipaddr(ip3)
+        self.assertEqual(peer_controller.process_acquire(acquire), (None, None))
+        self.assertEqual(peer_controller.ike_sas, [])
+
+    @patch('xfrm.Xfrm')
+    def test_redirect_invalid_nonce(self, mockclass):
+        self.controller.configuration = Configuration(
+            self.ip1, {"192.168.0.2": {"psk": "testing", "redirect": ["192.168.0.3"]}})
+        self.controller.REDIRECT_ESTABLISHED_THRESHOLD = 0
+        initiator, ike_sa_init_req = self._create_initiator()
+        redirect_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        initiator.request.get_payload(Payload.Type.NONCE).nonce = b'other nonce'
+        initiator.process_message(redirect_res)
+        self.assertEqual(initiator.peer_addr, self.ip1)
+        self.assertEqual(initiator.state, IkeSa.State.DELETED)
+
+    @patch('xfrm.Xfrm')
+    def test_check_deferred_rekeys(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        ike_sa = self.controller.ike_sas[0]
+        self.assertIs(ike_sa.rekey_governor, self.controller.rekey_governor)
+        # unknown traffic statistics, so the CHILD_SA is not considered idle
+        mockclass.return_value.get_sa_stats.return_value = None
+        self.controller.rekey_governor.MAX_IN_FLIGHT = 0
+        self.assertIsNone(ike_sa.process_expire(ike_sa.child_sas[0].inbound_spi))
+        self.assertEqual(self.controller.check_deferred_rekeys(), [])
+        self.controller.rekey_governor.MAX_IN_FLIGHT = 1
+        [(request_data, addr)] = self.controller.check_deferred_rekeys()
+        self.assertEqual(addr, self.peer_addr)
+        self.assertEqual(ike_sa.state, IkeSa.State.REK_CHILD_REQ_SENT)
+        # slots of deleted IKE_SAs are released
+        self.controller._remove_ike_sa(ike_sa)
+        self.assertEqual(self.controller.rekey_governor.in_flight, set())
+
+    @patch('xfrm.Xfrm')
+    def test_check_deferred_rekeys_ike_sa_rekeyed(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        ike_sa = self.controller.ike_sas[0]
+        child_sa = ike_sa.child_sas[0]
+        mockclass.return_value.get_sa_stats.return_value = None
+        self.controller.rekey_governor.MAX_IN_FLIGHT = 0
+        self.assertIsNone(ike_sa.process_expire(child_sa.inbound_spi))
+
+        # the peer rekeys the IKE_SA before the deferred rekey is resumed
+        initiator.rekey_ike_sa_at = 0
+        rekey_req = initiator.check_rekey_ike_sa_timer()
+        delete_req = initiator.process_message(self.controller.dispatch_message(rekey_req, self.my_addr,
+                                                                                self.peer_addr))
+        initiator.process_message(self.controller.dispatch_message(delete_req, self.my_addr, self.peer_addr))
+        [new_ike_sa] = self.controller.ike_sas
+        self.assertIsNot(new_ike_sa, ike_sa)
+        self.assertEqual(new_ike_sa.child_sas, [child_sa])
+
+        # the rekey is resumed on the IKE_SA the CHILD_SA belongs to now
+        self.controller.rekey_governor.MAX_IN_FLIGHT = 1
+        [(request_data, addr)] = self.controller.check_deferred_rekeys()
+        self.assertEqual(addr, self.peer_addr)
+        self.assertEqual(new_ike_sa.state, IkeSa.State.REK_CHILD_REQ_SENT)
+
+    @patch('xfrm.Xfrm')
+    def test_auto_start(self, mockclass):
+        configuration = Configuration(self.ip1, {
+            "192.168.0.2": {"psk": "testing", "auto_start": True,
+                            "protect": [{"index": 1}, {"index": 2, "ip_proto": "tcp"}]},
+            "192.168.0.3": {"auto_start": True},
+            "192.168.0.4": {},
+        })
+        controller = IkeSaController(self.ip1, configuration)
+        peer_controller = IkeSaController(self.ip2, self.peer_configuration)
+        controller.auto_start_bucket = TokenBucket(rate=0, burst=1)
+        [(ike_sa_init_req, addr)] = controller.check_auto_start()
+        self.assertEqual(addr, self.peer_addr)
+        # the rest of the peers wait for the token bucket
+        self.assertEqual(controller.check_auto_start(), [])
+        self.assertEqual(list(controller.auto_start_pending), [ip_address("192.168.0.3")])
+
+        # both CHILD_SAs are negotiated without any ACQUIRE
+        ike_sa_init_res = peer_controller.dispatch_message(ike_sa_init_req, self.peer_addr, self.my_addr)
+        ike_auth_req = controller.dispatch_message(ike_sa_init_res, self.my_addr, self.peer_addr)
+        ike_auth_res = peer_controller.dispatch_message(ike_auth_req, self.peer_addr, self.my_addr)
+        create_child_sa_req = controller.dispatch_message(ike_auth_res, self.my_addr, self.peer_addr)
+        create_child_sa_res = peer_controller.dispatch_message(create_child_sa_req, self.peer_addr, self.my_addr)
+        self.assertIsNone(controller.dispatch_message(create_child_sa_res, self.my_addr, self.peer_addr))
+        ike_sa = controller.ike_sas[0]
+        self.assertEqual(ike_sa.state, IkeSa.State.ESTABLISHED)
+        self.assertEqual(sorted(x.ipsec_conf.index for x in ike_sa.child_sas), [1, 2])
+
+        # the peer is brought up again after a failure
+        controller._remove_ike_sa(ike_sa)
+        self.assertGreater(controller.auto_start_pending[self.ip2], time.time())
+        controller.auto_start_pending = {self.ip2: 0}
+        controller.auto_start_bucket.tokens = 1
+        [(ike_sa_init_req, addr)] = controller.check_auto_start()
+        self.assertEqual(addr, self.peer_addr)
+
+        # and also when it was the peer who brought the IKE_SA up
+        controller.auto_start_pending = {}
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr)
+        [ike_sa] = [x for x in controller.ike_sas if not x.is_initiator]
+        self.assertEqual(ike_sa.state, IkeSa.State.ESTABLISHED)
+        controller._remove_ike_sa(ike_sa)
+        self.assertGreater(controller.auto_start_pending[self.ip2], time.time())
+
+    @patch('xfrm.Xfrm')
+    def test_network_peer(self, mockclass):
+        configuration = Configuration(self.ip1, {"192.168.0.0/24": {"psk": "testing", "protect": [{"index": 1}]}})
+        controller = IkeSaController(self.ip1, configuration)
+        ike_conf = configuration.get_ike_configuration(self.ip2)
+        mockclass.return_value.create_policies.assert_not_called()
+        # policies for the road-warrior are not created for unauthenticated IKE_SA_INIT requests
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        mockclass.return_value.create_policies.assert_not_called()
+        # but once it is authenticated
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        self.assertEqual(initiator.state, IkeSa.State.ESTABLISHED)
+        mockclass.return_value.create_policies.assert_called_once_with(self.ip1, self.ip2, ike_conf, per_peer=True)
+        self.assertEqual(controller.policy_peers, {self.ip2})
+
+        # and removed along with its last IKE_SA
+        controller._remove_ike_sa(controller.ike_sas[0])
+        mockclass.return_value.delete_policies.assert_called_once_with(self.ip1, self.ip2, ike_conf, per_peer=True)
+        self.assertEqual(controller.policy_peers, set())
+
+    @patch('xfrm.Xfrm')
+    def test_network_peer_failed_auth(self, mockclass):
+        configuration = Configuration(self.ip1, {"192.168.0.0/24": {"psk": "other", "protect": [{"index": 1}]}})
+        controller = IkeSaController(self.ip1, configuration)
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr)
+        self.assertEqual(controller.ike_sas, [])
+        mockclass.return_value.create_policies.assert_not_called()
+        mockclass.return_value.delete_policies.assert_not_called()
+        self.assertEqual(controller.policy_peers, set())
+
+    @patch('xfrm.Xfrm')
+    def test_check_sad_timer(self, mockclass):
+        initiator, ike_sa_init_req = self._create_initiator()
+        ike_sa_init_res = self.controller.dispatch_message(ike_sa_init_req, self.my_addr, self.peer_addr)
+        ike_auth_req = initiator.process_message(ike_sa_init_res)
+        initiator.process_message(self.controller.dispatch_message(ike_auth_req, self.my_addr, self.peer_addr))
+        ike_sa = self.controller.ike_sas[0]
+        self.assertEqual(ike_sa.state, IkeSa.State.ESTABLISHED)
+        child_sa = ike_sa.child_sas[0]
+        now = time.time()
+
+        # not due yet
+        self.assertEqual(self.controller.check_sad_timer(), [])
+
+        # inbound traffic postpones DPD, and keeps the CHILD_SA (with idle_timeout=60) from being deleted
+        ike_sa.start_dpd_at = 0
+        self.controller.xfrm.get_all_sa_stats.return_value = {
+            child_sa.inbound_spi: SaStats(bytes=1000, packets=10, add_time=now - 120, last_used=now),
+            child_sa.outbound_spi: SaStats(bytes=0, packets=0, add_time=now - 120, last_used=0),
+        }
+        self.controller.check_sad_at = 0
+        self.assertEqual(self.controller.check_sad_timer(), [])
+        self.assertEqual(self.controller.sad_size, 2)
+        self.assertGreater(self.controller.check_sad_at, now)
+        self.assertGreater(ike_sa.start_dpd_at, now)
+
+        # once neither IPsec SA has been used for idle_timeout, the CHILD_SA is deleted
+        ike_sa.start_dpd_at = 0
+        self.controller.xfrm.get_all_sa_stats.return_value = {
+            child_sa.inbound_spi: SaStats(bytes=1000, packets=10, add_time=now - 120, last_used=now - 61),
+            child_sa.outbound_spi: SaStats(bytes=0, packets=0, add_time=now - 120, last_used=0),
+        }
+        requests = self.controller.check_sad_timer(force=True)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0][1], self.peer_addr)
+        self.assertEqual(ike_sa.start_dpd_at, 0)
+        self.assertEqual(self.controller.idle_child_sas_deleted, 1)
+        request = Message.parse(requests[0][0], crypto=initiator.peer_crypto)
+        self.assertEqual(request.exchange_type, Message.Exchange.INFORMATIONAL)
+        delete = request.get_payload(Payload.Type.DELETE, encrypted=True)
+        self.assertEqual(delete.spis, [child_sa.inbound_spi])
+        self.assertEqual(ike_sa.state, IkeSa.State.DEL_CHILD_REQ_SENT)
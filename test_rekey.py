@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the rekey module
+"""
+import unittest
+
+from rekey import RekeyGovernor
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class TestRekeyGovernor(unittest.TestCase):
+    def setUp(self):
+        self.governor = RekeyGovernor()
+        self.governor.MAX_IN_FLIGHT = 2
+
+    def test_jittered(self):
+        values = [RekeyGovernor.jittered(1000) for _ in range(100)]
+        self.assertTrue(all(1000 * (1 - RekeyGovernor.JITTER) <= x <= 1000 for x in values))
+        # rekeys are spread, not just delayed by a few seconds
+        self.assertGreater(max(values) - min(values), 10)
+
+    def test_acquire_release(self):
+        self.assertTrue(self.governor.acquire(b'A' * 8, 1))
+        self.assertTrue(self.governor.acquire(b'B' * 8, 1))
+        self.assertFalse(self.governor.acquire(b'C' * 8, 1))
+        self.governor.release(b'A' * 8, 1)
+        self.assertTrue(self.governor.acquire(b'C' * 8, 1))
+        self.governor.release_all(b'B' * 8)
+        self.assertEqual(self.governor.in_flight, {(b'C' * 8, 1)})
+
+    def test_defer(self):
+        self.governor.defer(b'1234')
+        self.assertEqual(list(self.governor.deferred), [b'1234'])
+        self.assertEqual(self.governor.deferrals, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
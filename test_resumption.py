@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the session resumption tickets
+"""
+import unittest
+
+from message import Proposal, Transform
+from resumption import TicketManager
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class TestTicketManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = TicketManager()
+        self.proposal = Proposal(1, Proposal.Protocol.IKE, b'',
+                                 [Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256),
+                                  Transform(Transform.Type.PRF, Transform.PrfId.PRF_HMAC_SHA2_256),
+                                  Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA2_256_128),
+                                  Transform(Transform.Type.DH, Transform.DhId.DH_14)])
+
+    def test_issue_decrypt(self):
+        ticket = self.manager.issue(b'sk_d' * 8, self.proposal, b'peer_id', b'binding')
+        sk_d, proposal, peer_id = self.manager.decrypt(ticket, b'binding')
+        self.assertEqual(sk_d, b'sk_d' * 8)
+        self.assertEqual(proposal.to_bytes(), self.proposal.to_bytes())
+        self.assertEqual(peer_id, b'peer_id')
+        # tampered or foreign tickets are rejected
+        self.assertIsNone(self.manager.decrypt(ticket[:-1] + bytes([ticket[-1] ^ 1]), b'binding'))
+        self.assertIsNone(TicketManager().decrypt(ticket, b'binding'))
+        self.assertIsNone(self.manager.decrypt(b'short', b'binding'))
+
+    def test_binding(self):
+        ticket = self.manager.issue(b'sk_d', self.proposal, b'peer_id', b'binding')
+        self.assertIsNone(self.manager.decrypt(ticket, b'other binding'))
+
+    def test_expiration(self):
+        self.manager.TICKET_LIFETIME = -1
+        self.assertIsNone(self.manager.decrypt(self.manager.issue(b'sk_d', self.proposal, b'peer_id', b''), b''))
+
+    def test_key_rotation(self):
+        ticket = self.manager.issue(b'sk_d', self.proposal, b'peer_id', b'')
+        self.manager.rotate_at = 0
+        self.assertIsNotNone(self.manager.decrypt(ticket, b''))
+        self.manager.rotate_at = 0
+        self.assertIsNone(self.manager.decrypt(ticket, b''))
+
+    def test_store_pop(self):
+        self.manager.store('192.168.0.1', b'ticket', 10, b'sk_d', self.proposal)
+        self.assertEqual(self.manager.pop('192.168.0.1').ticket, b'ticket')
+        self.assertIsNone(self.manager.pop('192.168.0.1'))
+        self.manager.store('192.168.0.1', b'ticket', -1, b'sk_d', self.proposal)
+        self.assertIsNone(self.manager.pop('192.168.0.1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
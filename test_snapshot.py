@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module defines test for the SA snapshot format
+"""
+import os
+import tempfile
+import unittest
+from ipaddress import ip_address, ip_network
+
+import snapshot
+from message import Proposal, TrafficSelector, Transform
+from snapshot import ChildSaSnapshot, IkeSaSnapshot, SnapshotError
+
+__author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        ike_proposal = Proposal(1, Proposal.Protocol.IKE, b'',
+                                [Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 256),
+                                 Transform(Transform.Type.PRF, Transform.PrfId.PRF_HMAC_SHA2_256),
+                                 Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA2_256_128),
+                                 Transform(Transform.Type.DH, Transform.DhId.DH_14)])
+        child_proposal = Proposal(1, Proposal.Protocol.ESP, b'1234',
+                                  [Transform(Transform.Type.ENCR, Transform.EncrId.ENCR_AES_CBC, 128),
+                                   Transform(Transform.Type.INTEG, Transform.IntegId.AUTH_HMAC_SHA2_256_128)])
+        ts = TrafficSelector.from_network(ip_network('192.168.0.0/24'), 0, TrafficSelector.IpProtocol.ANY)
+        child_sa = ChildSaSnapshot(b'1234', b'5678', child_proposal, ts, ts, 1, 3, None, None, False)
+        self.ike_sas = [IkeSaSnapshot(True, False, b'A' * 8, b'B' * 8, 5, 3, 1, 100.5, 130.5,
+                                      ip_address('192.168.0.1'), ip_address('192.168.0.2'), ike_proposal,
+                                      tuple(bytes([x]) * 32 for x in range(7)),
+                                      [child_sa, child_sa._replace(cpu=2, keyring=(b'ai', b'ar', b'ei', b'er'),
+                                                                exchange_initiator=True)],
+                                      True)]
+
+    def test_to_bytes_parse(self):
+        parsed = snapshot.parse(snapshot.to_bytes(self.ike_sas))
+        self.assertFalse(parsed.clean)
+        self.assertTrue(snapshot.parse(snapshot.to_bytes(self.ike_sas, clean=True)).clean)
+        ike_sa = parsed.ike_sas[0]
+        self.assertEqual(ike_sa._replace(proposal=None, child_sas=None),
+                         self.ike_sas[0]._replace(proposal=None, child_sas=None))
+        self.assertEqual(ike_sa.proposal.to_bytes(), self.ike_sas[0].proposal.to_bytes())
+        self.assertEqual(len(ike_sa.child_sas), 2)
+        self.assertEqual(ike_sa.child_sas[0].tsi, self.ike_sas[0].child_sas[0].tsi)
+        self.assertIsNone(ike_sa.child_sas[0].cpu)
+        self.assertIsNone(ike_sa.child_sas[0].keyring)
+        self.assertEqual(ike_sa.child_sas[1].cpu, 2)
+        self.assertEqual(ike_sa.child_sas[1].keyring, (b'ai', b'ar', b'ei', b'er'))
+        self.assertFalse(ike_sa.child_sas[0].exchange_initiator)
+        self.assertTrue(ike_sa.child_sas[1].exchange_initiator)
+
+    def test_ike_sa_to_bytes(self):
+        ike_sa = snapshot.ike_sa_from_bytes(snapshot.ike_sa_to_bytes(self.ike_sas[0]))
+        self.assertEqual(ike_sa.my_spi, b'A' * 8)
+        with self.assertRaises(SnapshotError):
+            snapshot.ike_sa_from_bytes(snapshot.ike_sa_to_bytes(self.ike_sas[0])[:-1])
+
+    def test_parse_invalid(self):
+        data = snapshot.to_bytes(self.ike_sas)
+        with self.assertRaises(SnapshotError):
+            snapshot.parse(b'garbage')
+        with self.assertRaises(SnapshotError):
+            snapshot.parse(data[:-1])
+        with self.assertRaises(SnapshotError):
+            snapshot.parse(data + b'\0')
+        with self.assertRaises(SnapshotError):
+            snapshot.parse(data[:8] + bytes([snapshot.VERSION + 1]) + data[9:])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'state')
+            # a leftover temporary file does not prevent saving
+            open(filename + '.tmp', 'wb').close()
+            snapshot.save(filename, self.ike_sas)
+            self.assertEqual(os.listdir(directory), ['state'])
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+            self.assertEqual(len(snapshot.load(filename).ike_sas), 1)
+            with self.assertRaises(SnapshotError):
+                snapshot.load(os.path.join(directory, 'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
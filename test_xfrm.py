@@ -3,11 +3,17 @@
 
 """ This module defines test for the xfrm module
 """
+import socket
 import unittest
+from ctypes import sizeof
 from ipaddress import ip_address, ip_network
+from unittest.mock import patch, MagicMock
 
 from configuration import IkeConfiguration, IpsecConfiguration
-from xfrm import Xfrm, Mode
+from netlink import NetlinkHeader, NLM_F_MULTI, NLMSG_DONE
+from xfrm import (Xfrm, Mode, XfrmAddress, XfrmReplayStateEsn, XfrmLifetimeCfg, XfrmSelector, XfrmUserSaInfo,
+                  XfrmId, XfrmLifetimeCur, XfrmUserSaId, XFRM_MSG_DELSA, XFRM_MSG_NEWSA, XFRM_MSG_DELPOLICY,
+                  XFRM_POLICY_OUT, XFRMA_MARK, create_byte_array)
 from message import TrafficSelector, Proposal, Transform
 
 __author__ = 'Alejandro Perez-Mendez <alejandro.perez.mendez@gmail.com>'
@@ -32,6 +38,83 @@ class TestXfrm(unittest.TestCase):
         ike_conf = IkeConfiguration(protect=[ipsec_conf])
         self.xfrm.create_policies(ip_address('192.168.1.1'), ip_address('192.168.1.2'), ike_conf)
 
+    def test_create_route_based_policies(self):
+        ipsec_conf1 = IpsecConfiguration(my_subnet=ip_network('192.168.1.0/24'), peer_subnet=ip_network('10.0.0.0/8'),
+                                         my_port=0, peer_port=0, ip_proto=TrafficSelector.IpProtocol.ANY,
+                                         ipsec_proto=Proposal.Protocol.ESP, mode=Mode.TUNNEL, index=1, if_id=5)
+        ipsec_conf2 = ipsec_conf1._replace(peer_subnet=ip_network('172.16.0.0/12'), index=2)
+        ike_conf = IkeConfiguration(protect=[ipsec_conf1, ipsec_conf2])
+        with patch.object(self.xfrm, '_create_policy') as create_policy:
+            self.xfrm.create_policies(ip_address('192.168.1.1'), ip_address('192.168.1.2'), ike_conf)
+        # a single set of catch-all policies (out, in and fwd) is created for the peer
+        self.assertEqual(create_policy.call_count, 3)
+        for call in create_policy.call_args_list:
+            self.assertEqual(call[0][0], ip_network('0.0.0.0/0'))
+            self.assertEqual(call[0][1], ip_network('0.0.0.0/0'))
+            self.assertEqual(call[1]['if_id'], 5)
+
+    def test_create_per_peer_policies(self):
+        ipsec_conf = IpsecConfiguration(my_subnet=ip_network('192.168.1.0/24'), peer_subnet=ip_network('10.0.0.0/8'),
+                                        my_port=0, peer_port=0, ip_proto=TrafficSelector.IpProtocol.ANY,
+                                        ipsec_proto=Proposal.Protocol.ESP, mode=Mode.TUNNEL, index=1)
+        ike_conf = IkeConfiguration(protect=[ipsec_conf])
+        with patch.object(self.xfrm, '_create_policy') as create_policy:
+            self.xfrm.create_policies(ip_address('192.168.1.1'), ip_address('10.0.0.2'), ike_conf, per_peer=True)
+        # the peer selector is the address of the peer, and the kernel chooses the index
+        out_call, in_call, fwd_call = create_policy.call_args_list
+        self.assertEqual(out_call[0][:2], (ip_network('192.168.1.0/24'), ip_network('10.0.0.2/32')))
+        self.assertEqual(out_call[1]['index'], 0)
+        self.assertEqual(in_call[0][:2], (ip_network('10.0.0.2/32'), ip_network('192.168.1.0/24')))
+        self.assertEqual(fwd_call[0][:2], (ip_network('10.0.0.2/32'), ip_network('192.168.1.0/24')))
+
+    def test_delete_policies(self):
+        ipsec_conf = IpsecConfiguration(my_subnet=ip_network('192.168.1.0/24'), peer_subnet=ip_network('10.0.0.0/8'),
+                                        my_port=0, peer_port=80, ip_proto=TrafficSelector.IpProtocol.TCP,
+                                        ipsec_proto=Proposal.Protocol.ESP, mode=Mode.TUNNEL, index=1, mark=7)
+        ike_conf = IkeConfiguration(protect=[ipsec_conf])
+        with patch.object(self.xfrm, 'send_recv') as send_recv:
+            self.xfrm.delete_policies(ip_address('192.168.1.1'), ip_address('10.0.0.2'), ike_conf, per_peer=True)
+        self.assertEqual(send_recv.call_count, 3)
+        msg_type, flags, policy_id, attributes = send_recv.call_args_list[0][0]
+        self.assertEqual(msg_type, XFRM_MSG_DELPOLICY)
+        self.assertEqual(policy_id.dir, XFRM_POLICY_OUT)
+        # route-based policies of peers configured by network only select the address of the peer
+        self.assertEqual(policy_id.selector.daddr.to_ipaddr(socket.AF_INET), ip_address('10.0.0.2'))
+        self.assertEqual((policy_id.selector.prefixlen_s, policy_id.selector.prefixlen_d), (0, 32))
+        self.assertEqual(policy_id.selector.dport, 0)
+        self.assertEqual(attributes[XFRMA_MARK].v, 7)
+
+    def test_create_route_based_ipsec_sa(self):
+        self.xfrm.create_sa(ip_address('192.168.1.1'), ip_address('192.168.1.2'),
+                            TrafficSelector.from_network(ip_network('0.0.0.0/0'), 0, TrafficSelector.IpProtocol.ANY),
+                            TrafficSelector.from_network(ip_network('0.0.0.0/0'), 0, TrafficSelector.IpProtocol.ANY),
+                            Proposal.Protocol.ESP, b'1234',
+                            Transform.EncrId.ENCR_AES_CBC, b'1' * 16,
+                            Transform.IntegId.AUTH_HMAC_MD5_96, b'1' * 16, Mode.TUNNEL, if_id=5, mark=10)
+
+    def test_create_esn_ipsec_sa(self):
+        self.xfrm.create_sa(ip_address('192.168.1.1'), ip_address('192.168.1.2'),
+                            TrafficSelector.from_network(ip_network('192.168.1.1/32'), 0, TrafficSelector.IpProtocol.TCP),
+                            TrafficSelector.from_network(ip_network('192.168.1.2/32'), 0, TrafficSelector.IpProtocol.TCP),
+                            Proposal.Protocol.ESP, b'1234',
+                            Transform.EncrId.ENCR_AES_CBC, b'1' * 16,
+                            Transform.IntegId.AUTH_HMAC_MD5_96, b'1' * 16, Mode.TRANSPORT, replay_window=1024,
+                            esn=True)
+
+    def test_replay_state_esn_size(self):
+        replay_state = XfrmReplayStateEsn.build(1024)
+        self.assertEqual(replay_state.bmp_len, 32)
+        self.assertEqual(sizeof(replay_state), sizeof(XfrmReplayStateEsn) + 32 * 4)
+
+    def test_lifetime_cfg(self):
+        lifetime = XfrmLifetimeCfg.build(100, lifetime_bytes=1000, lifetime_packets=0)
+        self.assertEqual(lifetime.soft_add_expires_seconds, 100)
+        self.assertEqual(lifetime.hard_add_expires_seconds, 110)
+        self.assertEqual(lifetime.soft_byte_limit, 1000)
+        self.assertEqual(lifetime.hard_byte_limit, 1100)
+        self.assertEqual(lifetime.soft_packed_limit, 0xFFFFFFFFFFFFFFFF)
+        self.assertEqual(lifetime.hard_packet_limit, 0xFFFFFFFFFFFFFFFF)
+
     def test_create_transport_ipsec_sa(self):
         self.xfrm.create_sa(ip_address('192.168.1.1'), ip_address('192.168.1.2'),
                             TrafficSelector(TrafficSelector.Type.TS_IPV4_ADDR_RANGE,
@@ -61,12 +144,61 @@ class TestXfrm(unittest.TestCase):
                             Transform.IntegId.AUTH_HMAC_MD5_96, b'1' * 16, Mode.TUNNEL)
         self.xfrm.delete_sa(ip_address('192.168.1.2'), Proposal.Protocol.ESP, b'1234')
 
+    def test_address(self):
+        for addr in (ip_address('192.168.1.1'), ip_address('2001:db8::1:2')):
+            xfrm_addr = XfrmAddress.from_ipaddr(addr)
+            family = socket.AF_INET if addr.version == 4 else socket.AF_INET6
+            self.assertEqual(bytes(xfrm_addr)[:len(addr.packed)], addr.packed)
+            self.assertEqual(xfrm_addr.to_ipaddr(family), addr)
+
+    def test_selector(self):
+        tsi = TrafficSelector.from_network(ip_network('2001:db8::/64'), 0, TrafficSelector.IpProtocol.ANY)
+        tsr = TrafficSelector.from_network(ip_network('2001:db8:1::/48'), 80, TrafficSelector.IpProtocol.TCP)
+        selector = XfrmSelector.build(tsi.get_prefix(), tsr.get_prefix(), tsi.get_port(), tsr.get_port(),
+                                      tsr.ip_proto, tsi.version)
+        self.assertEqual(selector.family, socket.AF_INET6)
+        self.assertEqual(selector.daddr.to_ipaddr(socket.AF_INET6), ip_address('2001:db8:1::'))
+        self.assertEqual((selector.prefixlen_s, selector.prefixlen_d), (64, 48))
+        self.assertEqual((selector.sport_mask, selector.dport, selector.dport_mask), (0, 80, 0xFFFF))
+
     def test_get_policies(self):
         self.test_create_transport_policy()
         policies = self.xfrm._get_policies()
         for header, payload, attributes in policies:
             payload.to_dict()
 
+    @staticmethod
+    def _newsa(spi, byte_count):
+        usersa = XfrmUserSaInfo(id=XfrmId(spi=create_byte_array(spi), proto=socket.IPPROTO_ESP),
+                                cur=XfrmLifetimeCur(bytes=byte_count, packets=1, add_time=1000), family=socket.AF_INET)
+        header = NetlinkHeader(length=sizeof(NetlinkHeader) + sizeof(usersa), type=XFRM_MSG_NEWSA, flags=NLM_F_MULTI)
+        return bytes(header) + bytes(usersa)
+
+    def test_get_all_sa_stats_multipart(self):
+        done = bytes(NetlinkHeader(length=sizeof(NetlinkHeader), type=NLMSG_DONE, flags=NLM_F_MULTI))
+        sock = MagicMock()
+        sock.recv.side_effect = [self._newsa(b'1234', 100) + self._newsa(b'5678', 200), done]
+        with patch.object(Xfrm, '_get_socket', return_value=sock):
+            sa_stats = self.xfrm.get_all_sa_stats()
+        self.assertEqual(sock.recv.call_count, 2)
+        self.assertEqual(sa_stats[b'1234'].bytes, 100)
+        self.assertEqual(sa_stats[b'5678'].bytes, 200)
+        self.assertEqual(sa_stats[b'5678'].add_time, 1000)
+
+    def test_delete_sas_except(self):
+        done = bytes(NetlinkHeader(length=sizeof(NetlinkHeader), type=NLMSG_DONE))
+        sock = MagicMock()
+        sock.recv.side_effect = [self._newsa(b'1234', 100) + self._newsa(b'5678', 200), done, done]
+        with patch.object(Xfrm, '_get_socket', return_value=sock):
+            self.xfrm.delete_sas_except({b'1234'})
+        # the dump, and the deletion of the SA not kept
+        self.assertEqual(sock.send.call_count, 2)
+        header = NetlinkHeader.from_buffer_copy(sock.send.call_args[0][0])
+        self.assertEqual(header.type, XFRM_MSG_DELSA)
+        xfrm_id = XfrmUserSaId.from_buffer_copy(sock.send.call_args[0][0][sizeof(NetlinkHeader):])
+        self.assertEqual(bytes(xfrm_id.spi), b'5678')
+        self.assertEqual(xfrm_id.proto, socket.IPPROTO_ESP)
+
     def tearDown(self):
         self.xfrm.flush_policies()
         self.xfrm.flush_sas()
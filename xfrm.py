@@ -6,12 +6,13 @@
 """
 import logging
 import socket
+from collections import namedtuple
 from ctypes import (c_ubyte, c_uint16, c_uint32, c_uint64, BigEndianStructure)
 from ipaddress import ip_address, ip_network
 from random import SystemRandom
 
 from helpers import SafeIntEnum, hexstring
-from message import Proposal, Transform
+from message import Proposal, TrafficSelector, Transform
 from netlink import (NetlinkStructure, NetlinkProtocol, NLM_F_REQUEST, NLM_F_ACK, NLM_F_DUMP,
                      NetlinkError)
 
@@ -62,6 +63,14 @@ XFRMA_SA_EXTRA_FLAGS = 24
 XFRMA_PROTO = 25
 XFRMA_ADDRESS_FILTER = 26
 XFRMA_PAD = 27
+XFRMA_OFFLOAD_DEV = 28
+XFRMA_SET_MARK = 29
+XFRMA_SET_MARK_MASK = 30
+XFRMA_IF_ID = 31
+XFRMA_MTIMER_THRESH = 32
+XFRMA_SA_DIR = 33
+XFRMA_NAT_KEEPALIVE_INTERVAL = 34
+XFRMA_SA_PCPU = 35
 
 # XFRM policy dir
 XFRM_POLICY_IN = 0
@@ -79,11 +88,21 @@ XFRMGRP_EXPIRE = 2
 XFRMGRP_SA = 4
 XFRMGRP_POLICY = 8
 
+# XFRM policy flags
+XFRM_POLICY_CPU_ACQUIRE = 4
+
+# XFRM state flags
+XFRM_STATE_ESN = 128
+
 # XFRM policy types
 XFRM_POLICY_ALLOW = 0
 XFRM_POLICY_BLOCK = 1
 
 
+# Traffic statistics of an installed IPsec SA. Times are seconds since the epoch (0 if never happened)
+SaStats = namedtuple('SaStats', ['bytes', 'packets', 'add_time', 'last_used'])
+
+
 # Helper function to create a c_ubyte_Array from a byte object
 def create_byte_array(data, size=None):
     if size is None:
@@ -96,18 +115,36 @@ class Mode(SafeIntEnum):
     TUNNEL = XFRM_MODE_TUNNEL
 
 
-# TODO: This needs to support IPv6 in the future
+def _family(version):
+    return socket.AF_INET if version == 4 else socket.AF_INET6
+
+
 class XfrmAddress(NetlinkStructure, BigEndianStructure):
     _fields_ = (('addr', c_uint32 * 4),)
 
     @classmethod
-    def from_ipaddr(cls, ip_addr):
+    def from_int(cls, value, version=4):
+        """ Creates a new XfrmAddress from an integer address. IPv4 addresses take the first word
+        """
         result = XfrmAddress()
-        result.addr[0] = int(ip_addr)
+        if version == 4:
+            result.addr[0] = value
+        else:
+            for i in range(4):
+                result.addr[i] = (value >> (96 - 32 * i)) & 0xFFFFFFFF
         return result
 
-    def to_ipaddr(self):
-        return ip_address(self.addr[0])
+    @classmethod
+    def from_ipaddr(cls, ip_addr):
+        return cls.from_int(int(ip_addr), ip_addr.version)
+
+    def to_int(self, family=socket.AF_INET):
+        if family == socket.AF_INET:
+            return self.addr[0]
+        return self.addr[0] << 96 | self.addr[1] << 64 | self.addr[2] << 32 | self.addr[3]
+
+    def to_ipaddr(self, family=socket.AF_INET):
+        return ip_address(self.to_int(family).to_bytes(4 if family == socket.AF_INET else 16, 'big'))
 
 
 class XfrmSelector(NetlinkStructure):
@@ -124,6 +161,21 @@ class XfrmSelector(NetlinkStructure):
                 ('ifindex', c_uint32),
                 ('user', c_uint32))
 
+    @classmethod
+    def build(cls, src_prefix, dst_prefix, src_port, dst_port, ip_proto, version=4):
+        """ Creates a new XfrmSelector from the (address, prefix length) tuples of the source and destination
+        """
+        return XfrmSelector(family=_family(version),
+                            daddr=XfrmAddress.from_int(dst_prefix[0], version),
+                            saddr=XfrmAddress.from_int(src_prefix[0], version),
+                            dport=dst_port,
+                            sport=src_port,
+                            dport_mask=0 if dst_port == 0 else 0xFFFF,
+                            sport_mask=0 if src_port == 0 else 0xFFFF,
+                            prefixlen_d=dst_prefix[1],
+                            prefixlen_s=src_prefix[1],
+                            proto=ip_proto)
+
 
 class XfrmUserPolicyId(NetlinkStructure):
     _fields_ = (('selector', XfrmSelector),
@@ -152,6 +204,23 @@ class XfrmLifetimeCfg(NetlinkStructure):
                                soft_use_expires_seconds=0,
                                hard_use_expires_seconds=0)
 
+    @classmethod
+    def build(cls, lifetime=-1, lifetime_bytes=0, lifetime_packets=0):
+        """ Creates a lifetime configuration with the indicated soft limits. Hard limits are set slightly
+            above them to leave some room for the rekey. Negative or zero values mean no limit.
+        """
+        result = cls.infinite()
+        if lifetime >= 0:
+            result.soft_add_expires_seconds = lifetime
+            result.hard_add_expires_seconds = lifetime + 10
+        if lifetime_bytes > 0:
+            result.soft_byte_limit = lifetime_bytes
+            result.hard_byte_limit = lifetime_bytes + lifetime_bytes // 10
+        if lifetime_packets > 0:
+            result.soft_packed_limit = lifetime_packets
+            result.hard_packet_limit = lifetime_packets + lifetime_packets // 10
+        return result
+
 
 class XfrmLifetimeCur(NetlinkStructure):
     _fields_ = (('bytes', c_uint64),
@@ -160,6 +229,10 @@ class XfrmLifetimeCur(NetlinkStructure):
                 ('use_time', c_uint64))
 
 
+class XfrmLastUsed(NetlinkStructure):
+    _fields_ = (('time', c_uint64),)
+
+
 class XfrmUserPolicyInfo(NetlinkStructure):
     _fields_ = (('sel', XfrmSelector),
                 ('lft', XfrmLifetimeCfg),
@@ -227,6 +300,34 @@ class XfrmAlgo(NetlinkStructure):
                         key=create_byte_array(key, 64))
 
 
+class XfrmMark(NetlinkStructure):
+    _fields_ = (('v', c_uint32),
+                ('m', c_uint32))
+
+
+class XfrmReplayStateEsn(NetlinkStructure):
+    _fields_ = (('bmp_len', c_uint32),
+                ('oseq', c_uint32),
+                ('seq', c_uint32),
+                ('oseq_hi', c_uint32),
+                ('seq_hi', c_uint32),
+                ('replay_window', c_uint32))
+
+    @classmethod
+    def build(cls, replay_window, oseq=0):
+        # the bitmap is variable length, so create a specific structure for the requested window
+        bmp_len = (replay_window + 31) // 32
+
+        class _Internal(cls):
+            _fields_ = (('bmp', c_uint32 * bmp_len),)
+
+        return _Internal(bmp_len=bmp_len, replay_window=replay_window, oseq=oseq & 0xFFFFFFFF, oseq_hi=oseq >> 32)
+
+
+class XfrmSaPcpu(NetlinkStructure):
+    _fields_ = (('cpu', c_uint32),)
+
+
 class XfrmUserSaId(NetlinkStructure):
     _fields_ = (('daddr', XfrmAddress),
                 ('spi', c_ubyte * 4),
@@ -253,12 +354,15 @@ class XfrmUserExpire(NetlinkStructure):
 class Xfrm(NetlinkProtocol):
     attribute_types = {
         XFRMA_TMPL: XfrmUserTmpl,
+        XFRMA_LASTUSED: XfrmLastUsed,
+        XFRMA_SA_PCPU: XfrmSaPcpu,
     }
 
     payload_types = _msg_to_struct = {
         XFRM_MSG_ACQUIRE: XfrmUserAcquire,
         XFRM_MSG_EXPIRE: XfrmUserExpire,
         XFRM_MSG_NEWPOLICY: XfrmUserPolicyInfo,
+        XFRM_MSG_NEWSA: XfrmUserSaInfo,
     }
 
     _cipher_names = {
@@ -275,36 +379,41 @@ class Xfrm(NetlinkProtocol):
 
     netlink_family = socket.NETLINK_XFRM
 
-    def _create_sa(self, src_selector, dst_selector, src_port, dst_port, spi, ip_proto, ipsec_proto, mode, src, dst,
-                   enc_algorithm, sk_e, auth_algorithm, sk_a, lifetime=-1):
+    @staticmethod
+    def _route_attributes(if_id, mark):
+        """ Returns the attributes that bind a policy or SA to an XFRM interface or to a mark
+        """
+        attributes = {}
+        if if_id:
+            attributes[XFRMA_IF_ID] = c_uint32(if_id)
+        if mark:
+            attributes[XFRMA_MARK] = XfrmMark(v=mark, m=0xFFFFFFFF)
+        return attributes
+
+    def _create_sa(self, selector, spi, ipsec_proto, mode, src, dst, enc_algorithm, sk_e, auth_algorithm, sk_a,
+                   lifetime=-1, if_id=0, mark=0, replay_window=0, esn=False, cpu=None, lifetime_bytes=0,
+                   lifetime_packets=0, oseq=0):
+        # the legacy replay_window field only allows up to 32 packets. Larger windows, ESN and initial outbound
+        # sequence numbers require the replay state to be provided as an attribute (and the legacy field to be 0)
+        use_replay_esn = esn or replay_window > 32 or oseq > 0
         usersa = XfrmUserSaInfo(
-            sel=XfrmSelector(family=socket.AF_INET,
-                             daddr=XfrmAddress.from_ipaddr(dst_selector[0]),
-                             saddr=XfrmAddress.from_ipaddr(src_selector[0]),
-                             dport=dst_port,
-                             sport=src_port,
-                             dport_mask=0 if dst_port == 0 else 0xFFFF,
-                             sport_mask=0 if src_port == 0 else 0xFFFF,
-                             prefixlen_d=dst_selector.prefixlen,
-                             prefixlen_s=src_selector.prefixlen,
-                             proto=ip_proto),
+            sel=selector,
             id=XfrmId(daddr=XfrmAddress.from_ipaddr(dst),
                       proto=(socket.IPPROTO_ESP
                              if ipsec_proto == Proposal.Protocol.ESP else socket.IPPROTO_AH),
                       spi=create_byte_array(spi)),
-            family=socket.AF_INET,
+            family=_family(dst.version),
             saddr=XfrmAddress.from_ipaddr(src),
             mode=mode,
-            lft=XfrmLifetimeCfg.infinite() if lifetime < 0 else XfrmLifetimeCfg(soft_byte_limit=0xFFFFFFFFFFFFFFFF,
-                                                                                hard_byte_limit=0xFFFFFFFFFFFFFFFF,
-                                                                                soft_packed_limit=0xFFFFFFFFFFFFFFFF,
-                                                                                hard_packet_limit=0xFFFFFFFFFFFFFFFF,
-                                                                                soft_add_expires_seconds=lifetime,
-                                                                                hard_add_expires_seconds=lifetime + 10,
-                                                                                soft_use_expires_seconds=0,
-                                                                                hard_use_expires_seconds=0),
+            replay_window=0 if use_replay_esn else replay_window,
+            flags=XFRM_STATE_ESN if esn else 0,
+            lft=XfrmLifetimeCfg.build(lifetime, lifetime_bytes, lifetime_packets),
         )
-        attributes = {}
+        attributes = self._route_attributes(if_id, mark)
+        if use_replay_esn:
+            attributes[XFRMA_REPLAY_ESN_VAL] = XfrmReplayStateEsn.build(replay_window, oseq)
+        if cpu is not None:
+            attributes[XFRMA_SA_PCPU] = XfrmSaPcpu(cpu=cpu)
         if ipsec_proto == Proposal.Protocol.ESP:
             attributes[XFRMA_ALG_CRYPT] = XfrmAlgo.build(alg_name=self._cipher_names[enc_algorithm], key=sk_e)
         attributes[XFRMA_ALG_AUTH] = XfrmAlgo.build(alg_name=self._auth_names[auth_algorithm], key=sk_a)
@@ -318,39 +427,51 @@ class Xfrm(NetlinkProtocol):
         usersaflush = XfrmUserSaFlush(proto=0)
         self.send_recv(XFRM_MSG_FLUSHSA, (NLM_F_REQUEST | NLM_F_ACK), usersaflush)
 
+    def delete_sas_except(self, spis):
+        """ Deletes the IPsec SAs whose SPI is not in spis (e.g. those not adopted after a restart)
+        """
+        for header, payload, attributes in self.send_recv(XFRM_MSG_GETSA, (NLM_F_REQUEST | NLM_F_DUMP),
+                                                          XfrmUserSaId()):
+            if header.type != XFRM_MSG_NEWSA or bytes(payload.id.spi) in spis:
+                continue
+            xfrm_id = XfrmUserSaId(daddr=payload.id.daddr, spi=payload.id.spi, family=payload.family,
+                                   proto=payload.id.proto)
+            try:
+                self.send_recv(XFRM_MSG_DELSA, (NLM_F_REQUEST | NLM_F_ACK), xfrm_id)
+            except NetlinkError as ex:
+                logging.warning('Could not delete IPsec SA with SPI: {}. {}'.format(hexstring(bytes(payload.id.spi)),
+                                                                                    ex))
+
     def _create_policy(self, src_selector, dst_selector, src_port, dst_port, ip_proto, direction,
-                       ipsec_proto, mode, src, dst, index=0):
+                       ipsec_proto, mode, src, dst, index=0, if_id=0, mark=0, flags=0, update=False):
         policy = XfrmUserPolicyInfo(
-            sel=XfrmSelector(family=socket.AF_INET,
-                             daddr=XfrmAddress.from_ipaddr(dst_selector[0]),
-                             saddr=XfrmAddress.from_ipaddr(src_selector[0]),
-                             dport=dst_port,
-                             sport=src_port,
-                             dport_mask=0 if dst_port == 0 else 0xFFFF,
-                             sport_mask=0 if src_port == 0 else 0xFFFF,
-                             prefixlen_d=dst_selector.prefixlen,
-                             prefixlen_s=src_selector.prefixlen,
-                             proto=ip_proto),
+            sel=XfrmSelector.build((int(src_selector.network_address), src_selector.prefixlen),
+                                   (int(dst_selector.network_address), dst_selector.prefixlen), src_port, dst_port,
+                                   ip_proto, src_selector.version),
             dir=direction,
             index=index,
             action=XFRM_POLICY_ALLOW,
+            flags=flags,
             lft=XfrmLifetimeCfg.infinite(),
         )
         template = XfrmUserTmpl(
             id=XfrmId(daddr=XfrmAddress.from_ipaddr(dst),
                       proto=(socket.IPPROTO_ESP if ipsec_proto == Proposal.Protocol.ESP else socket.IPPROTO_AH)),
-            family=socket.AF_INET,
+            family=_family(dst.version),
             saddr=XfrmAddress.from_ipaddr(src),
             aalgos=0xFFFFFFFF,
             ealgos=0xFFFFFFFF,
             calgos=0xFFFFFFFF,
             mode=mode)
-        self.send_recv(XFRM_MSG_NEWPOLICY, (NLM_F_REQUEST | NLM_F_ACK), policy, {XFRMA_TMPL: template})
+        attributes = self._route_attributes(if_id, mark)
+        attributes[XFRMA_TMPL] = template
+        self.send_recv(XFRM_MSG_UPDPOLICY if update else XFRM_MSG_NEWPOLICY, (NLM_F_REQUEST | NLM_F_ACK), policy,
+                       attributes)
 
     def delete_sa(self, daddr, proto, spi):
         xfrm_id = XfrmUserSaId(
             daddr=XfrmAddress.from_ipaddr(daddr),
-            family=socket.AF_INET,
+            family=_family(daddr.version),
             proto=socket.IPPROTO_ESP if proto == Proposal.Protocol.ESP else socket.IPPROTO_AH,
             spi=create_byte_array(spi))
         try:
@@ -358,35 +479,109 @@ class Xfrm(NetlinkProtocol):
         except NetlinkError as ex:
             logging.warning('Could not delete IPsec SA with SPI: {}. {}'.format(hexstring(spi), ex))
 
-    def create_policies(self, my_addr, peer_addr, ike_conf):
+    @staticmethod
+    def _sa_stats(usersa, attributes):
+        last_used = attributes[XFRMA_LASTUSED].time if XFRMA_LASTUSED in attributes else 0
+        return SaStats(bytes=usersa.cur.bytes, packets=usersa.cur.packets, add_time=usersa.cur.add_time,
+                       last_used=last_used)
+
+    def get_sa_stats(self, daddr, proto, spi):
+        """ Returns the current SaStats of an IPsec SA, or None if it could not be found
+        """
+        xfrm_id = XfrmUserSaId(
+            daddr=XfrmAddress.from_ipaddr(daddr),
+            family=_family(daddr.version),
+            proto=socket.IPPROTO_ESP if proto == Proposal.Protocol.ESP else socket.IPPROTO_AH,
+            spi=create_byte_array(spi))
+        for header, payload, attributes in self.send_recv(XFRM_MSG_GETSA, NLM_F_REQUEST, xfrm_id):
+            if header.type == XFRM_MSG_NEWSA:
+                return self._sa_stats(payload, attributes)
+        return None
+
+    def get_all_sa_stats(self):
+        """ Dumps the whole SAD in a single batch and returns a dict of SaStats indexed by SPI
+        """
+        result = {}
+        for header, payload, attributes in self.send_recv(XFRM_MSG_GETSA, (NLM_F_REQUEST | NLM_F_DUMP),
+                                                          XfrmUserSaId()):
+            if header.type == XFRM_MSG_NEWSA:
+                result[bytes(payload.id.spi)] = self._sa_stats(payload, attributes)
+        return result
+
+    @staticmethod
+    def _policy_selectors(my_addr, peer_addr, ike_conf, per_peer):
+        """ Yields the (ipsec_conf, src_selector, dst_selector, ip_proto, my_port, peer_port) of the policies
+            towards a peer. Peers configured by network (per_peer) have their own address as peer selector, as
+            the network they share would make the policies of the different peers collide
+        """
+        route_based = set()
         for ipsec_conf in ike_conf.protect:
-            if ipsec_conf.mode == Mode.TUNNEL:
+            ip_proto, my_port, peer_port = ipsec_conf.ip_proto, ipsec_conf.my_port, ipsec_conf.peer_port
+            if ipsec_conf.if_id or ipsec_conf.mark:
+                # route-based configurations share a single set of catch-all policies per peer and
+                # interface/mark, as the routing table is the one selecting the traffic to protect
+                if (ipsec_conf.if_id, ipsec_conf.mark) in route_based:
+                    continue
+                route_based.add((ipsec_conf.if_id, ipsec_conf.mark))
+                src_selector = dst_selector = ip_network('0.0.0.0/0')
+                if per_peer:
+                    dst_selector = ip_network(peer_addr)
+                ip_proto, my_port, peer_port = TrafficSelector.IpProtocol.ANY, 0, 0
+            elif ipsec_conf.mode == Mode.TUNNEL:
                 src_selector = ipsec_conf.my_subnet
-                dst_selector = ipsec_conf.peer_subnet
+                dst_selector = ip_network(peer_addr) if per_peer else ipsec_conf.peer_subnet
             else:
                 src_selector = ip_network(my_addr)
                 dst_selector = ip_network(peer_addr)
-
-            # generate an index for outbound policies
-            index = ipsec_conf.index << 3 | XFRM_POLICY_OUT
-
-            self._create_policy(src_selector, dst_selector, ipsec_conf.my_port,
-                                ipsec_conf.peer_port, ipsec_conf.ip_proto, XFRM_POLICY_OUT,
-                                ipsec_conf.ipsec_proto, ipsec_conf.mode, my_addr, peer_addr,
-                                index=index)
-            self._create_policy(dst_selector, src_selector, ipsec_conf.peer_port,
-                                ipsec_conf.my_port, ipsec_conf.ip_proto, XFRM_POLICY_IN,
-                                ipsec_conf.ipsec_proto, ipsec_conf.mode, peer_addr, my_addr)
-            self._create_policy(dst_selector, src_selector,
-                                ipsec_conf.peer_port, ipsec_conf.my_port,
-                                ipsec_conf.ip_proto, XFRM_POLICY_FWD, ipsec_conf.ipsec_proto,
-                                ipsec_conf.mode, peer_addr, my_addr)
+            yield ipsec_conf, src_selector, dst_selector, ip_proto, my_port, peer_port
+
+    def create_policies(self, my_addr, peer_addr, ike_conf, update=False, per_peer=False):
+        for ipsec_conf, src_selector, dst_selector, ip_proto, my_port, peer_port in self._policy_selectors(
+                my_addr, peer_addr, ike_conf, per_peer):
+            # generate an index for outbound policies. Those of peers configured by network would collide, so the
+            # kernel chooses them
+            index = 0 if per_peer else ipsec_conf.index << 3 | XFRM_POLICY_OUT
+
+            # per-CPU SAs require the kernel to send ACQUIREs for CPUs without their own SA
+            flags = XFRM_POLICY_CPU_ACQUIRE if ipsec_conf.per_cpu_sas else 0
+
+            self._create_policy(src_selector, dst_selector, my_port, peer_port, ip_proto, XFRM_POLICY_OUT,
+                                ipsec_conf.ipsec_proto, ipsec_conf.mode, my_addr, peer_addr, index=index,
+                                if_id=ipsec_conf.if_id, mark=ipsec_conf.mark, flags=flags, update=update)
+            self._create_policy(dst_selector, src_selector, peer_port, my_port, ip_proto, XFRM_POLICY_IN,
+                                ipsec_conf.ipsec_proto, ipsec_conf.mode, peer_addr, my_addr,
+                                if_id=ipsec_conf.if_id, mark=ipsec_conf.mark, update=update)
+            self._create_policy(dst_selector, src_selector, peer_port, my_port, ip_proto, XFRM_POLICY_FWD,
+                                ipsec_conf.ipsec_proto, ipsec_conf.mode, peer_addr, my_addr,
+                                if_id=ipsec_conf.if_id, mark=ipsec_conf.mark, update=update)
+
+    def delete_policies(self, my_addr, peer_addr, ike_conf, per_peer=False):
+        """ Deletes the policies created by create_policies() with the same arguments
+        """
+        for ipsec_conf, src_selector, dst_selector, ip_proto, my_port, peer_port in self._policy_selectors(
+                my_addr, peer_addr, ike_conf, per_peer):
+            for src, dst, src_port, dst_port, direction in (
+                    (src_selector, dst_selector, my_port, peer_port, XFRM_POLICY_OUT),
+                    (dst_selector, src_selector, peer_port, my_port, XFRM_POLICY_IN),
+                    (dst_selector, src_selector, peer_port, my_port, XFRM_POLICY_FWD)):
+                policy_id = XfrmUserPolicyId(
+                    selector=XfrmSelector.build((int(src.network_address), src.prefixlen),
+                                                (int(dst.network_address), dst.prefixlen), src_port, dst_port,
+                                                ip_proto, src.version),
+                    dir=direction)
+                try:
+                    self.send_recv(XFRM_MSG_DELPOLICY, (NLM_F_REQUEST | NLM_F_ACK), policy_id,
+                                   self._route_attributes(ipsec_conf.if_id, ipsec_conf.mark))
+                except NetlinkError as ex:
+                    logging.warning('Could not delete policy towards {}. {}'.format(peer_addr, ex))
 
     def create_sa(self, src, dst, src_sel, dst_sel, ipsec_protocol, spi, enc_algorith, sk_e,
-                  auth_algorithm, sk_a, mode, lifetime=-1):
-        self._create_sa(src_sel.get_network(), dst_sel.get_network(), src_sel.get_port(),
-                        dst_sel.get_port(), spi, src_sel.ip_proto, ipsec_protocol, mode, src,
-                        dst, enc_algorith, sk_e, auth_algorithm, sk_a, lifetime)
+                  auth_algorithm, sk_a, mode, lifetime=-1, if_id=0, mark=0, replay_window=0, esn=False,
+                  cpu=None, lifetime_bytes=0, lifetime_packets=0, oseq=0):
+        selector = XfrmSelector.build(src_sel.get_prefix(), dst_sel.get_prefix(), src_sel.get_port(),
+                                      dst_sel.get_port(), src_sel.ip_proto, src_sel.version)
+        self._create_sa(selector, spi, ipsec_protocol, mode, src, dst, enc_algorith, sk_e, auth_algorithm, sk_a,
+                        lifetime, if_id, mark, replay_window, esn, cpu, lifetime_bytes, lifetime_packets, oseq)
 
     def _get_policies(self):
         policy_id = XfrmUserPolicyId()